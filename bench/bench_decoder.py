@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Benchmark of MinidoProtocolDecoder.recv_minido_packet : decoded
+    packets per second on a replayed bus trace, with the dispatch table
+    and with the former if/elif cascade (printing every packet).
+    The trace is mostly echo traffic, with EXO updates,
+    D2000 buttons and some unknown packets. The output of both decoders
+    goes to /dev/null, the table decoder logs at the INFO level.
+
+    Usage : ./bench_decoder.py [-n packets]
+    Requires twisted and orbited.
+"""
+
+from __future__ import print_function
+import argparse
+import datetime
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'tools'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'mu'))
+from twisted_minido_morbidqonly import (MinidoProtocolDecoder, Exi,
+    CMD, DST, SRC, COM, EXOOFFSET, EXIOFFSET)
+
+
+def legacy_recv_minido_packet(self, message):
+    """ The if/elif cascade decoder, kept for comparison """
+    print(' '.join(['{0:02x}'.format(x) for x in message]))
+    if EXOOFFSET < message[DST] <= EXOOFFSET + 16:
+        # This is a packet for an EXO module : EXI2EXO
+        # No need of additional test as EXO2EXO does not exists.
+        exoid = message[DST] - EXOOFFSET
+        exiid = message[SRC] - EXIOFFSET
+        # EXO_UPDATE :
+        # We must call the exo to check if a change occured.
+        if message[COM] == CMD['EXO_UPDATE']:
+            try:
+                list_of_changes = self.exodict[exoid].update(exiid, 
+                    message[5:-1])
+                for change in list_of_changes:
+                    print( ('{0!s:.23} : EXI-{1:02}->EXO-{2:02} : ' + \
+                        'Output {3:1} = {4:3}  ( was {5:3})').format(
+                        datetime.datetime.now(),
+                        exiid, exoid,
+                        change[0],
+                        change[1],
+                        change[2]
+                        ))
+            except(KeyError):
+                print("This should never happen : all EXO are created")
+        elif message[COM] == CMD['EXO_ECHO_REQUEST']:
+            print( ('{0!s:.23} : EXI-{1:02}->EXO-{2:02} : ' + \
+                'EXI2EXO_ECHO_REQUEST').format(
+                datetime.datetime.now(),
+                exiid, exoid,
+                ))
+            # Nothing more to do, as it's probably comming from us.
+
+    elif EXIOFFSET < message[DST] <= EXIOFFSET + 16:
+        # This is a packet to an EXI module
+        exiid = message[DST] - EXIOFFSET
+        if EXOOFFSET < message[SRC] <= EXOOFFSET + 16:
+            # From an EXO module : EXO2EXI
+            exoid = message[SRC] - EXOOFFSET
+            # EXO_ECHO_REPLY
+            if message[COM] == CMD['EXO_ECHO_REPLY']:
+                print( ( '{0!s:.23} : EXO-{1:02}->MU ' +
+                    'EXO2EXI_ECHO_REPLY').format(
+                    datetime.datetime.now(),
+                    exoid
+                    ))
+                self.exodict[exoid].is_present = True
+            else:
+                print('Problem here. AFAIK an EXO never send anything \
+                    to EXI except for EXO_ECHO_REPLY')
+                print('{0!s:.23} : EXO-{2:02}->EXI-{1:02} : \
+                    CMD:{3:2} DATA:{4!s:10}'.format(
+                    datetime.datetime.now(),
+                    exiid,exoid,
+                    message[COM],
+                    message[5:-1]
+                    ))
+        else:
+            # From an EXI module : EXI2EXI
+            if message[COM] == CMD['EXI_ECHO_REQUEST']:
+                print( '{0!s:.23} : EXI-{2:02}->EXI-{1:02} : \
+                    EXI2EXI_ECHO_REQUEST'.format(
+                    datetime.datetime.now(),
+                    message[DST] - EXIOFFSET,
+                    message[SRC] - EXIOFFSET,
+                    ))
+            elif message[COM] == CMD['EXI_ECHO_REPLY']:
+                srcexiid = message[SRC] - EXIOFFSET
+                print( '{0!s:.23} : EXI-{2:02}->EXI-{1:02} : \
+                    EXI2EXI_ECHO_REPLY'.format(
+                    datetime.datetime.now(),
+                    message[DST] - EXIOFFSET,
+                    srcexiid,
+                    ))
+                self.exidict[srcexiid] = Exi(self.send_data)
+            else:
+                print( '{0!s:.23} : SRC-{2:02}->EXI-{1:02} : \
+                    CMD:{3:2} DATA:{4!s:10}'.format(
+                    datetime.datetime.now(),
+                    message[DST] - EXIOFFSET,
+                    message[SRC],
+                    message[COM],
+                    message[5:-1]
+                    ))
+    elif message[DST] == 0x0b:
+        # This is a packet for the D2000
+        if message[COM] == CMD['EXICENT'] and \
+            message[SRC]-EXIOFFSET == message[5:-1][0]:
+            # This is packet normally used by D2000
+            # The EXI info is twice in the packet, 
+            # that's why we make the second check.
+            print( ( '{0!s:.23} : EXI-{1:02}->D-2000 : ' +
+                'Button {2:2}').format(
+                datetime.datetime.now(),
+                message[SRC]-EXIOFFSET,
+                message[6],
+                ))
+    else:
+        print( ( '{0!s:.23} : SRC-{2:02x}->DST-{1:02x} : ' +
+            'Unable to decode - ' +
+            'CMD (hex):{3:02x} DATA (hex):{4!s:10}' ).format(
+            datetime.datetime.now(),
+            message[DST],
+            message[SRC],
+            message[COM],
+            ' '.join(['{0:02x}'.format(x) 
+                for x in message[5:-1]])
+            ))
+
+
+def build_trace(count, seed=0x23):
+    """ Bus packets as received from STOMP (lists of integers) """
+    rnd = random.Random(seed)
+    trace = list()
+    status = dict([(exo, [0] * 8) for exo in range(1, 17)])
+    for i in range(count):
+        kind = rnd.random()
+        if kind < 0.5:
+            exi = rnd.randint(1, 16)
+            packet = [0x23, exi + EXIOFFSET, 0x17, 0x02,
+                rnd.choice((CMD['EXI_ECHO_REQUEST'], CMD['EXI_ECHO_REPLY']))]
+        elif kind < 0.8:
+            exo = rnd.randint(1, 16)
+            if rnd.random() < 0.5:
+                packet = [0x23, exo + EXOOFFSET, 0x17, 0x02,
+                    CMD['EXO_ECHO_REQUEST']]
+            else:
+                packet = [0x23, 0x17, exo + EXOOFFSET, 0x02,
+                    CMD['EXO_ECHO_REPLY']]
+        elif kind < 0.95:
+            # EXO_UPDATE, changing one output out of two
+            exo = rnd.randint(1, 16)
+            if rnd.random() < 0.5:
+                channel = rnd.randint(0, 7)
+                status[exo][channel] = 255 - status[exo][channel]
+            packet = [0x23, exo + EXOOFFSET, 0x14, 0x0A,
+                CMD['EXO_UPDATE']] + status[exo]
+        elif kind < 0.98:
+            exi = rnd.randint(1, 16)
+            packet = [0x23, 0x0B, exi + EXIOFFSET, 0x04, CMD['EXICENT'],
+                exi, rnd.randint(0, 31)]
+        else:
+            packet = [0x23, rnd.randint(0x60, 0xFF), 0x00, 0x02, 0x99]
+        chk = 0
+        for item in packet[4:]:
+            chk ^= item
+        trace.append(packet + [chk])
+    return trace
+
+
+def replay(decode, mpd, trace):
+    start = time.time()
+    for packet in trace:
+        decode(mpd, packet)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of MinidoProtocolDecoder.recv_minido_packet')
+    parser.add_argument('-n', '--packets', type=int, default=200000,
+        help='Number of packets in the trace (default 200000)')
+    args = parser.parse_args()
+
+    # The sqlite DB is created in the current directory.
+    os.chdir(tempfile.mkdtemp(prefix='mu-bench-'))
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    # stompservice sets the root logger to DEBUG on stderr.
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(name)s %(levelname)s : %(message)s'))
+    logging.getLogger().handlers = [handler]
+    logging.getLogger().setLevel(logging.INFO)
+
+    mpd = MinidoProtocolDecoder(lambda data, priority='normal': None)
+    trace = build_trace(args.packets)
+    # Warm up : the EXO outputs are known and every EXI was seen.
+    replay(MinidoProtocolDecoder.recv_minido_packet, mpd, trace[:1000])
+
+    results = list()
+    for name, decode in (
+            ('table', MinidoProtocolDecoder.recv_minido_packet),
+            ('cascade', legacy_recv_minido_packet)):
+        elapsed = replay(decode, mpd, trace)
+        results.append((name, elapsed))
+    mpd.mydb.closedb()
+
+    for name, elapsed in results:
+        print('{0:8} : {1:8.3f} s {2:10.0f} packets/s'.format(
+            name, elapsed, len(trace) / elapsed), file=stdout)
+    print('Speedup  : {0:.1f}x'.format(results[1][1] / results[0][1]),
+        file=stdout)
+
+
+if __name__ == '__main__':
+    main()
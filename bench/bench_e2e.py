@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    End-to-end benchmark of the real components, each in its own process :
+        bus simulator (tools/minidosim.py) <-> rs485bus2stomp.tac
+        <-> MorbidQ <-> decoder (twisted_minido_morbidqonly, XML-RPC)
+                    <-> morbidq2tcp.tac <-> TCP/IP client
+    This program is a client of the simulator (it plays an EXI), of the
+    decoder XML-RPC web service, and of morbidq2tcp. It measures :
+    - set_output to bus    : XML-RPC set_output until the EXO_UPDATE is
+                             seen on the bus.
+    - bus to get_output    : an EXO_UPDATE written on the bus until the new
+                             state is returned by XML-RPC get_output.
+    - bus to tcp client    : the same EXO_UPDATE until it is received by
+                             the client of morbidq2tcp.
+    - throughput           : EXO_UPDATE are written on the bus at doubling
+                             rates. A rate is sustained by the decoder if
+                             get_output shows the last state within
+                             --max-lag seconds after the last frame, and
+                             by the tcp client if it has received every
+                             frame within --max-lag seconds.
+    The results are written in JSON (--output), with the commit, and can
+    be compared with a previous run (--compare).
+
+    By default the simulated bus has no speed limit, so that only the
+    software is measured. Use --baudrate 19200 to add the real bus timing.
+
+    Usage : ./bench_e2e.py [-n samples] [-o results.json] [--compare old.json]
+    Requires twisted, morbid, stompservice and orbited.
+"""
+
+from __future__ import print_function
+import argparse
+import datetime
+import json as jsonlib
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+TOOLSDIR = os.path.join(BASEDIR, '..', 'tools')
+MUDIR = os.path.join(BASEDIR, '..', 'mu')
+sys.path.insert(0, TOOLSDIR)
+sys.path.insert(0, MUDIR)
+
+COMPONENTS = ('broker', 'sim', 'bridge', 'tcpbridge', 'decoder')
+EXOOFFSET = 0x3B
+EXIOFFSET = 0x13
+# The EXI played by this program
+BENCH_EXI = 5
+# EXO used by the throughput markers, the others carry the load
+MARKER_EXO = 16
+# Time slice of the load generator (seconds)
+TICK = 0.01
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def summary(latencies):
+    """ p50, p95, p99, max in milliseconds """
+    if not latencies:
+        return dict(n=0)
+    result = dict([('p%i' % pct, percentile(latencies, pct) * 1000.0)
+        for pct in (50, 95, 99)])
+    result['max'] = max(latencies) * 1000.0
+    result['n'] = len(latencies)
+    return result
+
+
+def run_component(args):
+    """ Run one component in this process, until it is killed """
+    from twisted.internet import reactor
+    # stompservice sets up its own logging when imported.
+    import stompservice
+    import mulog
+    mulog.setup({'mu': 'INFO'})
+    ports = args.ports
+    if args.component == 'broker':
+        from morbid import get_stomp_factory
+        reactor.listenTCP(ports['broker'], get_stomp_factory(),
+            interface='127.0.0.1')
+    elif args.component == 'sim':
+        import minidosim
+        bus, exos, exis = minidosim.build(exis=(1, 2, 3),
+            baudrate=args.baudrate, gap=args.gap, seed=1)
+        reactor.listenTCP(ports['sim'], minidosim.AdapterFactory(bus),
+            interface='127.0.0.1')
+    elif args.component == 'bridge':
+        bridge = dict(__file__='rs485bus2stomp.tac')
+        execfile(os.path.join(TOOLSDIR, 'rs485bus2stomp.tac'), bridge)
+        bridge['MORBIDQ_PORT'] = ports['broker']
+        reactor.connectTCP('127.0.0.1', ports['sim'],
+            bridge['minido_factory'])
+        reactor.connectTCP('127.0.0.1', ports['broker'],
+            bridge['morbidq_factory'])
+    elif args.component == 'tcpbridge':
+        tcpbridge = dict(__file__='morbidq2tcp.tac')
+        execfile(os.path.join(TOOLSDIR, 'morbidq2tcp.tac'), tcpbridge)
+        tcpbridge['MORBIDQ_PORT'] = ports['broker']
+        reactor.listenTCP(ports['tcpbridge'], tcpbridge['minidoFactory'],
+            interface='127.0.0.1')
+        reactor.connectTCP('127.0.0.1', ports['broker'],
+            tcpbridge['morbidqFactory'])
+    elif args.component == 'decoder':
+        import twisted_minido_morbidqonly as decoder
+        decoder.MORBIDQ_HOST = '127.0.0.1'
+        decoder.MORBIDQ_PORT = ports['broker']
+        decoder.XMLRPC_PORT = ports['decoder']
+        decoder.mu_main()
+        return
+    reactor.run()
+
+
+def start_components(args, workdir):
+    """ Start every component, return the list of processes """
+    processes = list()
+    for component in COMPONENTS:
+        logfile = open(os.path.join(workdir, component + '.log'), 'w')
+        processes.append(subprocess.Popen([sys.executable,
+            os.path.abspath(__file__), '--component', component,
+            '--ports', jsonlib.dumps(args.ports),
+            '--baudrate', str(args.baudrate), '--gap', str(args.gap)],
+            cwd=workdir, stdout=logfile, stderr=subprocess.STDOUT))
+        # The broker and the simulator must listen before the others.
+        time.sleep(0.5 if component in ('broker', 'sim') else 0.0)
+    return processes
+
+
+def measure(args):
+    """ Run the measures against the started components """
+    from twisted.internet import reactor, defer
+    from twisted.internet.protocol import ClientFactory
+    from twisted.web.xmlrpc import Proxy
+    from protocol import MinidoProtocol, checksum
+    import mulog
+    mulog.setup({'mu': 'WARNING'}, stream=sys.stderr)
+
+    class Probe(ClientFactory):
+        """
+        TCP/IP client receiving framed packets. expect(match) returns a
+        Deferred fired with the time when a matching packet is received.
+        """
+        def __init__(self):
+            self.connections = list()
+            self.expected = list()
+            self.received = 0
+            self.connected = defer.Deferred()
+
+        def buildProtocol(self, addr):
+            reactor.callLater(0, self.connected.callback, None)
+            return MinidoProtocol(self, pacing=0.0)
+
+        def clientConnectionFailed(self, connector, reason):
+            self.connected.errback(reason)
+
+        def expect(self, match):
+            d = defer.Deferred()
+            self.expected.append((match, d))
+            return d
+
+        def recv_message(self, data):
+            self.received += 1
+            now = time.time()
+            for item in list(self.expected):
+                if item[0](data):
+                    self.expected.remove(item)
+                    item[1].callback(now)
+
+        def write(self, data):
+            self.connections[0].transport.write(bytes(bytearray(data)))
+
+    def exo_update(exoid, state):
+        data = [0x01] + list(state)
+        return [0x23, exoid + EXOOFFSET, BENCH_EXI + EXIOFFSET,
+            len(data) + 1] + data + [checksum(data)]
+
+    def is_update(exoid, output, value):
+        return lambda data: (data[1] == exoid + EXOOFFSET and
+            data[4] == 0x01 and len(data) >= 14 and data[4 + output] == value)
+
+    def sleep(seconds):
+        d = defer.Deferred()
+        reactor.callLater(seconds, d.callback, None)
+        return d
+
+    ports = args.ports
+    proxy = Proxy('http://127.0.0.1:%i/' % ports['decoder'])
+    bus = Probe()
+    tcp = Probe()
+    # Last state of each EXO, as written on the bus
+    states = dict([(exoid, [0] * 8) for exoid in range(1, 17)])
+    results = dict(latency=dict(), throughput=dict())
+
+    @defer.inlineCallbacks
+    def get_output_until(exoid, output, value, timeout):
+        """ Poll get_output, return the time it returns value or None """
+        limit = time.time() + timeout
+        while time.time() < limit:
+            try:
+                current = yield proxy.callRemote('get_output', exoid, output)
+            except Exception:
+                current = None
+            if current == value:
+                defer.returnValue(time.time())
+        defer.returnValue(None)
+
+    @defer.inlineCallbacks
+    def wait_ready():
+        for retry in range(100):
+            try:
+                yield proxy.callRemote('list_exo')
+                break
+            except Exception:
+                yield sleep(0.2)
+        else:
+            raise RuntimeError('The decoder web service does not answer')
+        reactor.connectTCP('127.0.0.1', ports['sim'], bus)
+        reactor.connectTCP('127.0.0.1', ports['tcpbridge'], tcp)
+        yield bus.connected
+        yield tcp.connected
+        # Let the EXI scan of the decoder go through the bus.
+        yield sleep(2.5)
+        # Known state of every EXO (get_output returns None before).
+        for exoid in range(1, 17):
+            bus.write(exo_update(exoid, states[exoid]))
+            yield sleep(0.02)
+        yield sleep(0.5)
+
+    @defer.inlineCallbacks
+    def set_output_to_bus(samples):
+        latencies = list()
+        for i in range(samples):
+            exoid, output = i % 15 + 1, i // 15 % 8 + 1
+            value = 255 - states[exoid][output - 1]
+            states[exoid][output - 1] = value
+            d = bus.expect(is_update(exoid, output, value))
+            start = time.time()
+            yield proxy.callRemote('set_output', exoid, output, value)
+            latencies.append((yield d) - start)
+            yield sleep(0.02)
+        defer.returnValue(latencies)
+
+    @defer.inlineCallbacks
+    def bus_to_clients(samples):
+        to_get_output = list()
+        to_tcp = list()
+        for i in range(samples):
+            exoid, output = i % 15 + 1, i // 15 % 8 + 1
+            value = 255 - states[exoid][output - 1]
+            states[exoid][output - 1] = value
+            d = tcp.expect(is_update(exoid, output, value))
+            start = time.time()
+            bus.write(exo_update(exoid, states[exoid]))
+            seen = yield get_output_until(exoid, output, value, 5.0)
+            if seen is not None:
+                to_get_output.append(seen - start)
+            to_tcp.append((yield d) - start)
+            yield sleep(0.02)
+        defer.returnValue((to_get_output, to_tcp))
+
+    @defer.inlineCallbacks
+    def throughput_step(rate, duration, marker, check_tcp):
+        """ Write rate frames/s during duration seconds, return the lags """
+        frames = int(rate * duration)
+        received = tcp.received
+        sent = 0
+        start = time.time()
+        while sent < frames:
+            due = min(frames, int((time.time() - start) * rate) + 1)
+            while sent < due:
+                exoid, output = sent % 15 + 1, sent // 15 % 8 + 1
+                states[exoid][output - 1] ^= 0xFF
+                bus.write(exo_update(exoid, states[exoid]))
+                sent += 1
+            yield sleep(TICK)
+        elapsed = time.time() - start
+        states[MARKER_EXO][7] = marker
+        bus.write(exo_update(MARKER_EXO, states[MARKER_EXO]))
+        end = time.time()
+        seen = yield get_output_until(MARKER_EXO, 8, marker, args.max_lag)
+        decoder_lag = None if seen is None else seen - end
+        step = dict(rate=rate, sent_rate=sent / elapsed, frames=frames + 1,
+            decoder_lag=decoder_lag, decoder=decoder_lag is not None)
+        if check_tcp:
+            while (tcp.received - received < frames + 1 and
+                    time.time() < end + args.max_lag):
+                yield sleep(TICK)
+            step.update(tcp_lag=time.time() - end,
+                tcp_received=tcp.received - received)
+            step['tcp_client'] = (step['tcp_received'] >= frames + 1 and
+                step['tcp_lag'] <= args.max_lag)
+        # Let the queues drain before the next step.
+        yield sleep(1.0)
+        defer.returnValue(step)
+
+    @defer.inlineCallbacks
+    def run():
+        yield wait_ready()
+        results['latency']['set_output_to_bus'] = summary(
+            (yield set_output_to_bus(args.samples)))
+        to_get_output, to_tcp = yield bus_to_clients(args.samples)
+        results['latency']['bus_to_get_output'] = summary(to_get_output)
+        results['latency']['bus_to_tcp_client'] = summary(to_tcp)
+        steps = list()
+        rate = args.start_rate
+        best = dict(decoder=0, tcp_client=0)
+        sinks = list(best)
+        for marker in range(1, 255):
+            step = yield throughput_step(rate, args.step_duration, marker,
+                'tcp_client' in sinks)
+            steps.append(step)
+            for sink in list(sinks):
+                if step[sink]:
+                    best[sink] = rate
+                else:
+                    sinks.remove(sink)
+            if not sinks or rate >= args.max_rate:
+                break
+            rate *= 2
+        results['throughput'] = dict(max_sustained_fps=best, steps=steps)
+
+    def failed(failure):
+        sys.stderr.write(failure.getTraceback())
+        results['error'] = failure.getErrorMessage()
+
+    reactor.callWhenRunning(lambda: run().addErrback(failed).addBoth(
+        lambda result: reactor.stop()))
+    reactor.run()
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+            'HEAD'], cwd=BASEDIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, old=None):
+    """ Print the results, and the difference with an older run """
+    def line(name, value, unit, oldvalue):
+        text = '{0:32} {1:10.2f} {2:5}'.format(name, value, unit)
+        if oldvalue:
+            text += ' {0:10.2f} {1:+7.1f} %'.format(oldvalue,
+                (value - oldvalue) * 100.0 / oldvalue)
+        print(text)
+
+    header = '{0:32} {1:>10} {2:5}'.format('measure', 'value', 'unit')
+    if old is not None:
+        header += ' {0:>10} {1:>9}'.format(old.get('commit') or 'old',
+            'change')
+    print(header)
+    for name, stats in sorted(results['latency'].items()):
+        oldstats = old['latency'].get(name, {}) if old else {}
+        for key in ('p50', 'p95', 'p99', 'max'):
+            if key in stats:
+                line(name + ' ' + key, stats[key], 'ms', oldstats.get(key))
+    oldfps = old['throughput'].get('max_sustained_fps', {}) if old else {}
+    for sink, fps in sorted(results['throughput']['max_sustained_fps'].items()):
+        line('max sustained ' + sink, fps, 'fps', oldfps.get(sink))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='End-to-end latency and throughput of MU')
+    parser.add_argument('-n', '--samples', type=int, default=200,
+        help='Number of samples of each latency (default 200)')
+    parser.add_argument('-o', '--output', default='bench_e2e.json',
+        help='JSON result file (default bench_e2e.json)')
+    parser.add_argument('--compare', metavar='JSON',
+        help='Result file of a previous run to compare with')
+    parser.add_argument('--baudrate', type=int, default=0,
+        help='Simulated bus speed in bits/s (default 0 : no limit)')
+    parser.add_argument('--gap', type=float, default=0.0,
+        help='Simulated inter-frame gap in seconds (default 0)')
+    parser.add_argument('--start-rate', type=int, default=50,
+        help='First throughput step in frames/s (default 50)')
+    parser.add_argument('--max-rate', type=int, default=12800,
+        help='Last throughput step in frames/s (default 12800)')
+    parser.add_argument('--step-duration', type=float, default=3.0,
+        help='Duration of each throughput step in seconds (default 3)')
+    parser.add_argument('--max-lag', type=float, default=0.5,
+        help='Lag after a step above which the queues are growing '
+        '(default 0.5 s)')
+    parser.add_argument('--keep', action='store_true',
+        help='Keep the working directory with the logs of the components')
+    parser.add_argument('--component', choices=COMPONENTS,
+        help=argparse.SUPPRESS)
+    parser.add_argument('--ports', type=jsonlib.loads, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.component:
+        run_component(args)
+        return
+
+    old = None
+    if args.compare:
+        with open(args.compare) as oldfile:
+            old = jsonlib.load(oldfile)
+    args.ports = dict([(component, free_port()) for component in COMPONENTS])
+    workdir = tempfile.mkdtemp(prefix='mu-bench-e2e-')
+    processes = start_components(args, workdir)
+    try:
+        results = measure(args)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    results.update(commit=commit(),
+        date=datetime.datetime.now().isoformat(),
+        params=dict(samples=args.samples, baudrate=args.baudrate,
+            gap=args.gap, step_duration=args.step_duration,
+            max_lag=args.max_lag))
+    with open(args.output, 'w') as output:
+        jsonlib.dump(results, output, indent=2, sort_keys=True)
+    if args.keep:
+        print('Logs of the components in ' + workdir)
+    else:
+        shutil.rmtree(workdir)
+    if 'error' in results:
+        print('Error : ' + results['error'])
+        sys.exit(1)
+    report(results, old)
+
+
+if __name__ == '__main__':
+    main()
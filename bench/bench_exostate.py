@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    State of the 16 EXO : the ExoStore of minidodevices against the
+    former tuple of 8 deques of (datetime, value) per Exo.
+    - same    : Exo.update with the 8 outputs unchanged (most updates)
+    - change  : Exo.update with one output changed
+    - read    : Exo.get_output
+    - memory  : bytes of the state of the 16 EXO with a full history
+    The DB is replaced by a stub, only the state is measured.
+
+    Usage : ./bench_exostate.py [-n updates]
+    Requires twisted.
+"""
+
+from __future__ import print_function
+import argparse
+import datetime
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'mu'))
+import minidodevices
+
+HIST = minidodevices.HIST
+
+
+class NullDb(object):
+    def history(self, *args):
+        pass
+
+
+class LegacyExo(object):
+    """ The former Exo state, kept for comparison """
+    def __init__(self, exoid, send_data):
+        self.send_data = send_data
+        self.exoid = exoid
+        self.mydb = NullDb()
+        self.is_present = False
+        self.history = tuple([deque(maxlen=HIST) for i in range(8)])
+        for i in range(8):
+            self.history[i].append( ( datetime.datetime.now(), None ) )
+        self.pending = list()
+        self.slotcall = None
+
+    def update(self, src, statuslist):
+        list_of_changes = list()
+        for i in range(8):
+            if self.history[i][-1][1] != statuslist[i]:
+                now = datetime.datetime.now()
+                self.history[i].append( ( now, statuslist[i] ) )
+                self.mydb.history( now, 'EXO', self.exoid, i+1, statuslist[i] )
+                list_of_changes.append((i+1, statuslist[i], self.history[i][-2][1]))
+        return list_of_changes
+
+    def get_output(self, channel):
+        return self.history[ channel -1 ][-1][1]
+
+
+def legacy_exos():
+    return [LegacyExo(exoid, None) for exoid in range(1, 17)]
+
+
+def store_exos():
+    minidodevices.Db = NullDb
+    store = minidodevices.ExoStore(16, HIST)
+    return [minidodevices.Exo(exoid, None, store) for exoid in range(1, 17)]
+
+
+def sizeof(obj, seen):
+    """ Bytes of obj and of what it refers to, counted once """
+    if id(obj) in seen or obj is None or isinstance(obj, (NullDb, type)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sizeof(key, seen) + sizeof(value, seen)
+    elif isinstance(obj, (tuple, list, deque)):
+        for item in obj:
+            size += sizeof(item, seen)
+    if hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, seen)
+    for name in getattr(type(obj), '__slots__', ()):
+        size += sizeof(getattr(obj, name, None), seen)
+    return size
+
+
+def memory(exos):
+    seen = set()
+    # Shared and interned objects are not part of the state.
+    for name in ('send_data', 'mydb', 'is_present', 'exoid', 'slotcall'):
+        for exo in exos:
+            seen.add(id(getattr(exo, name)))
+    return sum([sizeof(exo, seen) for exo in exos])
+
+
+def fill(exos):
+    """ Full history : HIST changes of every output """
+    for value in range(HIST):
+        for exo in exos:
+            exo.update(0, [value + 1] * 8)
+
+
+def run(exos, frames):
+    start = time.time()
+    for exo, frame in frames:
+        exo.update(0, frame)
+    return len(frames) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EXO state store')
+    parser.add_argument('-n', '--updates', type=int, default=200000,
+        help='Updates per measure (default 200000)')
+    args = parser.parse_args()
+
+    print('{0:8} {1:>12} {2:>12} {3:>12} {4:>10}'.format('state',
+        'same /s', 'change /s', 'read /s', 'memory B'))
+    for name, build in (('legacy', legacy_exos), ('store', store_exos)):
+        exos = build()
+        fill(exos)
+        size = memory(exos)
+        steady = [HIST] * 8
+        same = [(exos[i % 16], steady) for i in range(args.updates)]
+        same_rate = run(exos, same)
+        # Every frame toggles one output of its EXO.
+        changes = list()
+        for i in range(args.updates):
+            frame = list(steady)
+            frame[(i // 16) % 8] = 0 if (i // 128) % 2 == 0 else HIST
+            changes.append((exos[i % 16], frame))
+        change_rate = run(exos, changes)
+        start = time.time()
+        for i in range(args.updates):
+            exos[i % 16].get_output(1 + i % 8)
+        read_rate = args.updates / (time.time() - start)
+        print('{0:8} {1:12.0f} {2:12.0f} {3:12.0f} {4:10}'.format(name,
+            same_rate, change_rate, read_rate, size))
+
+
+if __name__ == '__main__':
+    main()
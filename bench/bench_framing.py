@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Micro-benchmark of the MinidoProtocol packet assembler.
+    A noisy bus stream (valid packets, garbage, bad checksums) is replayed
+    in fixed size reads through the bytearray assembler and through the
+    former list based loop, and both must deliver the same packets.
+
+    Usage : ./bench_framing.py [-s size_in_MB] [-c read_size] [--legacy]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'tools'))
+from protocol import MinidoProtocol, checksum
+import mulog
+
+
+class NullFactory(object):
+    """ Collect the packets instead of sending them to STOMP """
+    def __init__(self):
+        self.connections = list()
+        self.packets = 0
+        self.last = None
+
+    def recv_message(self, data):
+        self.packets += 1
+        self.last = data
+
+
+class QuietMinidoProtocol(MinidoProtocol):
+    """ Same assembler, without the per packet bookkeeping """
+    def newpacket(self, data):
+        self.factory.recv_message(data)
+
+
+class LegacyMinidoProtocol(QuietMinidoProtocol):
+    """ The list of one char strings assembler, kept for comparison """
+    def dataReceived(self, chardata):
+        try:
+            self.chardata.extend(chardata)
+        except AttributeError:
+            self.chardata = list(chardata)
+
+        while len(self.chardata) >= 6:
+            if ord(self.chardata[0]) != 0x23:
+                try:
+                    startidx = self.chardata.index(chr(0x23))
+                except(LookupError, ValueError):
+                    self.chardata = list()
+                    continue
+                if startidx != 0:
+                    self.chardata = self.chardata[startidx:]
+                    continue
+            else:
+                datalength = ord(self.chardata[3])
+                if len(self.chardata) >= datalength + 4:
+                    if checksum(
+                        [ord(x) for x in self.chardata[4:datalength + 3]]
+                        ) != ord(self.chardata[datalength + 3]):
+                        self.chardata = self.chardata[datalength + 4:]
+                        continue
+                    else:
+                        validpacket = self.chardata[0:datalength + 4]
+                        self.chardata = self.chardata[datalength + 4:]
+                    data = [ord(x) for x in validpacket]
+                    self.newpacket(bytes(bytearray(data)))
+                else:
+                    break
+
+
+def build_stream(size, seed=0x23):
+    """
+    Build a bus stream of about size bytes : mostly EXO_UPDATE and echo
+    packets, with some garbage between them and some bad checksums.
+    """
+    rnd = random.Random(seed)
+    stream = bytearray()
+    while len(stream) < size:
+        kind = rnd.random()
+        if kind < 0.05:
+            # Line noise
+            stream.extend(rnd.randint(0, 255)
+                for i in range(rnd.randint(1, 16)))
+            continue
+        if kind < 0.6:
+            data = [0x01] + [rnd.choice((0x00, 0xff)) for i in range(8)]
+            dst = 0x3B + rnd.randint(1, 16)
+        else:
+            data = [rnd.choice((0x05, 0x38, 0x39, 0x49))]
+            dst = 0x13 + rnd.randint(1, 16)
+        packet = [0x23, dst, 0x17, len(data) + 1] + data
+        chk = checksum(data)
+        if kind > 0.98:
+            chk ^= 0x5a
+        packet.append(chk)
+        stream.extend(packet)
+    return bytes(stream)
+
+
+def replay(protocol_class, stream, readsize):
+    factory = NullFactory()
+    proto = protocol_class(factory)
+    start = time.time()
+    for idx in range(0, len(stream), readsize):
+        proto.dataReceived(stream[idx:idx + readsize])
+    elapsed = time.time() - start
+    return elapsed, factory
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the MinidoProtocol packet assembler')
+    parser.add_argument('-s', '--size', type=float, default=4.0,
+        help='Size of the replayed stream in MB (default 4)')
+    parser.add_argument('-c', '--chunk', type=int, default=4096,
+        help='Size of each read delivered to dataReceived (default 4096)')
+    parser.add_argument('--legacy', action='store_true',
+        help='Also run the former list based assembler and compare')
+    args = parser.parse_args()
+    # The stream holds garbage on purpose, do not log every resync.
+    mulog.setup({'mu.protocol': 'ERROR'})
+
+    stream = build_stream(int(args.size * 1024 * 1024))
+    print('Stream : {0} bytes, reads of {1} bytes'.format(
+        len(stream), args.chunk))
+
+    elapsed, factory = replay(QuietMinidoProtocol, stream, args.chunk)
+    print('bytearray : {0:8.3f} s {1:8} packets {2:10.0f} packets/s'.format(
+        elapsed, factory.packets, factory.packets / elapsed))
+
+    if args.legacy:
+        old_elapsed, old_factory = replay(LegacyMinidoProtocol, stream,
+            args.chunk)
+        print('list      : {0:8.3f} s {1:8} packets {2:10.0f} packets/s'.format(
+            old_elapsed, old_factory.packets,
+            old_factory.packets / old_elapsed))
+        if (old_factory.packets != factory.packets or
+                old_factory.last != factory.last):
+            print('Error : both assemblers do not deliver the same packets')
+            sys.exit(1)
+        print('Speedup   : {0:.1f}x'.format(old_elapsed / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    History table of mu/db.py, without (legacy) and with the migrations
+    (indexes, WAL), on a synthetic history of 60 days over the 128 EXO
+    outputs, and one more expired day to remove. The size of the table
+    grows with the churn, the work of each measure does not :
+    - startup : legacy, Db() with the DELETE of the expired day.
+                indexed, Db(), the retention runs later by chunks.
+    - chunk   : longest chunk of the retention pass (in the DB writer
+                thread), the expired day is deleted by RETENTION_CHUNK.
+    - channel : time range holding the last ~100 changes of one output.
+    - window  : time range holding the last ~1000 changes.
+    - warm    : populate_exodict, the last HIST values of the 128 outputs
+                (legacy : replay of the whole EXO history).
+    The migration itself runs once, its time is also given.
+
+    Usage : ./bench_history.py [--sizes 60000,240000,960000] [--plans]
+    Requires twisted (imported by mu/db.py).
+"""
+
+from __future__ import print_function
+import argparse
+import datetime
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'mu'))
+import db
+import minidodevices
+
+DAYS = 60
+QUERIES = 50
+
+CHANNEL_QUERY = ('SELECT dtime, status FROM history WHERE type = ? '
+    'AND busid = ? AND channel = ? AND dtime > ? ORDER BY dtime')
+WINDOW_QUERY = ('SELECT dtime, type, busid, channel, status FROM history '
+    'WHERE dtime > ?')
+WARM_QUERY = ('SELECT dtime, status FROM history WHERE type = ? '
+    'AND busid = ? AND channel = ? ORDER BY dtime DESC LIMIT ?')
+
+
+def build(path, rows, now):
+    """ Legacy DB (no index, rollback journal) with rows of history """
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        dtime DATETIME,
+        type TEXT NOT NULL,
+        busid NUMERIC NOT NULL,
+        channel NUMERIC NOT NULL,
+        status TEXT NOT NULL
+        )''')
+    conn.execute('''CREATE TABLE log (
+        id INTEGER NOT NULL  DEFAULT NULL PRIMARY KEY AUTOINCREMENT,
+        logtime NONE NOT NULL  DEFAULT NULL,
+        logsource TEXT DEFAULT NULL,
+        logtext TEXT DEFAULT NULL
+        )''')
+    rng = random.Random(1)
+    step = (DAYS + 1) * 86400.0 / rows
+    start = now - datetime.timedelta(days=DAYS + 1)
+
+    def generate():
+        for i in range(rows):
+            dtime = start + datetime.timedelta(seconds=i * step)
+            yield (str(dtime), 'EXO', rng.randint(1, 16), rng.randint(1, 8),
+                rng.choice((0, 255)))
+    conn.executemany('INSERT INTO history (dtime, type, busid, channel, '
+        'status) VALUES (?, ?, ?, ?, ?)', generate())
+    conn.commit()
+    conn.close()
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def legacy_startup(path):
+    """ What Db() did before the migrations """
+    conn = sqlite3.connect(path)
+    conn.execute('DELETE FROM history WHERE dtime < ?',
+        [datetime.datetime.now() - datetime.timedelta(days=DAYS)])
+    conn.commit()
+    conn.close()
+
+
+def startup(path):
+    db.SQLITEDB = path
+    db.Db._instance = None
+    mydb = db.Db()
+    mydb.closedb()
+
+
+def retention(path, now):
+    """ Run a retention pass, returns the longest chunk """
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    longest = 0.0
+    for kind, days in sorted(db.RETENTION.items()):
+        expiry = now - datetime.timedelta(days=days)
+        deleted = db.RETENTION_CHUNK
+        while deleted == db.RETENTION_CHUNK:
+            start = time.time()
+            deleted = db.delete_expired(cur, kind, expiry, db.RETENTION_CHUNK)
+            conn.commit()
+            longest = max(longest, time.time() - start)
+    conn.close()
+    return longest
+
+
+def exodict():
+    return dict([(exoid, minidodevices.Exo(exoid, None))
+        for exoid in range(1, 17)])
+
+
+def legacy_populate(path):
+    """ What populate_exodict did before the warm start """
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    exos = exodict()
+    for row in conn.execute("SELECT dtime, busid, channel, status "
+            "FROM history WHERE type = 'EXO'"):
+        exos[int(row[1])].update_history(row[0], int(row[2]), int(row[3]))
+    conn.close()
+
+
+def populate(path):
+    db.SQLITEDB = path
+    db.Db._instance = None
+    mydb = db.Db()
+    mydb.populate_exodict(exodict())
+    mydb.closedb()
+
+
+def queries(path, rows, now):
+    """ Average time of the channel and window queries """
+    conn = sqlite3.connect(path)
+    rng = random.Random(2)
+    step = (DAYS + 1) * 86400.0 / rows
+    channel_start = str(now - datetime.timedelta(seconds=100 * 128 * step))
+    window_start = str(now - datetime.timedelta(seconds=1000 * step))
+    start = time.time()
+    for i in range(QUERIES):
+        conn.execute(CHANNEL_QUERY, ['EXO', rng.randint(1, 16),
+            rng.randint(1, 8), channel_start]).fetchall()
+    channel = (time.time() - start) / QUERIES
+    start = time.time()
+    for i in range(QUERIES):
+        conn.execute(WINDOW_QUERY, [window_start]).fetchall()
+    window = (time.time() - start) / QUERIES
+    conn.close()
+    return channel, window
+
+
+def plans(path, now):
+    conn = sqlite3.connect(path)
+    for name, query, args in (
+            ('channel', CHANNEL_QUERY, ['EXO', 1, 1, str(now)]),
+            ('warm', WARM_QUERY, ['EXO', 1, 1, minidodevices.HIST]),
+            ('window', WINDOW_QUERY, [str(now)]),
+            ('chunk', 'DELETE FROM history WHERE id IN (SELECT id FROM '
+                'history WHERE type = ? AND dtime < ? LIMIT ?)',
+                ['EXO', str(now), db.RETENTION_CHUNK])):
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + query, args):
+            print('{0:8} {1}'.format(name, row[-1]))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='History table with and without the migrations')
+    parser.add_argument('--sizes', default='60000,240000,960000',
+        help='Comma separated numbers of rows (default 60000,240000,960000)')
+    parser.add_argument('--plans', action='store_true',
+        help='Print the query plans with the migrations')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='mu-bench-history-')
+    now = datetime.datetime.now()
+    print('{0:>8} {1:7} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} '
+        '{7:>10}'.format('rows', 'schema', 'migrate s', 'startup ms',
+        'chunk ms', 'channel ms', 'window ms', 'warm ms'))
+    try:
+        for rows in [int(size) for size in args.sizes.split(',')]:
+            legacy = os.path.join(workdir, 'legacy.db')
+            migrated = os.path.join(workdir, 'migrated.db')
+            for path in (legacy, migrated):
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+            build(legacy, rows, now)
+            shutil.copy(legacy, migrated)
+
+            startup_time = timed(legacy_startup, legacy)
+            channel, window = queries(legacy, rows, now)
+            warm = timed(legacy_populate, legacy)
+            print('{0:8} {1:7} {2:>10} {3:10.1f} {4:>10} {5:10.3f} '
+                '{6:10.3f} {7:10.1f}'.format(rows, 'legacy', '-',
+                startup_time * 1000.0, '-', channel * 1000.0,
+                window * 1000.0, warm * 1000.0))
+
+            conn = sqlite3.connect(migrated)
+            migrate_time = timed(db.migrate, conn)
+            conn.close()
+            startup_time = timed(startup, migrated)
+            chunk = retention(migrated, now)
+            channel, window = queries(migrated, rows, now)
+            warm = timed(populate, migrated)
+            print('{0:8} {1:7} {2:10.2f} {3:10.1f} {4:10.1f} {5:10.3f} '
+                '{6:10.3f} {7:10.1f}'.format(rows, 'indexed', migrate_time,
+                startup_time * 1000.0, chunk * 1000.0, channel * 1000.0,
+                window * 1000.0, warm * 1000.0))
+        if args.plans:
+            plans(migrated, now)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
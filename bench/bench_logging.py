@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Time spent by the caller (the reactor thread) to log one record per
+    packet, for a sink taking --delay ms per write (slow journal) :
+    - print    : the former print of every packet.
+    - sync     : logging.StreamHandler on the slow sink.
+    - async    : mulog.AsyncHandler on the slow sink (records beyond the
+                 queue size are dropped and counted).
+    - disabled : the debug level is disabled, nothing is formatted.
+
+    Usage : ./bench_logging.py [-n packets] [--delay ms] [--queue size]
+"""
+
+from __future__ import print_function
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'tools'))
+import mulog
+from mulog import HexData
+
+
+class SlowSink(object):
+    """ File-like object blocking for delay seconds on every write """
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, data):
+        time.sleep(self.delay)
+        self.lines += data.count('\n')
+
+    def flush(self):
+        pass
+
+
+def run(name, packets, sink, queue_size):
+    log = logging.getLogger('mu.bench')
+    log.propagate = False
+    log.handlers = list()
+    handler = None
+    if name == 'sync':
+        handler = logging.StreamHandler(sink)
+    elif name == 'async':
+        target = logging.StreamHandler(sink)
+        handler = mulog.AsyncHandler(target, queue_size)
+    if handler is not None:
+        handler.setFormatter(logging.Formatter(mulog.FORMAT))
+        log.addHandler(handler)
+    log.setLevel(logging.INFO if name == 'disabled' else logging.DEBUG)
+
+    start = time.time()
+    for packet in packets:
+        if name == 'print':
+            print('Debug : sending packet : ' + ' '.join(
+                ['%0.2x' % c for c in packet]), file=sink)
+        else:
+            log.debug('Sending packet : %s', HexData(packet))
+    elapsed = time.time() - start
+    dropped = getattr(handler, 'dropped', 0)
+    if handler is not None:
+        handler.close()
+    return elapsed, dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Cost of per-packet logging on a slow sink')
+    parser.add_argument('-n', '--packets', type=int, default=2000,
+        help='Number of packets (default 2000)')
+    parser.add_argument('--delay', type=float, default=0.5,
+        help='Time taken by the sink for each write, in ms (default 0.5)')
+    parser.add_argument('--queue', type=int, default=mulog.QUEUE_SIZE,
+        help='AsyncHandler queue size (default %i)' % mulog.QUEUE_SIZE)
+    args = parser.parse_args()
+
+    packets = [[0x23, 0x3C, 0x17, 0x0A, 0x01] + [(i + j) % 2 * 255
+        for j in range(8)] + [i % 256] for i in range(args.packets)]
+    print('{0:8} {1:>10} {2:>12} {3:>8}'.format(
+        'mode', 'caller s', 'us/packet', 'dropped'))
+    for name in ('print', 'sync', 'async', 'disabled'):
+        elapsed, dropped = run(name, packets, SlowSink(args.delay / 1000.0),
+            args.queue)
+        print('{0:8} {1:10.3f} {2:12.1f} {3:8}'.format(name, elapsed,
+            elapsed * 1e6 / len(packets), dropped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Latency of the serial adapter (tools/minidoserial.py) against the
+    TCP/IP adapter path. The serial device is the slave side of a
+    pseudo-terminal pair, the master side plays the bus adapter. The TCP
+    path uses a loopback connection. Both sides run a MinidoProtocol.
+    - to MU  : packet written by the adapter until it is validated by MU.
+    - to bus : MinidoProtocol.send_data until the adapter validates it.
+               It includes the bus pacing, as MU has just received a packet.
+
+    Usage : ./bench_serial.py [-n samples]
+    Requires twisted and pyserial.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'tools'))
+from twisted.internet import reactor, defer, abstract, fdesc
+from twisted.internet.protocol import Factory, ClientFactory
+from protocol import MinidoProtocol, checksum
+from minidoserial import SerialClient
+import mulog
+
+
+class Endpoint(Factory):
+    """ One side of the link, fires a Deferred when a packet is validated """
+    def __init__(self):
+        self.connections = list()
+        self.waiting = None
+        self.connected = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        reactor.callLater(0, self.connected.callback, None)
+        return MinidoProtocol(self)
+
+    def expect(self):
+        self.start = time.time()
+        self.waiting = defer.Deferred()
+        return self.waiting
+
+    def recv_message(self, data):
+        if self.waiting is not None:
+            d, self.waiting = self.waiting, None
+            d.callback(time.time() - self.start)
+
+
+class ClientEndpoint(Endpoint, ClientFactory):
+    pass
+
+
+class PtyMaster(abstract.FileDescriptor):
+    """ Master side of the pseudo-terminal, as a transport """
+    connected = 1
+
+    def __init__(self, fd, protocol):
+        abstract.FileDescriptor.__init__(self, reactor)
+        self.fd = fd
+        fdesc.setNonBlocking(fd)
+        self.protocol = protocol
+        self.protocol.makeConnection(self)
+        self.startReading()
+
+    def fileno(self):
+        return self.fd
+
+    def getPeer(self):
+        return 'pty master'
+
+    def writeSomeData(self, data):
+        return fdesc.writeToFD(self.fd, data)
+
+    def doRead(self):
+        return fdesc.readFromFD(self.fd, self.protocol.dataReceived)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+@defer.inlineCallbacks
+def measure(adapter, mu, samples):
+    yield adapter.connected
+    yield mu.connected
+    results = dict(to_mu=list(), to_bus=list())
+    for i in range(samples):
+        data = [0x01] + [(i + j) % 2 * 255 for j in range(8)]
+        packet = [0x23, 0x3C, 0x14, len(data) + 1] + data + [checksum(data)]
+        d = mu.expect()
+        adapter.connections[0].transport.write(bytes(bytearray(packet)))
+        results['to_mu'].append((yield d))
+        d = adapter.expect()
+        mu.connections[0].send_data(list(packet), 'interactive')
+        results['to_bus'].append((yield d))
+        wait = defer.Deferred()
+        reactor.callLater(0.02, wait.callback, None)
+        yield wait
+    defer.returnValue(results)
+
+
+@defer.inlineCallbacks
+def run(samples):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    mulog.setup(stream=sys.stdout)
+    allresults = list()
+
+    adapter, mu = Endpoint(), ClientEndpoint()
+    port = reactor.listenTCP(0, adapter, interface='127.0.0.1')
+    connector = reactor.connectTCP('127.0.0.1', port.getHost().port, mu)
+    allresults.append(('tcp', (yield measure(adapter, mu, samples))))
+    connector.disconnect()
+    yield port.stopListening()
+
+    adapter, mu = Endpoint(), Endpoint()
+    master, slave = os.openpty()
+    PtyMaster(master, adapter.buildProtocol(None))
+    client = SerialClient(mu, os.ttyname(slave))
+    client.startService()
+    allresults.append(('serial', (yield measure(adapter, mu, samples))))
+    client.stopService()
+
+    print('{0:8} {1:8} {2:>8} {3:>8} {4:>8}'.format(
+        'path', 'direction', 'p50 ms', 'p95 ms', 'max ms'), file=stdout)
+    for name, results in allresults:
+        for direction in ('to_mu', 'to_bus'):
+            values = results[direction]
+            print('{0:8} {1:8} {2:8.3f} {3:8.3f} {4:8.3f}'.format(
+                name, direction, percentile(values, 50) * 1000.0,
+                percentile(values, 95) * 1000.0, max(values) * 1000.0),
+                file=stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Latency of the serial adapter against TCP/IP')
+    parser.add_argument('-n', '--samples', type=int, default=200,
+        help='Number of samples in each direction (default 200)')
+    args = parser.parse_args()
+
+    def done(result):
+        reactor.stop()
+        return result
+    reactor.callWhenRunning(lambda: run(args.samples).addBoth(done))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Benchmark of the STOMP packet encodings (see tools/stompcodec.py) :
+    body size, encode and decode cost per packet for each encoding.
+
+    Usage : ./bench_stompcodec.py [-n packets]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'tools'))
+import stompcodec
+
+# A typical EXO_UPDATE and an EXI echo request, with their checksum
+PACKETS = [
+    [0x23, 0x3C, 0x17, 0x0A, 0x01, 0xFF, 0x00, 0x00, 0xFF, 0x00, 0x00,
+        0x00, 0xFF, 0x01],
+    [0x23, 0x14, 0x17, 0x02, 0x39, 0x39],
+    ]
+
+
+def bench(encoding, packet, count):
+    body, headers = stompcodec.encode(packet, encoding)
+    msg = {'headers': dict(headers, destination='/mu/read'), 'body': body}
+    assert stompcodec.decode(msg) == packet
+
+    start = time.time()
+    for i in range(count):
+        stompcodec.encode(packet, encoding)
+    encode_time = time.time() - start
+
+    start = time.time()
+    for i in range(count):
+        stompcodec.decode(msg)
+    decode_time = time.time() - start
+    return len(body), encode_time / count, decode_time / count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the STOMP packet encodings')
+    parser.add_argument('-n', '--count', type=int, default=100000,
+        help='Number of packets encoded and decoded (default 100000)')
+    args = parser.parse_args()
+
+    print('{0:8} {1:>6} {2:>6} {3:>12} {4:>12}'.format(
+        'encoding', 'packet', 'body', 'encode (us)', 'decode (us)'))
+    for packet in PACKETS:
+        for encoding in stompcodec.ENCODINGS:
+            size, encode_time, decode_time = bench(encoding, packet,
+                args.count)
+            print('{0:8} {1:6} {2:6} {3:12.2f} {4:12.2f}'.format(
+                encoding, len(packet), size,
+                encode_time * 1e6, decode_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
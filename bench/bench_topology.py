@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Latency of the two deployment topologies, over loopback TCP :
+    - stomp  : adapter -> rs485bus2stomp.tac -> MorbidQ -> decoder
+    - direct : adapter -> decoder (MinidoDirectFactory, broker-less mode)
+    Measured in both directions :
+    - bus to decoder : an EXO_UPDATE written by the adapter stand-in until
+                       MinidoProtocolDecoder.recv_minido_packet is done.
+    - decoder to bus : Exo.set_output until the adapter stand-in receives
+                       the EXO_UPDATE.
+    Each topology runs in its own process (the decoder is a singleton),
+    with the MorbidQ broker in the same process as the bridge, so the
+    cost of the extra process hops themselves is not included.
+
+    Usage : ./bench_topology.py [-n samples] [--topology stomp|direct]
+    Requires twisted, morbid, stompservice and orbited.
+"""
+
+from __future__ import print_function
+import argparse
+import json as jsonlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASEDIR, '..', 'tools'))
+sys.path.insert(0, os.path.join(BASEDIR, '..', 'mu'))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def summary(latencies):
+    """ p50, p95, max in milliseconds """
+    return dict([(key, func(latencies) * 1000.0) for key, func in (
+        ('p50', lambda v: percentile(v, 50)),
+        ('p95', lambda v: percentile(v, 95)),
+        ('max', max))])
+
+
+def run_topology(topology, samples):
+    """ Run one topology in this process, return the latencies """
+    from twisted.internet import reactor, defer
+    from twisted.internet.protocol import Factory
+    from protocol import MinidoProtocol
+    import twisted_minido_morbidqonly as decoder
+
+    class Probe(object):
+        """ Fire a Deferred with the latency when the expected packet is seen """
+        def __init__(self):
+            self.match = None
+
+        def expect(self, match):
+            self.match = match
+            self.start = time.time()
+            self.d = defer.Deferred()
+            return self.d
+
+        def seen(self, packet):
+            if self.match is not None and self.match(packet):
+                self.match = None
+                self.d.callback(time.time() - self.start)
+
+    bus_probe = Probe()
+    decoder_probe = Probe()
+
+    recv_minido_packet = decoder.MinidoProtocolDecoder.recv_minido_packet
+    def timed_recv_minido_packet(self, message):
+        recv_minido_packet(self, message)
+        decoder_probe.seen(message)
+    decoder.MinidoProtocolDecoder.recv_minido_packet = timed_recv_minido_packet
+
+    class AdapterFactory(Factory):
+        """ Stand-in for the minidoadt bus adapter """
+        def buildProtocol(self, addr):
+            return MinidoProtocol(self)
+
+        def recv_message(self, data):
+            bus_probe.seen(data)
+
+    adapter = AdapterFactory()
+    adapter_port = reactor.listenTCP(0, adapter,
+        interface='127.0.0.1').getHost().port
+
+    if topology == 'stomp':
+        from morbid import get_stomp_factory
+        broker_port = reactor.listenTCP(0, get_stomp_factory(),
+            interface='127.0.0.1').getHost().port
+        bridge = dict(__file__='rs485bus2stomp.tac')
+        execfile(os.path.join(BASEDIR, '..', 'tools', 'rs485bus2stomp.tac'),
+            bridge)
+        reactor.connectTCP('127.0.0.1', adapter_port, bridge['minido_factory'])
+        reactor.connectTCP('127.0.0.1', broker_port, bridge['morbidq_factory'])
+        mu_factory = decoder.MorbidQClientFactory()
+        reactor.connectTCP('127.0.0.1', broker_port, mu_factory)
+    else:
+        mu_factory = decoder.MinidoDirectFactory()
+        reactor.connectTCP('127.0.0.1', adapter_port, mu_factory)
+
+    results = dict(inbound=list(), outbound=list())
+
+    def sleep(seconds):
+        d = defer.Deferred()
+        reactor.callLater(seconds, d.callback, None)
+        return d
+
+    @defer.inlineCallbacks
+    def measure():
+        # Let the connections settle and the EXI scan go through the bus.
+        yield sleep(2.5)
+        for i in range(samples):
+            # Bus to decoder : an EXI switches EXO 1 to a new state.
+            status = [(i + j) % 2 * 255 for j in range(8)]
+            data = [0x01] + status
+            packet = [0x23, 0x3C, 0x14, len(data) + 1] + data
+            packet.append(reduce(lambda a, b: a ^ b, data))
+            d = decoder_probe.expect(
+                lambda message, packet=packet: message[:-1] == packet[:-1])
+            for conn in adapter.connections:
+                conn.transport.write(bytes(bytearray(packet)))
+            results['inbound'].append((yield d))
+            yield sleep(0.02)
+
+            # Decoder to bus : switch output 1 of EXO 1 back.
+            value = 255 - status[0]
+            d = bus_probe.expect(lambda message, value=value:
+                message[1] == 0x3C and message[2] == 0x17 and
+                message[5] == value)
+            mu_factory.mpd.exodict[1].set_output(1, value)
+            results['outbound'].append((yield d))
+            yield sleep(0.03)
+        reactor.stop()
+
+    def failed(failure):
+        sys.__stderr__.write(failure.getTraceback())
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: measure().addErrback(failed))
+    reactor.run()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Latency of the stomp and direct topologies')
+    parser.add_argument('-n', '--samples', type=int, default=200,
+        help='Number of samples in each direction (default 200)')
+    parser.add_argument('--topology', choices=('stomp', 'direct'),
+        help='Run only this topology and print raw results in JSON')
+    args = parser.parse_args()
+
+    if args.topology:
+        # The sqlite DB is created in the current directory.
+        os.chdir(tempfile.mkdtemp(prefix='mu-bench-'))
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        # stompservice sets up its own logging when imported.
+        import stompservice
+        import mulog
+        mulog.setup(stream=sys.stdout)
+        results = run_topology(args.topology, args.samples)
+        stdout.write(jsonlib.dumps(results) + '\n')
+        return
+
+    print('{0:8} {1:16} {2:>8} {3:>8} {4:>8}'.format(
+        'topology', 'direction', 'p50 ms', 'p95 ms', 'max ms'))
+    for topology in ('stomp', 'direct'):
+        output = subprocess.check_output([sys.executable,
+            os.path.abspath(__file__), '--topology', topology,
+            '-n', str(args.samples)])
+        results = jsonlib.loads(output.strip().splitlines()[-1])
+        for direction, label in (('inbound', 'bus to decoder'),
+                ('outbound', 'decoder to bus')):
+            stats = summary(results[direction])
+            print('{0:8} {1:16} {2:8.2f} {3:8.2f} {4:8.2f}'.format(
+                topology, label, stats['p50'], stats['p95'], stats['max']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,280 @@
 import textwrap
 import sqlite3
 import datetime
+import logging
+import threading
+import time
+from itertools import groupby
+try:
+    from Queue import Queue, Full, Empty
+except ImportError:
+    from queue import Queue, Full, Empty
 # from exo import *
 from devices import *
-from twisted.internet import reactor, defer, error
+import usage
+import scenes
+from twisted.internet import reactor, defer
+from twisted.enterprise import adbapi
+from twisted.python import failure
 
 SQLITEDB = "minido_unleashed.db"
+# Connection settings, applied at every start. NORMAL is safe with WAL :
+# a power loss may only lose the last commits, never corrupt the DB.
+SYNCHRONOUS = 'NORMAL'
+# Page cache of the connection, in KiB
+CACHE_SIZE = 8192
+
+# Retention (days) of the history per type, and of the log table ('log').
+RETENTION = {'EXO': 60, 'EXI': 60, 'log': 60}
+# The expired rows are deleted by chunks of RETENTION_CHUNK rows, one
+# chunk every RETENTION_PAUSE seconds, so that the reactor never waits for
+# a long DELETE. The first pass starts RETENTION_DELAY seconds after the
+# start, the next ones every RETENTION_PERIOD seconds.
+RETENTION_CHUNK = 1000
+RETENTION_PAUSE = 0.2
+RETENTION_DELAY = 60
+RETENTION_PERIOD = 3600
+
+# Every write goes through the DbWriter thread. Writes waiting in its
+# queue : beyond, the reactor waits for the writer (backpressure).
+WRITE_QUEUE = 10000
+# Group commit : the writes are committed together when WRITE_BATCH of
+# them are waiting, or WRITE_DELAY seconds after the first one. A crash
+# loses at most WRITE_DELAY seconds of history.
+WRITE_BATCH = 500
+WRITE_DELAY = 0.5
+
+# Reads of the XML-RPC WebService run in a pool of READERS threads, each
+# with its own connection. History pages : HISTORY_PAGE rows by default,
+# at most HISTORY_MAX_PAGE.
+READERS = 2
+HISTORY_PAGE = 100
+HISTORY_MAX_PAGE = 1000
+# Keyset pagination : the next page starts after the (dtime, id) of the
+# last row of the previous one, so every page is an index range.
+HISTORY_SELECT = ("SELECT id, dtime, status FROM history WHERE type = 'EXO' "
+    "AND busid = ? AND channel = ? AND dtime >= ? AND dtime < ? "
+    "AND (dtime > ? OR (dtime = ? AND id > ?)) ORDER BY dtime, id LIMIT ?")
+
+HISTORY_INSERT = ('INSERT INTO history (dtime, type, busid, channel, status) '
+    'VALUES (?, ?, ?, ?, ?)')
+
+# Schema migrations : (version, description, statements). The version of
+# a DB is stored in its user_version, and each migration runs only once.
+# A statement can also be a function, called with the cursor.
+# Always append new migrations at the end, never modify the old ones.
+MIGRATIONS = [
+    (1, 'history indexes and WAL journal', [
+        # Covering index of the reads per channel (status included), in
+        # time order.
+        'CREATE INDEX IF NOT EXISTS history_channel_dtime ON history '
+        '(type, busid, channel, dtime, status)',
+        # Time range reads and deletes
+        'CREATE INDEX IF NOT EXISTS history_dtime ON history (dtime)',
+        'PRAGMA journal_mode = WAL',
+        'ANALYZE',
+        ]),
+    (2, 'retention indexes', [
+        # Expired rows of one type, whatever the retention of the others
+        'CREATE INDEX IF NOT EXISTS history_type_dtime ON history '
+        '(type, dtime)',
+        'CREATE INDEX IF NOT EXISTS log_logtime ON log (logtime)',
+        'ANALYZE',
+        ]),
+    (3, 'usage aggregates', [
+        'CREATE TABLE IF NOT EXISTS usage_hour (start DATETIME NOT NULL, '
+        'exo INTEGER NOT NULL, channel INTEGER NOT NULL, '
+        'ontime REAL NOT NULL, switches INTEGER NOT NULL, laststatus INTEGER, '
+        'PRIMARY KEY (exo, channel, start))',
+        'CREATE TABLE IF NOT EXISTS usage_day (start DATETIME NOT NULL, '
+        'exo INTEGER NOT NULL, channel INTEGER NOT NULL, '
+        'ontime REAL NOT NULL, switches INTEGER NOT NULL, laststatus INTEGER, '
+        'PRIMARY KEY (exo, channel, start))',
+        usage.rebuild,
+        ]),
+    (4, 'scenes', [
+        'CREATE TABLE IF NOT EXISTS scene (id INTEGER PRIMARY KEY '
+        'AUTOINCREMENT, name TEXT NOT NULL UNIQUE, description TEXT)',
+        'CREATE TABLE IF NOT EXISTS scene_target (id INTEGER PRIMARY KEY '
+        'AUTOINCREMENT, id_scene INTEGER NOT NULL REFERENCES scene (id), '
+        'id_device INTEGER NOT NULL REFERENCES device (id), '
+        'value TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS scene_target_scene ON scene_target '
+        '(id_scene)',
+        ]),
+    ]
+
+# Class of the devices built by populate_devdict, by devtype
+DEVICE_CLASSES = {
+    'Light': LightDevice,
+    'RCS': LightDevice,
+    'Store': StoreDevice,
+    }
+
+log = logging.getLogger('mu.db')
+
+def migrate(conn):
+    """
+    Upgrade the schema of an opened DB to the last version of MIGRATIONS.
+    Returns the version of the DB.
+    """
+    cur = conn.cursor()
+    version = cur.execute('PRAGMA user_version').fetchone()[0]
+    for target, description, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        log.info('Upgrading the DB to version %i : %s', target, description)
+        conn.commit()
+        for statement in statements:
+            if callable(statement):
+                statement(cur)
+            else:
+                cur.execute(statement)
+        # PRAGMA does not accept parameters, target is an int.
+        cur.execute('PRAGMA user_version = %i' % target)
+        conn.commit()
+        version = target
+    cur.close()
+    return version
+
+def delete_expired(cur, kind, expiry, limit):
+    """
+    Delete at most limit rows of the history of type kind (or of the
+    log table if kind is 'log') older than expiry. Returns the number of
+    deleted rows.
+    """
+    if kind == 'log':
+        cur.execute("DELETE FROM log WHERE id IN \
+            (SELECT id FROM log WHERE logtime < ? LIMIT ?)", [expiry, limit])
+    else:
+        cur.execute("DELETE FROM history WHERE id IN \
+            (SELECT id FROM history WHERE type = ? AND dtime < ? \
+            LIMIT ?)", [kind, expiry, limit])
+    return cur.rowcount
+
+class DbWriter(object):
+    """
+    Thread doing every write of the DB, on its own connection (WAL lets
+    the reactor read meanwhile). The consecutive writes of the same
+    statement are run by a single executemany, and committed together.
+    """
+    def __init__(self, filename, queue_size=WRITE_QUEUE, batch=WRITE_BATCH,
+            delay=WRITE_DELAY):
+        self.filename = filename
+        self.queue = Queue(queue_size)
+        self.batch = batch
+        self.delay = delay
+        # Backpressure metrics, see stats()
+        self.queued = 0
+        self.written = 0
+        self.commits = 0
+        self.largest = 0
+        self.full = 0
+        self.blocked = 0.0
+        self.reported = 0
+        self.thread = threading.Thread(target=self.writer, name='mu.db')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            # The writer is late : wait for it rather than losing history.
+            start = time.time()
+            self.queue.put(item)
+            self.full += 1
+            self.blocked += time.time() - start
+        self.queued += 1
+
+    def execute(self, statement, params):
+        """ Queue an INSERT, UPDATE or DELETE """
+        self.put((statement, params, None))
+
+    def call(self, func, *args):
+        """
+        Run func(cursor, *args) in the writer thread. Returns a Deferred
+        fired in the reactor with its result, once committed.
+        """
+        d = defer.Deferred()
+        self.put((func, args, d))
+        return d
+
+    def stats(self):
+        """
+        queued, written : writes queued and committed since the start
+        depth : writes waiting now
+        commits, largest : number of commits, largest commit (writes)
+        full, blocked : times the queue was full, seconds the reactor
+        waited for the writer
+        """
+        return dict(queued=self.queued, written=self.written,
+            depth=self.queue.qsize(), commits=self.commits,
+            largest=self.largest, full=self.full, blocked=self.blocked)
+
+    def next_batch(self):
+        """ Wait for the writes of the next commit """
+        batch = [self.queue.get()]
+        deadline = time.time() + self.delay
+        while len(batch) < self.batch and batch[-1] is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0.0:
+                break
+            try:
+                batch.append(self.queue.get(True, timeout))
+            except Empty:
+                break
+        return batch
+
+    def writer(self):
+        conn = sqlite3.connect(self.filename)
+        conn.execute('PRAGMA synchronous = %s' % SYNCHRONOUS)
+        cur = conn.cursor()
+        running = True
+        while running:
+            batch = self.next_batch()
+            if batch[-1] is None:
+                # closed
+                batch.pop()
+                running = False
+            results = list()
+            for statement, group in groupby(batch, lambda item: item[0]):
+                if not callable(statement):
+                    try:
+                        cur.executemany(statement,
+                            [params for _, params, _ in group])
+                    except sqlite3.Error:
+                        log.exception('DB write failed : %s', statement)
+                    continue
+                for func, args, d in group:
+                    try:
+                        results.append((d, func(cur, *args)))
+                    except Exception:
+                        results.append((d, failure.Failure()))
+            if batch:
+                conn.commit()
+                self.written += len(batch)
+                self.commits += 1
+                self.largest = max(self.largest, len(batch))
+            for d, result in results:
+                if isinstance(result, failure.Failure):
+                    reactor.callFromThread(d.errback, result)
+                else:
+                    reactor.callFromThread(d.callback, result)
+            if self.full != self.reported and self.queue.empty():
+                full = self.full
+                log.warning('DB writer late : the queue was full %i times '
+                    '(%i since startup, %.3f s waited)',
+                    full - self.reported, full, self.blocked)
+                self.reported = full
+        cur.close()
+        conn.close()
+
+    def close(self):
+        """ Commit what is still queued, and stop the thread """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
 
 class Db(object):
     """ Every access to DB from here """
@@ -35,10 +304,12 @@ class Db(object):
                 detect_types=sqlite3.PARSE_DECLTYPES|\
                 sqlite3.PARSE_COLNAMES, check_same_thread = False)
         except:
-            print("I am unable to connect to the SQLITE database ( " + str(SQLITEDB)
-                + ") , exiting.")
+            log.critical('I am unable to connect to the SQLITE database '
+                '( %s ) , exiting.', SQLITEDB)
             raise
         self.cur = self.conn.cursor()
+        self.cur.execute('PRAGMA synchronous = %s' % SYNCHRONOUS)
+        self.cur.execute('PRAGMA cache_size = %i' % -CACHE_SIZE)
         self.cur.execute(textwrap.dedent('''
         CREATE TABLE IF NOT EXISTS output (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -165,107 +436,252 @@ class Db(object):
         );
         '''))
 
-        self.clean_history()
+        migrate(self.conn)
+        self.writer = DbWriter(SQLITEDB)
+        self.usage = usage.Usage(self.conn, self.writer)
+        self.readpool = adbapi.ConnectionPool('sqlite3', SQLITEDB,
+            check_same_thread=False, cp_min=1, cp_max=READERS)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.closedb)
+        self.retention_call = reactor.callLater(RETENTION_DELAY,
+            self.clean_history)
         # Obsolete ?
         # self.mdev = dict()
 
     def history(self, now, type_, exoid, output, status):
         """ history( now, self.exoid, self.status[i] )"""
-        self.cur.execute("INSERT INTO history \
-            ( dtime, type, busid, channel, status ) \
-            VALUES ( ?, ?, ?, ?, ?)", [now, type_, exoid, output, status])
-        self.schedule_commit()
+        self.writer.execute(HISTORY_INSERT, [now, type_, exoid, output,
+            status])
+        if type_ == 'EXO':
+            self.usage.record(now, exoid, output, status)
 
 
-    def get_device_details(self):
+    def load_registry(self):
         """
-        Retrieve devices from the DB (only)
-        Quite similar to populate_devdict.
-        We could probably get rid of it, using the data
-        directly in the devices.
+        Read the devices and their outputs in a single join, and keep
+        them in self.registry until invalidate_registry() :
+            {'devices': {devid: {'devtype':, 'name':, 'details': {...},
+                'channels': {cmdtype: (exo, channel)}}},
+             'details': what get_device_details returns}
         """
         self.cur.execute(textwrap.dedent('''
-        SELECT output.id, output2device.id, device.id,exo,channel,type,
-        cmdtype, devtype, name, floor, room 
-        FROM output2device 
-        LEFT JOIN device ON id_device=device.id 
-        LEFT JOIN output ON id_output=output.id 
-        ORDER BY floor,room;
+        SELECT device.id, devtype, name, floor, room, posx, posy,
+        description, output.id, output2device.id, cmdtype, exo, channel,
+        type
+        FROM device
+        LEFT JOIN output2device ON id_device = device.id
+        LEFT JOIN output ON id_output = output.id
+        ORDER BY floor, room, device.id;
         '''))
-        result = dict()
+        devices = dict()
+        details = dict()
         for row in self.cur:
-            result[row[8]]= row
-        return(result)
+            devid = str(row[0])
+            if devid not in devices:
+                devices[devid] = dict(
+                    devtype = row[1],
+                    name = row[2],
+                    details = dict(
+                        name = row[2],
+                        floor = str(row[3]),
+                        room = str(row[4]),
+                        posx = row[5],
+                        posy = row[6],
+                        description = row[7]
+                    ),
+                    channels = dict()
+                )
+            if row[9] is None:
+                # No output for this device
+                continue
+            devices[devid]['channels'][str(row[10])] = (row[11], row[12])
+            details[row[2]] = (row[8], row[9], row[0], row[11], row[12],
+                row[13], row[10], row[1], row[2], row[3], row[4])
+        self.registry = dict(devices = devices, details = details)
+        log.info('Device registry loaded : %i devices', len(devices))
+        return self.registry
+
+    def get_history(self, exo, channel, start='', end='', limit=HISTORY_PAGE,
+            cursor=''):
+        """
+        A page of the history of an EXO output between start and end
+        (history.dtime strings, '' : no limit), read in the thread pool.
+        cursor is '' for the first page, then the cursor returned with
+        the previous page. Returns a Deferred fired with
+        {'rows': [[dtime, status], ...], 'cursor': next cursor, '' after
+        the last page}.
+        """
+        limit = max(1, min(int(limit), HISTORY_MAX_PAGE))
+        if cursor:
+            after, lastid = cursor.rsplit(',', 1)
+            lastid = int(lastid)
+        else:
+            after, lastid = '', 0
+        # dtime is never empty, '~' is after any date.
+        d = self.readpool.runQuery(HISTORY_SELECT, (exo, channel, start,
+            end or '~', after, after, lastid, limit))
+
+        def page(rows):
+            result = dict(rows=[[row[1], int(row[2])] for row in rows],
+                cursor='')
+            if len(rows) == limit:
+                result['cursor'] = '%s,%i' % (rows[-1][1], rows[-1][0])
+            return result
+        return d.addCallback(page)
+
+    def get_registry(self):
+        """ The device registry, loaded at the first call """
+        if getattr(self, 'registry', None) is None:
+            self.load_registry()
+        return self.registry
+
+    def invalidate_registry(self):
+        """
+        To be called after any change of the device, output and
+        output2device tables : the registry is read again at the next use.
+        """
+        self.registry = None
+        self.scene_frames = dict()
+
+    def get_device_details(self):
+        """
+        Devices from the DB (only), by name :
+        (output.id, output2device.id, device.id, exo, channel, type,
+        cmdtype, devtype, name, floor, room)
+        Served from the registry.
+        """
+        return(self.get_registry()['details'])
+
+    def get_scenes(self):
+        """
+        The scenes, read at the first call :
+        {name: {'description':, 'targets': [(devid, value)]}}
+        """
+        if getattr(self, 'scenes', None) is None:
+            self.scenes = dict()
+            self.scene_frames = dict()
+            self.cur.execute('SELECT name, description, id_device, value '
+                'FROM scene LEFT JOIN scene_target ON id_scene = scene.id '
+                'ORDER BY name, scene_target.id')
+            for name, description, devid, value in self.cur.fetchall():
+                scene = self.scenes.setdefault(name, dict(
+                    description=description or '', targets=list()))
+                if devid is not None:
+                    scene['targets'].append((str(devid), value))
+        return self.scenes
+
+    def get_scene_frames(self, name):
+        """
+        Outputs to set per EXO for a scene, (frames, stops) of
+        scenes.compile_scene, compiled once until the scenes or the
+        registry change. KeyError for an unknown scene.
+        """
+        if name not in self.get_scenes():
+            raise KeyError(name)
+        if name not in self.scene_frames:
+            self.scene_frames[name] = scenes.compile_scene(
+                self.scenes[name]['targets'],
+                self.get_registry()['devices'])
+        return self.scene_frames[name]
+
+    def save_scene(self, name, targets, description=''):
+        """
+        Create or replace a scene. The targets [(devid, value)] are checked
+        against the registry first (ValueError). Returns a Deferred fired
+        with the number of targets once written.
+        """
+        scenes.compile_scene(targets, self.get_registry()['devices'])
+        d = self.writer.call(scenes.store_scene, name, description, targets)
+        return d.addBoth(self.scenes_changed)
+
+    def delete_scene(self, name):
+        """ Returns a Deferred fired with 1 once deleted, 0 if unknown """
+        d = self.writer.call(scenes.remove_scene, name)
+        return d.addBoth(self.scenes_changed)
+
+    def scenes_changed(self, result):
+        """ The scenes are read again at the next use """
+        self.scenes = None
+        return result
+
+    def load_rules(self):
+        """
+        Triggers and their actions, for the RuleEngine (see rules.py) :
+        [{'id':, 'name':, 'on_status':, 'from_time':, 'to_time':,
+        'weekdays':, 'src_type':, 'src_busid':, 'src_channel':,
+        'actions': [(function, parameter1, parameter2, parameter3)]}]
+        The actions of a trigger are those of its program, or of its id
+        when it has none.
+        """
+        self.cur.execute(textwrap.dedent('''
+        SELECT "trigger".id, name, on_status, from_time, to_time, weekdays,
+        src_type, src_busid, src_channel, function, parameter1, parameter2,
+        parameter3
+        FROM "trigger"
+        LEFT JOIN actions
+        ON actions.id_program = COALESCE("trigger".id_program, "trigger".id)
+        ORDER BY "trigger".id, actions.rowid;
+        '''))
+        triggers = list()
+        for row in self.cur.fetchall():
+            if not triggers or triggers[-1]['id'] != row[0]:
+                triggers.append(dict(id=row[0], name=row[1],
+                    on_status=row[2], from_time=row[3], to_time=row[4],
+                    weekdays=row[5], src_type=row[6], src_busid=row[7],
+                    src_channel=row[8], actions=list()))
+            if row[9] is not None:
+                triggers[-1]['actions'].append(tuple(row[9:13]))
+        return triggers
 
     def populate_exodict(self, exodict):
-        """ Retrieve/populate exodict object by replaying
-        the history """
-        self.cur.execute("SELECT dtime, busid, channel, status \
-            FROM history WHERE type = 'EXO'")
-        for row in self.cur:
-            exoid = int(row[1])
-            output = int(row[2])
-            status = int(row[3])
-            if row[1] in exodict:
-                exodict[exoid].update_history(row[0], output, status)
+        """
+        Retrieve/populate exodict object from the history : only the
+        last values kept by each output (the hist of its ExoStore) are
+        read, newest first from the history_channel_dtime index, so the
+        time does not depend on the size of the history.
+        """
+        for exoid, exo in exodict.items():
+            for idx in range(8):
+                self.cur.execute("SELECT dtime, status FROM history \
+                    WHERE type = 'EXO' AND busid = ? AND channel = ? \
+                    ORDER BY dtime DESC LIMIT ?",
+                    [exoid, idx + 1, exo.store.hist])
+                rows = self.cur.fetchall()
+                for row in reversed(rows):
+                    exo.update_history(row[0], idx + 1, int(row[1]))
+                if rows:
+                    self.usage.restore(exoid, idx + 1, rows[0][0],
+                        int(rows[0][1]))
 
-        print(datetime.datetime.now(), 'self.exodict restored')
+        log.info('self.exodict restored')
         return(exodict)
 
     def populate_devdict(self, exodict):
-        """ Retrieve known devices from DB """
-        print(('{0!s:.23} : Initialisation : ' +
-            'Importing known devices...').format(
-            datetime.datetime.now()))
-        self.cur.execute("SELECT id, devtype, name, floor, room, \
-            posx, posy, description FROM device")
+        """ Build the known devices from the registry """
+        log.info('Initialisation : Importing known devices...')
         devdict = dict()
         # Sample devdict structure :
-        # ToDo : Update the following description
-        # devdict = {'CentreBureau': GenericDevice(
-        #   {'power': {'exo':3, 'channel':1}}, type_ = 'Light', ...), ... }
-        # print('exodict : ', self.exodict)
-        cur2 = self.conn.cursor()
-        for row in self.cur:
-            devid = str(row[0])
-            devtype = row[1]
-            name = row[2]
-            devdetails[devid] = dict(
-                name = row[2],
-                floor = str(row[3]),
-                room = str(row[4]),
-                posx = row[5],
-                posy = row[6],
-                description = row[7]
-            )
-            # Fetch the exo/channels for the device.
+        # devdict = {'12': LightDevice(
+        #   {'power': {'exo': exodict[3], 'channel': 1}}, name), ... }
+        for devid, device in self.get_registry()['devices'].items():
+            devtype = device['devtype']
             channels = dict()
-            print('devid : ', row[0], ' devtype : ', row[1], ' name ', row[2])
-            cur2.execute(
-                "SELECT cmdtype, exo, channel FROM output2device \
-                LEFT JOIN output ON id_output = output.id WHERE \
-                id_device = '{0}'".format(devid))
-            for row2 in cur2:
-                print(row2)
+            log.debug('devid : %s devtype : %s name %s', devid, devtype,
+                device['name'])
+            for cmdtype, (exo, channel) in device['channels'].items():
                 try:
-                    channels[ str(row2[0]) ] = {
-                        'exo': exodict[int(row2[1])],
-                        'channel': int(row2[2]) 
+                    channels[cmdtype] = {
+                        'exo': exodict[int(exo)],
+                        'channel': int(channel)
                         }
                 except(KeyError):
-                    print('Probably major problem in the DB as all exos are in exodict already')
-                    print('Exo ' + str(row2[1]) + ' does not exists in exodict')
-            # End fetch the exo/channels for the device.
-            if devtype == 'Light':
-                devdict[ devid ] = LightDevice( channels, name, devdetails)
-            elif devtype == 'RCS':
-                devdict[ devid ] = LightDevice( channels, name, devdetails)
-            elif devtype == 'Store':
-                devdict[ devid ] = StoreDevice( channels, name, devdetails)
-                print('Debug', devdict[ devid ] , "StoreDevice : ", channels)
-        print(('{0!s:.23} : Initialisation : ' +
-            'Known devices imported.').format(
-            datetime.datetime.now()))
+                    log.error('Probably major problem in the DB as all exos '
+                        'are in exodict already : Exo %s does not exists in '
+                        'exodict', exo)
+            if devtype in DEVICE_CLASSES:
+                devdict[devid] = DEVICE_CLASSES[devtype](channels,
+                    device['name'])
+                log.debug('%s', devdict[devid])
+        log.info('Initialisation : Known devices imported.')
         return( devdict )
 
     def get_dev_details(self, filter_=None, sort=None):
@@ -275,7 +691,7 @@ class Db(object):
         self.cur.execute("SELECT id, devtype, name, floor, room, \
             posx, posy, description FROM device")
         cur = self.conn.cursor()
-        print('exodict : ', self.exodict)
+        log.debug('exodict : %s', self.exodict)
         for row in self.cur:
             devid = str(row[0])
             devdetails[devid] = dict(
@@ -287,30 +703,60 @@ class Db(object):
                 description = row[7]
             )
     def clean_history(self):
-        """Used at startup to clean history in the DB (last 60 days)"""
+        """
+        Start a pass of retention : the history (and log) older than
+        RETENTION is deleted by clean_chunk, one chunk at a time.
+        """
         now = datetime.datetime.now()
-        td = datetime.timedelta( days=-60 )
-        print("Cleaning history")
-        self.cur.execute("DELETE FROM history WHERE dtime < ?", [now + td,])
-        self.schedule_commit()
+        log.info('Cleaning history')
+        self.retention_jobs = [(kind, now - datetime.timedelta(days=days))
+            for kind, days in sorted(RETENTION.items())]
+        self.retention_deleted = 0
+        self.clean_chunk()
 
-    def schedule_commit(self):
-        try:
-            self.delayed_commit.reset(5)
-        except (error.AlreadyCalled, AttributeError):
-            # Initialize the Deferred used for the Deferred Commit
-            self.cdf = defer.Deferred()
-            self.delayed_commit = reactor.callLater(5, self.cdf.callback, None)
-            self.cdf.addCallback(self.commit)
-
-    def commit(self, x):
-        """ Commit (Called back after 5 seconds of inactivity on the bus.) """
-        print('Commit into DB')
-        self.conn.commit()
+    def clean_chunk(self):
+        """
+        Have the writer delete at most RETENTION_CHUNK expired rows of
+        the current type (each chunk is committed on its own).
+        """
+        self.retention_call = None
+        kind, expiry = self.retention_jobs[0]
+        d = self.writer.call(delete_expired, kind, expiry, RETENTION_CHUNK)
+        d.addCallbacks(self.chunk_deleted, self.chunk_failed)
+
+    def chunk_deleted(self, deleted):
+        """ Schedule the next chunk, or the next pass when all are done """
+        if self.conn is None:
+            return
+        self.retention_deleted += deleted
+        if deleted < RETENTION_CHUNK:
+            self.retention_jobs.pop(0)
+        if self.retention_jobs:
+            self.retention_call = reactor.callLater(RETENTION_PAUSE,
+                self.clean_chunk)
+        else:
+            log.info('History cleaned : %i rows deleted',
+                self.retention_deleted)
+            self.retention_call = reactor.callLater(RETENTION_PERIOD,
+                self.clean_history)
+
+    def chunk_failed(self, reason):
+        log.error('Cleaning history failed : %s', reason.getErrorMessage())
+        if self.conn is not None:
+            self.retention_call = reactor.callLater(RETENTION_PERIOD,
+                self.clean_history)
 
     def closedb(self):
-        """ Cleanly close the DB """
-        self.conn.commit()
+        """ Cleanly close the DB, once the queued writes are committed """
+        if self.conn is None:
+            return
+        if self.retention_call is not None and self.retention_call.active():
+            self.retention_call.cancel()
+        self.usage.flush()
+        self.writer.close()
+        self.readpool.close()
+        log.info('DB closed : %(written)i writes in %(commits)i commits',
+            self.writer.stats())
         self.cur.close()
         self.conn.close()
-
+        self.conn = None
@@ -1,5 +1,16 @@
-from threading import Timer
+import logging
+from twisted.internet import reactor
+
+# A store motor is stopped after STORE_RUN seconds, and waits
+# STORE_REVERSE seconds before it turns the other way.
+STORE_RUN = 30
+STORE_REVERSE = 0.3
+
+log = logging.getLogger('mu.devices')
+
 class GenericDevice(object):
+    __slots__ = ('type_', 'name', 'channels')
+
     def __init__(self,channels, name):
         self.type_ = 'Generic'
         self.name = name
@@ -10,6 +21,8 @@ class GenericDevice(object):
 
 class DefaultDevice(GenericDevice):
     """ Light states & methods """
+    __slots__ = ()
+
     def __init__(self, channels, name):
 
         self.channels = channels
@@ -20,14 +33,14 @@ class DefaultDevice(GenericDevice):
         """ Set device status """
         exo = self.channels['power']['exo']
         channel = self.channels['power']['channel']
-        print("exo.set_output(channel, 255)")
+        log.debug('%s : exo.set_output(%i, 255)', self.name, channel)
         exo.set_output(channel, 255)
 
     def off(self):
         """ Set device status """
         exo = self.channels['power']['exo']
         channel = self.channels['power']['channel']
-        print("exo.set_output(channel, 0)")
+        log.debug('%s : exo.set_output(%i, 0)', self.name, channel)
         exo.set_output(channel, 0)
 
     def toggle(self):
@@ -44,8 +57,14 @@ class DefaultDevice(GenericDevice):
         exo = self.channels['power']['exo']
         return(exo.get_output(self.channels['power']['channel']))
 
+    def get_value(self):
+        """ Get device status """
+        return(self.status())
+
 class LightDevice(GenericDevice):
     """ Light states & methods """
+    __slots__ = ()
+
     def __init__(self, channels, name):
 
         self.channels = channels
@@ -56,14 +75,14 @@ class LightDevice(GenericDevice):
         """ Set device status """
         exo = self.channels['power']['exo']
         channel = self.channels['power']['channel']
-        print("exo.set_output(channel, 255)")
+        log.debug('%s : exo.set_output(%i, 255)', self.name, channel)
         exo.set_output(channel, 255)
 
     def off(self):
         """ Set device status """
         exo = self.channels['power']['exo']
         channel = self.channels['power']['channel']
-        print("exo.set_output(channel, 0)")
+        log.debug('%s : exo.set_output(%i, 0)', self.name, channel)
         exo.set_output(channel, 0)
 
     def toggle(self):
@@ -80,8 +99,19 @@ class LightDevice(GenericDevice):
         exo = self.channels['power']['exo']
         return(exo.get_output(self.channels['power']['channel']))
 
+    def get_value(self):
+        """ Get device status """
+        return(self.status())
+
 class StoreDevice(GenericDevice):
-    """ Store """
+    """
+    Store
+    The timers run in the reactor (set_output is not thread safe) :
+    tmr is the DelayedCall of the next move or stop, or None.
+    """
+    __slots__ = ('exoup', 'channelup', 'exodown', 'channeldown', 'tmr',
+        'openratio')
+
     def __init__(self, channels, name):
         GenericDevice.__init__(self, channels, name)
         self.name = name
@@ -90,39 +120,49 @@ class StoreDevice(GenericDevice):
         self.channelup = channels['up']['channel']
         self.exodown = channels['down']['exo']
         self.channeldown = channels['down']['channel']
-        self.tmr = Timer( 1, self.exoup.set_output,
-                [self.channelup, 0])
+        self.tmr = None
         self.openratio = None
 
+    def cancel(self):
+        """ Cancel the pending move or stop """
+        if self.tmr is not None and self.tmr.active():
+            self.tmr.cancel()
+        self.tmr = None
+
+    def move(self, exo, channel):
+        """ Start the motor, and stop it after STORE_RUN seconds """
+        exo.set_output(channel, 255)
+        self.stop_later(exo, channel)
+
+    def stop_later(self, exo, channel):
+        """ Stop the motor after STORE_RUN seconds (also used by scenes) """
+        self.tmr = reactor.callLater(STORE_RUN, exo.set_output, channel, 0)
+
     def set_value(self, cmd):
         """ Set device status """
         if ( cmd == 'up' and 
                 self.exoup.get_output(self.channelup) == 0):
-            if self.tmr.is_alive():
-                self.tmr.cancel()
+            self.cancel()
             if self.exodown.get_output(self.channeldown) != 0 :
+                # Let the motor stop before it turns the other way
                 self.exodown.set_output(self.channeldown, 0)
-                time.sleep(0.3)
-            self.exoup.set_output(self.channelup, 255)
-            self.tmr = Timer(30, 
-                self.exoup.set_output, [self.channelup, 0])
-            self.tmr.start()
+                self.tmr = reactor.callLater(STORE_REVERSE, self.move,
+                    self.exoup, self.channelup)
+            else:
+                self.move(self.exoup, self.channelup)
 
         if ( cmd == 'down' and 
                 self.exodown.get_output(self.channeldown) == 0):
-            if self.tmr.is_alive():
-                self.tmr.cancel()
+            self.cancel()
             if ( self.exoup.get_output(self.channelup) != 0 ):
                 self.exoup.set_output(self.channelup, 0)
-                time.sleep(0.3)
-            self.exodown.set_output(self.channeldown, 255)
-            self.tmr = Timer(30,
-                self.exodown.set_output, [self.channeldown, 0])
-            self.tmr.start()
+                self.tmr = reactor.callLater(STORE_REVERSE, self.move,
+                    self.exodown, self.channeldown)
+            else:
+                self.move(self.exodown, self.channeldown)
 
         if ( cmd == 'stop' ):
-            if ( self.tmr.is_alive() ):
-                self.tmr.cancel()
+            self.cancel()
             if ( self.exoup.get_output(self.channelup) !=0 ):
                 self.exoup.set_output(self.channelup, 0)
             elif ( self.exodown.get_output(self.channeldown) != 0 ):
@@ -139,4 +179,4 @@ class StoreDevice(GenericDevice):
 
 class VMCDevice(GenericDevice):
     """ Ventilation Mecanique Constolee """
-    pass
+    __slots__ = ()
@@ -0,0 +1,119 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Change feed of the installation : the last EVENTS changes of the EXO
+    outputs, numbered by a sequence, in a ring. A client reads the events
+    after the last sequence it got (EventLog.wait, behind the XML-RPC
+    get_nextevent). When there is none yet, it gets a Deferred fired by
+    the next change or by its timeout : a waiting client is only a
+    Deferred and a DelayedCall, it takes no thread.
+    An event is [seq, dtime, type, busid, channel, value, old].
+"""
+
+import datetime
+import logging
+from collections import deque
+from twisted.internet import reactor, defer
+
+# Events kept for the clients late to read them
+EVENTS = 1000
+# Wait of get_nextevent without event (seconds), default and maximum
+LONGPOLL_TIMEOUT = 30
+LONGPOLL_MAX = 300
+# Value of an output not known yet (see minidodevices.UNKNOWN)
+UNKNOWN = -1
+
+log = logging.getLogger('mu.events')
+
+
+class EventLog(object):
+    """ Ring of the last events, and the clients waiting for the next """
+    def __init__(self, size=EVENTS):
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        # Deferred : (since, DelayedCall of its timeout)
+        self.waiters = dict()
+        self.wakecall = None
+
+    def append(self, kind, busid, channel, value, old):
+        """ Record an event, the waiting clients get it at the next turn """
+        self.seq += 1
+        self.events.append([self.seq, str(datetime.datetime.now()), kind,
+            busid, channel, value, UNKNOWN if old is None else old])
+        # The changes of one packet are sent together.
+        if self.waiters and self.wakecall is None:
+            self.wakecall = reactor.callLater(0, self.wake)
+
+    def since(self, seq):
+        """
+        {'events': [events after seq], 'seq': last sequence, 'lost': True
+        if events after seq are no longer in the ring}. A seq from before
+        a restart (greater than the last one) gets the whole ring.
+        """
+        if seq > self.seq:
+            seq = 0
+        first = self.events[0][0] if self.events else self.seq + 1
+        lost = seq + 1 < first
+        # The events are numbered without gap : index of seq + 1
+        start = max(seq + 1 - first, 0)
+        events = [self.events[i] for i in range(start, len(self.events))]
+        return dict(events=events, seq=self.seq, lost=lost)
+
+    def wait(self, seq=-1, timeout=LONGPOLL_TIMEOUT):
+        """
+        Deferred of since(seq), fired at once if there are events after
+        seq, else by the next event or after timeout seconds (no event).
+        seq -1 is the last sequence : wait for the next event.
+        """
+        if seq < 0:
+            seq = self.seq
+        if seq != self.seq:
+            return defer.succeed(self.since(seq))
+        d = defer.Deferred()
+        self.waiters[d] = (seq, reactor.callLater(
+            min(max(timeout, 0), LONGPOLL_MAX), self.expire, d))
+        return d
+
+    def wake(self):
+        """ Fire the Deferreds of the waiting clients with the new events """
+        self.wakecall = None
+        waiters, self.waiters = self.waiters, dict()
+        # Most clients wait from the same sequence
+        replies = dict()
+        for d, (seq, timeout) in waiters.items():
+            timeout.cancel()
+            if seq not in replies:
+                replies[seq] = self.since(seq)
+            d.callback(replies[seq])
+        log.debug('%i waiting clients woken up at event %i', len(waiters),
+            self.seq)
+
+    def expire(self, d):
+        """ Timeout of a waiting client """
+        del self.waiters[d]
+        d.callback(dict(events=list(), seq=self.seq, lost=False))
+
+    def close(self):
+        """ Release the waiting clients (at shutdown) """
+        if self.wakecall is not None:
+            self.wakecall.cancel()
+        self.wakecall = None
+        self.wake()
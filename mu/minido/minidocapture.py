@@ -0,0 +1 @@
+../../tools/minidocapture.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../tools/minidoserial.py
\ No newline at end of file
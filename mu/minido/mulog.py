@@ -0,0 +1 @@
+../../tools/mulog.py
\ No newline at end of file
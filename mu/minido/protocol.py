@@ -0,0 +1 @@
+../../tools/protocol.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../tools/stompcodec.py
\ No newline at end of file
@@ -1,6 +1,13 @@
+from array import array
 from collections import deque
+from twisted.internet import reactor, defer
+from twisted.python import failure
 import datetime
+import logging
+import time
 from db import Db
+from usage import parse_dtime
+from minido.mulog import HexData
 
 EXIID = 0x17
 # Never change the following values, it's only for clarity :
@@ -18,6 +25,14 @@ LEN = 3
 COM = 4
 
 HIST = 5
+ALL_KNOWN = bytearray(b'\x01' * 8)
+NO_CHANGES = ()
+# Value of an output not known yet, where None can not be used (XML-RPC)
+UNKNOWN = -1
+# One transmit slot on the bus (seconds), see MinidoProtocol pacing.
+SLOT = 0.01
+
+log = logging.getLogger('mu.devices')
 
 class Exi(object):
     """ One instanciation for each physical EXI module """
@@ -47,73 +62,227 @@ class ExiStore(object):
     pass
 
 
+class ExoStore(object):
+    """
+    State of the EXO outputs of the whole installation, in flat arrays
+    indexed by slot = (exoid - 1) * 8 + channel - 1 :
+        outputs : bytearray, current value of each output
+        known   : bytearray, 1 once the value of the output is known
+    and the last hist changes of each output, in a ring buffer of hist
+    entries per output (entry = slot * hist + i) :
+        times   : array of float timestamps (time.time())
+        values  : bytearray
+        heads   : bytearray, next entry to write
+        counts  : bytearray, number of entries (up to hist)
+    version is incremented at each change, so a client can tell whether
+    the state changed since it last read it (see get_state_snapshot).
+    """
+    __slots__ = ('hist', 'outputs', 'known', 'times', 'values', 'heads',
+        'counts', 'version')
+
+    def __init__(self, exos=16, hist=HIST):
+        size = exos * 8
+        self.hist = hist
+        self.outputs = bytearray(size)
+        self.known = bytearray(size)
+        self.times = array('d', [0.0]) * (size * hist)
+        self.values = bytearray(size * hist)
+        self.heads = bytearray(size)
+        self.counts = bytearray(size)
+        self.version = 0
+
+    def record(self, slot, timestamp, value):
+        """ An output changed to value at timestamp """
+        head = self.heads[slot]
+        entry = slot * self.hist + head
+        self.times[entry] = timestamp
+        self.values[entry] = value
+        self.heads[slot] = (head + 1) % self.hist
+        if self.counts[slot] < self.hist:
+            self.counts[slot] += 1
+        self.outputs[slot] = value
+        self.known[slot] = 1
+        self.version += 1
+
+    def exo_outputs(self, exoid):
+        """ The 8 outputs of an EXO, UNKNOWN for the ones not known yet """
+        base = (exoid - 1) * 8
+        if self.known[base:base + 8] == ALL_KNOWN:
+            return list(self.outputs[base:base + 8])
+        return [self.outputs[slot] if self.known[slot] else UNKNOWN
+            for slot in range(base, base + 8)]
+
+    def history(self, slot):
+        """ [(timestamp, value)] of the last changes of an output """
+        hist = self.hist
+        base = slot * hist
+        first = self.heads[slot] - self.counts[slot]
+        return [(self.times[base + (first + i) % hist],
+            self.values[base + (first + i) % hist])
+            for i in range(self.counts[slot])]
+
+
 class Exo(object):
-    """ One instanciation for each physical EXO module """
-    # self.history is a tuple of 8 deque containing (date, value) tuples.
-    def __init__(self, exoid, send_data):
+    """
+    One instanciation for each physical EXO module, its state is kept in
+    the ExoStore shared by all of them.
+    """
+    __slots__ = ('send_data', 'exoid', 'mydb', 'is_present', 'store', 'base',
+        'complete', 'pending', 'slotcall', 'events')
+
+    def __init__(self, exoid, send_data, store=None, events=None):
         self.send_data = send_data
         self.exoid = exoid
         self.mydb = Db()
         self.is_present = False
         # I must find a way to provide the protocol mpd
         # self.protocol = protocol
-        # self.oldstatus = list()
-        self.history = tuple([deque(maxlen=HIST) for i in range(8)])
-        # Not necessary, but ensure queues are not empty.
-        for i in range(8):
-            self.history[i].append( ( datetime.datetime.now(), None ) )
+        self.store = store if store is not None else ExoStore()
+        # First slot of the outputs of this Exo in the store
+        self.base = (exoid - 1) * 8
+        # True once the 8 outputs are known
+        self.complete = False
+        # Write combining : Deferreds waiting for the next EXO_UPDATE,
+        # and the end of the current transmit slot.
+        self.pending = list()
+        self.slotcall = None
+        # EventLog of the changes (see events.py), if any
+        self.events = events
 
     def update(self, src, statuslist):
         """
         Update the Exo status
         And return the list of changes as tupple : ( channel, new_state, last_state )
         """
-        # self.oldstatus = [self.history[i][-1][1] for i in range(8)]
+        store = self.store
+        base = self.base
+        # Most updates change nothing : compare the 8 outputs at once
+        # (statuslist is a list, comparing lists is the fastest).
+        if self.complete and statuslist == list(store.outputs[base:base + 8]):
+            return NO_CHANGES
+        status = statuslist[:8]
         list_of_changes = list()
-
-        for i in range(8):
-            try:
-                if self.history[i][-1][1] != statuslist[i]:
-                    now = datetime.datetime.now()
-                    # Ok, we update the Exo history here.
-                    self.history[i].append( ( now, statuslist[i] ) )
-                    # But is it the right place to update the db history ?
-                    self.mydb.history( now, 'EXO', self.exoid, i+1, statuslist[i] )
-                    list_of_changes.append((i+1, statuslist[i], self.history[i][-2][1]))
-            except IndexOutOfRange:
-                print("No history yet for this Output.")
+        timestamp = time.time()
+        now = datetime.datetime.fromtimestamp(timestamp)
+        outputs = store.outputs
+        known = store.known
+        for i, value in enumerate(status):
+            slot = base + i
+            if known[slot]:
+                old = outputs[slot]
+                if old == value:
+                    continue
+            else:
+                old = None
+            store.record(slot, timestamp, value)
+            # But is it the right place to update the db history ?
+            self.mydb.history(now, 'EXO', self.exoid, i + 1, value)
+            if self.events is not None:
+                self.events.append('EXO', self.exoid, i + 1, value, old)
+            list_of_changes.append((i + 1, value, old))
+        if not self.complete:
+            self.complete = known[base:base + 8] == ALL_KNOWN
         return list_of_changes
 
     def update_history(self, dtime, output, status):
         """ Used to update from DB history """
-        data = (dtime, status)
-        self.history[output - 1].append( data )
+        dtime = parse_dtime(dtime)
+        timestamp = time.mktime(dtime.timetuple()) + dtime.microsecond / 1e6
+        self.store.record(self.base + output - 1, timestamp, status)
+
+    def get_history(self, channel):
+        """ [(timestamp, value)] of the last changes of an EXO output """
+        return self.store.history(self.base + channel - 1)
 
     def set_output(self, channel, value):
-        """Change the status of an EXO channel"""
-        idx = channel - 1
-        now = datetime.datetime.now()
-        # These 2 lines might seem touchy, and should be explained.
-        self.mydb.history( now, 'EXO', self.exoid, idx+1, value )
-        self.history[ idx ].append( ( now, value ) )
-        newdata = [self.history[i][-1][1] for i in range(8)]
+        """
+        Change the status of an EXO channel
+        Returns a Deferred fired with 'Ok' when the EXO_UPDATE is sent
+        (see send_data of the factory), IOError if it is not.
+        The changes requested in the same reactor turn, then during each
+        following transmit slot, are merged in a single EXO_UPDATE
+        carrying the final state of the 8 channels.
+        """
+        return self.set_outputs({channel: value})
+
+    def set_outputs(self, outputs):
+        """
+        Change several channels at once, outputs is {channel: value} :
+        they are sent in the same EXO_UPDATE (see set_output).
+        ValueError if a channel is not 1 to 8 or a value not 0 to 255,
+        nothing is changed then.
+        """
+        for channel, value in outputs.items():
+            if not 1 <= channel <= 8:
+                raise ValueError('No output {0} on an EXO'.format(channel))
+            if not 0 <= value <= 255:
+                raise ValueError('Output value out of range : {0}'.format(
+                    value))
+        timestamp = time.time()
+        now = datetime.datetime.fromtimestamp(timestamp)
+        store = self.store
+        for channel, value in sorted(outputs.items()):
+            slot = self.base + channel - 1
+            # The EXO_UPDATE is sent anyway, but only a change is recorded
+            # (history, usage, events), as in update().
+            if store.known[slot]:
+                old = store.outputs[slot]
+                if old == value:
+                    continue
+            else:
+                old = None
+            self.mydb.history( now, 'EXO', self.exoid, channel, value )
+            if self.events is not None:
+                self.events.append('EXO', self.exoid, channel, value, old)
+            store.record(slot, timestamp, value)
+        d = defer.Deferred()
+        self.pending.append(d)
+        if self.slotcall is None:
+            self.slotcall = reactor.callLater(0, self.flush)
+        return d
+
+    def flush(self):
+        """ Send the current state of the 8 channels in one EXO_UPDATE """
+        pending, self.pending = self.pending, list()
+        newdata = list(self.store.outputs[self.base:self.base + 8])
+        self.slotcall = reactor.callLater(SLOT, self.end_slot)
         # FixMe : The factory shouldn't be called here !!!
-        self.send_packet( self.exoid + EXOOFFSET, [01] + newdata )
-        # return [self.history[i][-1][1] for i in range(8)]
-        return 'Ok'
+        sent = defer.maybeDeferred(self.send_packet, self.exoid + EXOOFFSET,
+            [CMD['EXO_UPDATE']] + newdata)
+        sent.addBoth(self.sent, pending)
+
+    def sent(self, result, pending):
+        """ Fire the Deferreds of the changes carried by an EXO_UPDATE """
+        if result is False:
+            result = failure.Failure(IOError(
+                'EXO_UPDATE of EXO {0} not sent'.format(self.exoid)))
+        for d in pending:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback('Ok')
+
+    def end_slot(self):
+        """ The transmit slot is over, send what was merged meanwhile """
+        self.slotcall = None
+        if self.pending:
+            self.flush()
 
     def send_packet(self, dst, data):
         valuelist = [0x23, dst, EXIID, len(data) + 1] + data
         # valuelist.append(checksum( data ))
-        print('Debug : sending packet : ' + ' '.join(
-            [ '%0.2x' % c for c in valuelist ]))
+        log.debug('Sending packet : %s', HexData(valuelist))
         # packet = ''.join([chr(x) for x in valuelist])
         # FixMe
-        self.send_data(valuelist)
+        return self.send_data(valuelist, 'interactive')
 
     def get_output(self, channel):
-        """Get status of an EXO output"""
-        return self.history[ channel -1 ][-1][1]
+        """Get status of an EXO output (None until it is known)"""
+        slot = self.base + channel - 1
+        store = self.store
+        if store.known[slot]:
+            return store.outputs[slot]
+        return None
 
 class Exodict(dict):
     """
@@ -129,9 +298,17 @@ class Exodict(dict):
             cls._instance = super(Exodict, cls).__new__(cls, *args, **kwargs)
         return cls._instance
 
-    def __init__(self, send_data):
+    def __init__(self, send_data, events=None):
         # self = dict()
+        # Run again at each reconnection of the decoder : the Exo and
+        # their state are kept, only send_data and events change.
+        if hasattr(self, 'store'):
+            for exo in self.values():
+                exo.send_data = send_data
+                exo.events = events
+            return
+        self.store = ExoStore(16, HIST)
         for i in range(16):
-            self[i+1] = Exo(i+1, send_data)
+            self[i+1] = Exo(i+1, send_data, self.store, events)
         Db().populate_exodict(self)
 
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Replay a capture file of the bus traffic (see CAPTURE_FILE in the
+    bridges and minido/minidocapture.py), with the original timing, N
+    times faster, or as fast as possible :
+    - decoder : into a MinidoProtocolDecoder in this process. Nothing is
+                sent to the bus, the sqlite DB of the current directory
+                is updated.
+    - tcp     : as a TCP/IP client of morbidq2tcp (or of anything
+                listening like the bus adapter).
+    By default, both directions are replayed, as the decoder sees them
+    in production (the bridges copy what they send to /mu/read).
+
+    Examples :
+        ./minidoreplay.py bus.mucap decoder
+        ./minidoreplay.py --speed 10 bus.mucap tcp --port 2323
+        ./minidoreplay.py --speed 0 --direction rx bus.mucap decoder
+"""
+
+from __future__ import print_function
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import Protocol, ClientFactory
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+import argparse
+import logging
+import time
+
+from minido import mulog
+from minido.mulog import HexData
+from minido.minidocapture import CaptureReader, CaptureError, DIRECTIONS
+import twisted_minido_morbidqonly as decoder
+
+LOG_LEVELS = {'mu': 'INFO', 'mu.decoder': 'WARNING', 'mu.db': 'WARNING'}
+# Packets sent in a row at maximum speed before giving the hand back
+# to the reactor
+BURST = 500
+# Log the progress every PROGRESS packets
+PROGRESS = 100000
+
+log = logging.getLogger('mu.replay')
+
+
+@implementer(IPushProducer)
+class Replay(object):
+    """
+    Hand the packets of a capture file to sink(packet), packet being a
+    byte string, at speed times the original pace (0 : no waiting).
+    start() returns a Deferred fired with the number of packets sent.
+    It can be registered as a streaming producer of a transport.
+    """
+    def __init__(self, reader, sink, speed=1.0, directions=DIRECTIONS['all']):
+        self.records = iter(reader)
+        self.sink = sink
+        self.speed = speed
+        self.directions = directions
+        self.sent = 0
+        self.paused = False
+        self.call = None
+        self.record = None
+        self.lasttime = None
+        self.replaytime = 0.0
+
+    def start(self):
+        self.done = defer.Deferred()
+        self.starttime = time.time()
+        self.send_next()
+        return self.done
+
+    def send_next(self):
+        self.call = None
+        burst = 0
+        while not self.paused:
+            if self.record is None:
+                self.record = self.next_record()
+                if self.record is None:
+                    self.done.callback(self.sent)
+                    return
+            timestamp, direction, packet = self.record
+            if self.speed > 0.0:
+                due = self.starttime + self.replaytime / self.speed
+                delay = due - time.time()
+                if delay > 0.0:
+                    self.call = reactor.callLater(delay, self.send_next)
+                    return
+            elif burst >= BURST:
+                self.call = reactor.callLater(0, self.send_next)
+                return
+            self.record = None
+            self.sink(packet)
+            self.sent += 1
+            burst += 1
+            if self.sent % PROGRESS == 0:
+                log.info('%i packets replayed', self.sent)
+
+    def next_record(self):
+        """ Next record to replay, with replaytime updated """
+        for timestamp, direction, packet in self.records:
+            if direction not in self.directions:
+                continue
+            if self.lasttime is not None and timestamp > self.lasttime:
+                # A new run of the capture may restart from a lower time.
+                self.replaytime += timestamp - self.lasttime
+            self.lasttime = timestamp
+            return timestamp, direction, packet
+        return None
+
+    def pauseProducing(self):
+        self.paused = True
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.call is None:
+            self.call = reactor.callLater(0, self.send_next)
+
+    def stopProducing(self):
+        self.pauseProducing()
+
+
+def replay_decoder(replay):
+    """ Feed the packets to a MinidoProtocolDecoder """
+    def send_data(data, priority='normal'):
+        log.debug('Not sent (replay) : %s', HexData(data))
+
+    mpd = decoder.MinidoProtocolDecoder(send_data)
+    # The EXI scan is only useful on a real bus.
+    mpd.exiloop.stop()
+    replay.sink = lambda packet: mpd.recv_minido_packet(
+        list(bytearray(packet)))
+    return replay.start()
+
+
+class ReplayClient(Protocol):
+    def connectionMade(self):
+        log.info('Connected to %s', self.transport.getPeer())
+        self.transport.registerProducer(self.factory.replay, True)
+        self.factory.replay.sink = self.transport.write
+        d = self.factory.replay.start()
+        d.addCallback(self.replayed)
+        d.chainDeferred(self.factory.done)
+
+    def replayed(self, sent):
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+        return sent
+
+
+class ReplayClientFactory(ClientFactory):
+    protocol = ReplayClient
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.done = defer.Deferred()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.done.errback(reason)
+
+
+def replay_tcp(replay, host, port):
+    """ Send the packets to a TCP/IP server """
+    factory = ReplayClientFactory(replay)
+    reactor.connectTCP(host, port, factory)
+    return factory.done
+
+
+def mu_main():
+    parser = argparse.ArgumentParser(
+        description='Replay a capture file of the bus traffic')
+    parser.add_argument('capture', help='Capture file')
+    parser.add_argument('target', choices=('decoder', 'tcp'),
+        help='Replay into a MinidoProtocolDecoder or as a TCP/IP client')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+        help='Replay speed, 1 is the original pace, 0 as fast as possible')
+    parser.add_argument('-d', '--direction', choices=sorted(DIRECTIONS),
+        default='all', help='Packets to replay (default all)')
+    parser.add_argument('--host', default='localhost',
+        help='TCP/IP server (default localhost)')
+    parser.add_argument('--port', type=int, default=2323,
+        help='TCP/IP port (default 2323, morbidq2tcp)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='Log every packet')
+    args = parser.parse_args()
+
+    if args.verbose:
+        mulog.setup({'mu': 'DEBUG'})
+    else:
+        mulog.setup(LOG_LEVELS)
+    try:
+        reader = CaptureReader(args.capture)
+    except (CaptureError, IOError) as e:
+        parser.error(str(e))
+    replay = Replay(reader, None, args.speed, DIRECTIONS[args.direction])
+
+    def run():
+        start = time.time()
+        if args.target == 'decoder':
+            d = replay_decoder(replay)
+        else:
+            d = replay_tcp(replay, args.host, args.port)
+
+        def replayed(sent):
+            elapsed = time.time() - start
+            log.info('%i packets replayed in %.3f s (%.0f packets/s)',
+                sent, elapsed, sent / max(elapsed, 1e-9))
+
+        def failed(failure):
+            log.error('Replay failed : %s', failure.getErrorMessage())
+
+        d.addCallbacks(replayed, failed)
+        d.addBoth(lambda result: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    reader.close()
+
+
+if __name__ == '__main__':
+    mu_main()
@@ -40,9 +40,13 @@ from orbited import json
 # Other imports
 import datetime
 import time
+import logging
 
 # minido
 from minido.protocol import *
+from minido import stompcodec
+from minido import mulog
+from minido.mulog import HexData
 
 MINIDO_ADAPTER_HOST = 'localhost'
 MINIDO_ADAPTER_PORT = 2323
@@ -53,6 +57,10 @@ CHANNEL_MINIDO_READ= "/mu/read"
 HIST = 5
 SQLITEDB = "minido_unleashed.db"
 EXIID = 0x17
+# Encoding of the packets sent to STOMP : 'json' or 'base64'
+STOMP_ENCODING = 'json'
+# Level of each logger (see mulog), use DEBUG to dump every packet.
+LOG_LEVELS = {'mu': 'INFO'}
 
 # Never change the following values, it's only for clarity :
 EXOOFFSET = 0x3B
@@ -68,22 +76,24 @@ SRC = 2
 LEN = 3
 COM = 4
 
+log = logging.getLogger('mu.tcpbridge')
+
 class MinidoServerFactory(Factory):
     def __init__(self):
         self.connections = []
 
     def startedConnecting(self, connector):
-        print('Started to connect.')
+        log.info('Started to connect.')
 
     def buildProtocol(self, addr):
         return MinidoProtocol(self)
 
     def clientConnectionLost(self, connector, reason):
-        print('Lost connection.  Reason:', reason)
+        log.info('Lost connection.  Reason: %s', reason)
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
-        print('Connection failed. Reason:', reason)
+        log.warning('Connection failed. Reason: %s', reason)
         ReconnectingClientFactory.clientConnectionFailed(self, connector,
                                                          reason)
  
@@ -92,18 +102,20 @@ class MorbidQClientFactory(StompClientFactory):
         self.subscribe(CHANNEL_MINIDO_READ)
 
     def recv_message(self, msg):
-        message = json.decode(msg['body'])
+        message = stompcodec.decode(msg)
         if msg['headers']['destination'] == CHANNEL_MINIDO_READ:
-            if type(message) is list:
-                print(str(datetime.datetime.now()), ": Sending to",
-                    len(self.minidoFactory.connections),"tcp client(s) :", message)
+            for packet in stompcodec.packets(message):
+                log.debug('Sending to %i tcp client(s) : %s',
+                    len(self.minidoFactory.connections), HexData(packet))
                 for conn in self.minidoFactory.connections:
-                    conn.send_data(message)
+                    conn.send_data(packet)
  
     def send_data(self, data):
-        self.send(CHANNEL_MINIDO_WRITE, json.encode(data))
+        body, headers = stompcodec.encode(data, STOMP_ENCODING)
+        self.send(CHANNEL_MINIDO_WRITE, body, **headers)
 
 def mu_main():
+    mulog.setup(LOG_LEVELS)
     morbidqFactory = MorbidQClientFactory()
     minidoFactory = MinidoServerFactory()
     morbidqFactory.minidoFactory =  minidoFactory
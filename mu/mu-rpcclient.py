@@ -21,10 +21,14 @@
 
 
 import argparse
+import shlex
 import textwrap
 import sys
 import xmlrpclib
 
+# Commands sent in one system.multicall by the batch mode
+BATCH_CHUNK = 50
+
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -36,12 +40,25 @@ parser = argparse.ArgumentParser(
         set : to change the state of an object
         get : to get the state of an object
 
+    Scenes : set many devices at once, with one bus frame per EXO
+        scenes    : list the scenes
+        scene     : apply a scene
+        savescene : create or replace a scene, from device=value targets
+                    (value on, off, 0 to 255, up, down or stop)
+        delscene  : delete a scene
+
+    Rules : the trigger and actions tables of the DB
+        rules       : hits of each rule and time spent evaluating them
+        reloadrules : read the rules again after a change of the tables
+
     Low level commands :
         You must know the exo id and the output id for these commands
         and specify them with -e 1 -o 1 (for exi 1 output 1)
 
         setouput  : low level command to set an exo output state.
         getoutput : low level command to get an exo output state.
+        history   : changes of an exo output, optionally from a date
+                    and to a date ('YYYY-MM-DD HH:MM:SS').
 
     Programming commands :
         Warning. These commands will turn programming mode on the EXI,
@@ -60,14 +77,26 @@ parser = argparse.ArgumentParser(
         ./muclient.py set CentreWC on
         ./muclient.py get CentreWC
         ./muclient.py set CentreWC off
+        ./muclient.py savescene night 12=off 13=off 20=down
+        ./muclient.py scene night
 
     Examples for more advanced commands (directly command exo)
         ./muclient.py -e 1 -o 1 setoutput 0
         ./muclient.py -e 1 -o 1 getoutput 
         ./muclient.py -e 1 -o 1 setoutput 255
+        ./muclient.py -e 1 -o 1 history '2011-01-01' '2011-02-01'
+        ./muclient.py state
+        ./muclient.py getnext
+
+    Batch mode : the commands of a file (or stdin), one per line, are
+    sent by chunks of 50 in one request, over one connection :
+        ./muclient.py batch commands.txt
+        echo "-e 1 -o 1 setoutput 255" | ./muclient.py batch
     ''') )
 parser.add_argument("command", default="list", nargs="+",
-    help="Command : list, setoutput, getoutput, set, get, " +
+    help="Command : list, setoutput, getoutput, history, state, getnext, " +
+    "batch, scenes, scene, savescene, delscene, rules, reloadrules, " +
+    "set, get, " +
     "addmode, delmode, cancelmode, listmethods (for dev)")
 parser.add_argument("-u", "--url", dest="url",
     default='http://localhost:8000', 
@@ -93,6 +122,73 @@ except(IOError):
     sys.exit(0)
 
 
+# Commands of the batch mode : XML-RPC method and its parameters
+BATCH_CALLS = {
+    'setoutput': lambda a: ('set_output', [a.exo, a.output, a.command[1]]),
+    'getoutput': lambda a: ('get_output', [a.exo, a.output]),
+    'list': lambda a: ('get_device_dict', []),
+    'state': lambda a: ('get_state_snapshot', []),
+    'scene': lambda a: ('apply_scene', [a.command[1]]),
+    'get': lambda a: ('get_device_value', [a.command[1]]),
+    'set': lambda a: ('set_device_value', [a.command[1], a.command[2]]),
+    'on': lambda a: ('set_device_on', [a.command[1]]),
+    'off': lambda a: ('set_device_off', [a.command[1]]),
+    'cancelmode': lambda a: ('minido_programming',
+        [a.exo, a.output, 'cancel']),
+    'delmode': lambda a: ('minido_programming', [a.exo, a.output, 'remove']),
+    'addmode': lambda a: ('minido_programming', [a.exo, a.output, 'add']),
+    }
+
+
+def batch_call(line):
+    """ (method, params) of a command line of the batch mode """
+    try:
+        line_args = parser.parse_args(shlex.split(line))
+    except SystemExit:
+        raise ValueError('invalid command')
+    if line_args.command[0] not in BATCH_CALLS:
+        raise ValueError('not available in batch mode')
+    try:
+        return BATCH_CALLS[line_args.command[0]](line_args)
+    except IndexError:
+        raise ValueError('missing argument')
+
+
+def run_batch(lines):
+    """ Send the commands by chunks, print the result of each one in order """
+    failed = 0
+    chunk = list()
+    for number, line in enumerate(lines + [None]):
+        if line is not None:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                chunk.append((number + 1, line, batch_call(line)))
+            except ValueError as error:
+                chunk.append((number + 1, line, error))
+        if chunk and (line is None or len(chunk) == BATCH_CHUNK):
+            multicall = xmlrpclib.MultiCall(client)
+            for lineno, text, call in chunk:
+                if not isinstance(call, ValueError):
+                    getattr(multicall, call[0])(*call[1])
+            results = iter(multicall())
+            for lineno, text, call in chunk:
+                try:
+                    if isinstance(call, ValueError):
+                        raise call
+                    print('%i: %s : %s' % (lineno, text, next(results)))
+                except ValueError as error:
+                    print('%i: %s : %s' % (lineno, text, error))
+                    failed += 1
+                except xmlrpclib.Fault as fault:
+                    print('%i: %s : error %s' % (lineno, text,
+                        fault.faultString))
+                    failed += 1
+            chunk = list()
+    return failed
+
+
 
 
 
@@ -113,6 +209,68 @@ elif args.command[0] == 'getoutput':
         print(result)
     else:
         print(result)
+elif args.command[0] == 'history':
+    start = args.command[1] if len(args.command) > 1 else ''
+    end = args.command[2] if len(args.command) > 2 else ''
+    cursor = ''
+    while True:
+        page = client.get_history(args.exo, args.output, start, end, 1000,
+            cursor)
+        for dtime, status in page['rows']:
+            print('%s %s' % (dtime, status))
+        cursor = page['cursor']
+        if not cursor:
+            break
+elif args.command[0] == 'state':
+    result = client.get_state_snapshot()
+    print('Version %s (since %s)' % (result['version'], result['boot']))
+    for exo in sorted(result['exo'], key=int):
+        print('EXO-%02d %s' % (int(exo), ' '.join(['%3d' % value
+            for value in result['exo'][exo]])))
+    for devid in sorted(result['devices']):
+        print('%s %s' % (devid, result['devices'][devid]))
+elif args.command[0] == 'batch':
+    if len(args.command) > 1 and args.command[1] != '-':
+        with open(args.command[1]) as commands:
+            lines = commands.readlines()
+    else:
+        lines = sys.stdin.readlines()
+    if run_batch(lines):
+        sys.exit(1)
+elif args.command[0] == 'scenes':
+    result = client.list_scenes()
+    for name in sorted(result):
+        print('%s : %s' % (name, result[name]['description']))
+        print('    ' + ' '.join(['%s=%s' % (devid, value)
+            for devid, value in result[name]['targets']]))
+elif args.command[0] == 'scene':
+    try:
+        result = client.apply_scene(args.command[1])
+        print('%s EXO updated' % result)
+    except(xmlrpclib.Fault) as fault:
+        print(fault.faultString)
+elif args.command[0] == 'savescene':
+    try:
+        targets = [target.split('=', 1) for target in args.command[2:]]
+        result = client.save_scene(args.command[1], targets)
+        print('%s targets saved' % result)
+    except(xmlrpclib.Fault) as fault:
+        print(fault.faultString)
+elif args.command[0] == 'delscene':
+    result = client.delete_scene(args.command[1])
+    print('%s scene deleted' % result)
+elif args.command[0] == 'rules':
+    result = client.get_rule_stats()
+    print('%i events, %i rules run, %.3f ms average, %.3f ms slowest' % (
+        result['events'], result['matched'], result['average'] * 1000.0,
+        result['slowest'] * 1000.0))
+    for ruleid in sorted(result['rules'], key=int):
+        rule = result['rules'][ruleid]
+        print('%s %s : %i hits, %i runs, %i errors, last %s' % (ruleid,
+            rule['name'], rule['hits'], rule['runs'], rule['errors'],
+            rule['last'] or 'never'))
+elif args.command[0] == 'reloadrules':
+    print('%s rules loaded' % client.reload_rules())
 elif args.command[0] == 'listmethods':
     print client.system.listMethods()
 
@@ -157,4 +315,13 @@ elif args.command[0] == 'addmode':
     result = client.minido_programming(args.exo, args.output, 'add')
     # print(result)
 elif args.command[0] == 'getnext':
-    result = client.get_nextevent()
+    # Follow the changes until interrupted
+    since = -1
+    while True:
+        result = client.get_nextevent(since)
+        if result['lost']:
+            print('Some events were lost')
+        for seq, dtime, kind, busid, channel, value, old in result['events']:
+            print('%s %s-%02d Output %1d = %3d  ( was %3d)' % (dtime, kind,
+                busid, channel, value, old))
+        since = result['seq']
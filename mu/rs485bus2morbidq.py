@@ -51,61 +51,103 @@ import sqlite3
 import time
 import textwrap
 import traceback
+import logging
 
 # Minido
 from minido.protocol import MinidoProtocol
+from minido import stompcodec
+from minido import mulog
+from minido.minidocapture import CaptureWriter
+from minido.mulog import HexData
 
 MINIDO_ADAPTER_HOST = 'minidoadt'
 MINIDO_ADAPTER_PORT = 23
+# Serial adapter : set the device (e.g. '/dev/ttyUSB0') to use it instead
+# of the TCP/IP adapter. Requires pyserial.
+MINIDO_SERIAL_DEVICE = None
+MINIDO_SERIAL_BAUDRATE = 19200
+# pyserial read timeout (seconds), see minidoserial.TIMEOUT
+MINIDO_SERIAL_TIMEOUT = 0
 MORBIDQ_HOST = 'localhost'
 MORBIDQ_PORT = 61613
 CHANNEL_MINIDO_WRITE= "/mu/write"
 CHANNEL_MINIDO_READ= "/mu/read"
+# Drop an incomplete packet after RXTIMEOUT seconds of silence
+# (disabled if 0.0, 0.1 is a good value with a serial adapter)
+RXTIMEOUT = 0.0
+# Encoding of the packets sent to STOMP : 'json' or 'base64'
+# Keep 'json' if a web browser listens to /mu/read (see stompcodec).
+STOMP_ENCODING = 'json'
+# Record the bus traffic in this file (see minidocapture), e.g.
+# 'bus.mucap', to replay it later with mu/minidoreplay.py.
+CAPTURE_FILE = None
+# Level of each logger (see mulog), use DEBUG to dump every packet.
+LOG_LEVELS = {'mu': 'INFO'}
+
+log = logging.getLogger('mu.bridge')
 
 class MinidoClientFactory(ReconnectingClientFactory):
+    capture = None
+
     def startedConnecting(self, connector):
-        print('Started to connect.')
+        log.info('Started to connect.')
 
     def buildProtocol(self, addr):
-        return MinidoProtocol(self)
+        return MinidoProtocol(self, rxtimeout=RXTIMEOUT, capture=self.capture)
 
 
     def clientConnectionLost(self, connector, reason):
-        print('Lost connection.  Reason:', reason)
+        log.info('Lost connection.  Reason: %s', reason)
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
     def clientConnectionFailed(self, connector, reason):
-        print('Connection failed. Reason:', reason)
+        log.warning('Connection failed. Reason: %s', reason)
         ReconnectingClientFactory.clientConnectionFailed(self, connector,
                                                          reason)
  
 class MorbidQClientFactory(StompClientFactory):
  
     def recv_connected(self, msg):
-        print('Subscribing to channel ' + CHANNEL_MINIDO_WRITE)
+        log.info('Subscribing to channel %s', CHANNEL_MINIDO_WRITE)
         self.subscribe(CHANNEL_MINIDO_WRITE)
 
     def recv_message(self, msg):
-        message = json.decode(msg['body'])
+        message = stompcodec.decode(msg)
         if msg['headers']['destination'] == CHANNEL_MINIDO_WRITE:
             if type(message) is list:
-                print(str(datetime.datetime.now()), ": STOMP to RS485 :", message)
+                log.debug('STOMP to RS485 : %s', HexData(message))
+                priority = msg['headers'].get('priority', 'normal')
                 for conn in self.minidoFactory.connections:
-                    conn.send_data(message)
+                    conn.send_data(message, priority)
                 # Also copy it for other listeners.
-                self.send(CHANNEL_MINIDO_READ, json.encode(message))
+                self.send_packet(CHANNEL_MINIDO_READ, message)
  
     def send_data(self, data):
-        print(str(datetime.datetime.now()) + " : RS485 to STOMP : " + str(data))
-        self.send(CHANNEL_MINIDO_READ, json.encode(data))
+        log.debug('RS485 to STOMP : %s', HexData(data))
+        self.send_packet(CHANNEL_MINIDO_READ, data)
+
+    def send_packet(self, dest, data):
+        body, headers = stompcodec.encode(data, STOMP_ENCODING)
+        self.send(dest, body, **headers)
  
 
 def mu_main():
+    mulog.setup(LOG_LEVELS)
     morbidqFactory = MorbidQClientFactory()
     minidoFactory = MinidoClientFactory()
     morbidqFactory.minidoFactory =  minidoFactory
     minidoFactory.morbidqFactory = morbidqFactory
-    reactor.connectTCP(MINIDO_ADAPTER_HOST, MINIDO_ADAPTER_PORT, minidoFactory)
+    if CAPTURE_FILE:
+        minidoFactory.capture = CaptureWriter(CAPTURE_FILE)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+            minidoFactory.capture.close)
+    if MINIDO_SERIAL_DEVICE:
+        from minido.minidoserial import SerialClient
+        SerialClient(minidoFactory, MINIDO_SERIAL_DEVICE,
+            MINIDO_SERIAL_BAUDRATE, MINIDO_SERIAL_TIMEOUT).startService()
+    else:
+        reactor.connectTCP(MINIDO_ADAPTER_HOST, MINIDO_ADAPTER_PORT,
+            minidoFactory)
     reactor.connectTCP(MORBIDQ_HOST, MORBIDQ_PORT, morbidqFactory)
     reactor.run()
 
@@ -0,0 +1,226 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Rules of the trigger and actions tables (see Db.load_rules), run by
+    the MinidoProtocolDecoder on the events decoded from the bus :
+        EXO change : src_type 'EXO', src_busid the EXO, src_channel the
+                     output (1 to 8), the status is the new value
+        D2000 button : src_type 'EXI', src_busid the EXI, src_channel the
+                     button
+    A trigger matches when, if they are set :
+        on_status : 'on' (any value but 0), 'off' (0), or the value
+        from_time, to_time : 'HH:MM' (or 'H:MM'), the time is in
+                     [from_time, to_time[ (over midnight if to_time <
+                     from_time)
+        weekdays  : the days, '1' (monday) to '7', e.g. '12345'
+    src_channel NULL matches any channel of the module.
+    The actions of a trigger (actions.id_program = trigger.id_program,
+    or trigger.id without program) are run in order :
+        deviceaction : parameter1 device, parameter2 on, off, toggle (lights)
+                       or up, down, stop (stores)
+        scene        : parameter1 scene name
+        output       : parameter1 exo, parameter2 output, parameter3 value
+    The rules are kept in an index by (src_type, busid, channel) : an event
+    only looks at the rules of its source.
+"""
+
+import datetime
+import logging
+import time
+
+log = logging.getLogger('mu.rules')
+
+
+class Rule(object):
+    """ A trigger, its actions and its counters """
+    __slots__ = ('id', 'name', 'status', 'from_time', 'to_time', 'weekdays',
+        'actions', 'hits', 'runs', 'errors', 'last')
+
+    def __init__(self, trigger, actions):
+        self.id = trigger['id']
+        self.name = trigger['name'] or str(trigger['id'])
+        self.status = parse_status(trigger['on_status'])
+        self.from_time = parse_time(trigger['from_time'])
+        self.to_time = parse_time(trigger['to_time'])
+        self.weekdays = trigger['weekdays'] or None
+        self.actions = actions
+        # Events of the source, events matching the conditions, failed
+        # actions, time of the last run
+        self.hits = 0
+        self.runs = 0
+        self.errors = 0
+        self.last = ''
+
+    def matches(self, status, now):
+        if self.status is not None and status is not None:
+            if self.status == 'on':
+                if not status:
+                    return False
+            elif status != self.status:
+                return False
+        if self.weekdays is not None and \
+                str(now.isoweekday()) not in self.weekdays:
+            return False
+        if self.from_time is not None or self.to_time is not None:
+            hour = now.strftime('%H:%M')
+            start = self.from_time or '00:00'
+            end = self.to_time or '24:00'
+            if start <= end:
+                return start <= hour < end
+            return hour >= start or hour < end
+        return True
+
+
+def parse_time(value):
+    """
+    from_time or to_time of a trigger as 'HH:MM', to be compared with
+    strftime('%H:%M') : None if not set, ValueError if not a time
+    """
+    if value is None or str(value).strip() == '':
+        return None
+    hours, minutes = str(value).strip().split(':')
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 23 and 0 <= minutes <= 59
+            or (hours, minutes) == (24, 0)):
+        raise ValueError('Not a time : {0}'.format(value))
+    return '{0:02d}:{1:02d}'.format(hours, minutes)
+
+
+def parse_status(value):
+    """ on_status of a trigger : None (any), 'on', or the value """
+    if value is None or str(value).strip() == '':
+        return None
+    value = str(value).strip().lower()
+    if value == 'on':
+        return 'on'
+    if value == 'off':
+        return 0
+    return int(value)
+
+
+class RuleEngine(object):
+    """
+    Index of the rules, and their evaluation. mpd is the
+    MinidoProtocolDecoder running the actions on its devices.
+    """
+    def __init__(self, mpd):
+        self.mpd = mpd
+        # (src_type, busid, channel or None) : [Rule]
+        self.index = dict()
+        self.rules = list()
+        # Evaluation metrics, see stats()
+        self.events = 0
+        self.matched = 0
+        self.elapsed = 0.0
+        self.slowest = 0.0
+
+    def load(self, triggers):
+        """
+        Build the index from the triggers of Db.load_rules. A trigger that
+        can not be read is logged and left out. The counters of the rules
+        still loaded are kept.
+        """
+        previous = dict([(rule.id, rule) for rule in self.rules])
+        index = dict()
+        rules = list()
+        for trigger in triggers:
+            try:
+                rule = Rule(trigger, trigger['actions'])
+                key = (str(trigger['src_type']).upper(),
+                    int(trigger['src_busid']),
+                    None if trigger['src_channel'] is None
+                        else int(trigger['src_channel']))
+            except (TypeError, ValueError):
+                log.error('Trigger %s ignored : can not read %s',
+                    trigger['id'], trigger)
+                continue
+            if rule.id in previous:
+                old = previous[rule.id]
+                rule.hits, rule.runs = old.hits, old.runs
+                rule.errors, rule.last = old.errors, old.last
+            index.setdefault(key, list()).append(rule)
+            rules.append(rule)
+        self.index = index
+        self.rules = rules
+        log.info('%i rules loaded, %i sources', len(rules), len(index))
+        return len(rules)
+
+    def event(self, src_type, busid, channel, status=None):
+        """ An event was decoded : run the rules it triggers """
+        rules = self.index.get((src_type, busid, channel))
+        anychannel = self.index.get((src_type, busid, None))
+        if rules is None and anychannel is None:
+            return
+        start = time.time()
+        now = datetime.datetime.now()
+        for rule in (rules or []) + (anychannel or []):
+            rule.hits += 1
+            if not rule.matches(status, now):
+                continue
+            rule.runs += 1
+            rule.last = str(now)
+            self.matched += 1
+            log.info('Rule %s triggered by %s-%02d %i', rule.name, src_type,
+                busid, channel)
+            for action in rule.actions:
+                try:
+                    self.run(*action)
+                except Exception:
+                    rule.errors += 1
+                    log.exception('Rule %s : action %s failed', rule.name,
+                        action)
+        elapsed = time.time() - start
+        self.events += 1
+        self.elapsed += elapsed
+        self.slowest = max(self.slowest, elapsed)
+
+    def run(self, function, parameter1, parameter2, parameter3):
+        """ Run an action through the device API """
+        if function == 'deviceaction':
+            device = self.mpd.devdict[str(parameter1)]
+            if device.type_ == 'Store':
+                device.set_value(parameter2)
+            elif parameter2 in ('on', 'off', 'toggle'):
+                getattr(device, parameter2)()
+            else:
+                raise ValueError('Unknown device action : {0}'.format(
+                    parameter2))
+        elif function == 'scene':
+            self.mpd.apply_scene(parameter1)
+        elif function == 'output':
+            self.mpd.exodict[int(parameter1)].set_output(int(parameter2),
+                int(parameter3))
+        else:
+            raise ValueError('Unknown action : {0}'.format(function))
+
+    def stats(self):
+        """
+        events, matched : events with rules, rules run
+        elapsed, slowest, average : seconds spent evaluating the rules
+        and running their actions
+        rules : {trigger id: {'name', 'hits', 'runs', 'errors', 'last'}}
+        """
+        return dict(events=self.events, matched=self.matched,
+            elapsed=self.elapsed, slowest=self.slowest,
+            average=self.elapsed / self.events if self.events else 0.0,
+            rules=dict([(str(rule.id), dict(name=rule.name, hits=rule.hits,
+                runs=rule.runs, errors=rule.errors, last=rule.last))
+                for rule in self.rules]))
@@ -0,0 +1,115 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Scenes : named sets of device targets, in the tables scene and
+    scene_target (see the migrations of db.py). A target is a device and
+    a value :
+        on, off, or 0 to 255 : the power output of a light
+        up, down, stop       : the outputs of a store
+    A scene is compiled from the device registry into the outputs to set
+    per EXO, {exo: {channel: value}}, so applying it sends at most one
+    EXO_UPDATE per EXO (see Exo.set_outputs), whatever the number of
+    devices.
+"""
+
+import logging
+# A store moved by a scene is stopped after STORE_RUN seconds, as
+# StoreDevice does.
+from devices import STORE_RUN
+
+# Outputs of a device (cmdtype : value) for the value of a target
+TARGETS = {
+    'on': {'power': 255},
+    'off': {'power': 0},
+    'up': {'up': 255, 'down': 0},
+    'down': {'up': 0, 'down': 255},
+    'stop': {'up': 0, 'down': 0},
+    }
+
+log = logging.getLogger('mu.scenes')
+
+
+def target_outputs(value):
+    """ {cmdtype: value} of a target value, ValueError if invalid """
+    value = str(value).strip().lower()
+    if value in TARGETS:
+        return TARGETS[value]
+    try:
+        level = int(value)
+    except ValueError:
+        raise ValueError('Unknown target value : {0}'.format(value))
+    if not 0 <= level <= 255:
+        raise ValueError('Output value out of range : {0}'.format(level))
+    return {'power': level}
+
+
+def compile_scene(targets, devices):
+    """
+    Outputs to set for the targets [(devid, value)] of a scene, from the
+    devices of the registry : (frames, stops), both {exo: {channel:
+    value}}. stops are the store outputs to set back to 0 after
+    STORE_RUN. When several targets set the same output, the last wins,
+    a store stopped by a later target is not stopped again.
+    """
+    frames = dict()
+    stops = dict()
+    for devid, value in targets:
+        device = devices.get(str(devid))
+        if device is None:
+            raise ValueError('Unknown device : {0}'.format(devid))
+        outputs = target_outputs(value)
+        for cmdtype, level in outputs.items():
+            if cmdtype not in device['channels']:
+                raise ValueError('Device {0} has no {1} output'.format(
+                    devid, cmdtype))
+            exo, channel = device['channels'][cmdtype]
+            frames.setdefault(int(exo), dict())[int(channel)] = level
+            if cmdtype in ('up', 'down'):
+                if level:
+                    stops.setdefault(int(exo), dict())[int(channel)] = 0
+                elif int(channel) in stops.get(int(exo), ()):
+                    del stops[int(exo)][int(channel)]
+                    if not stops[int(exo)]:
+                        del stops[int(exo)]
+    return frames, stops
+
+
+def store_scene(cur, name, description, targets):
+    """ Create or replace a scene (run in the DB writer thread) """
+    cur.execute('DELETE FROM scene_target WHERE id_scene IN '
+        '(SELECT id FROM scene WHERE name = ?)', [name])
+    cur.execute('DELETE FROM scene WHERE name = ?', [name])
+    cur.execute('INSERT INTO scene (name, description) VALUES (?, ?)',
+        [name, description])
+    sceneid = cur.lastrowid
+    cur.executemany('INSERT INTO scene_target (id_scene, id_device, value) '
+        'VALUES (?, ?, ?)', [(sceneid, int(devid), str(value))
+        for devid, value in targets])
+    log.info('Scene %s saved : %i targets', name, len(targets))
+    return len(targets)
+
+
+def remove_scene(cur, name):
+    """ Delete a scene (run in the DB writer thread) """
+    cur.execute('DELETE FROM scene_target WHERE id_scene IN '
+        '(SELECT id FROM scene WHERE name = ?)', [name])
+    cur.execute('DELETE FROM scene WHERE name = ?', [name])
+    return cur.rowcount
@@ -41,7 +41,6 @@
 
 ###############################################################################
 # TODO:                                                                       #
-#  * Implement serial adapter (not only tcp/ip)                               #
 #  * History for EXI also as with EXO                                         #
 #  * Mettre à jour les tables exi_id2output et exi                            #
 #  * Implement action testing                                                 #
@@ -63,17 +62,48 @@ from orbited import json
 
 # Other imports
 import datetime
+import logging
 import time
 import traceback
 
 # minido
-from db import Db
-from minidodevices import Exo, Exodict, Exi
+from minido import stompcodec
+from minido import mulog
+from minido.mulog import HexData
+from minido.minidocapture import CaptureWriter
+from db import Db, HISTORY_PAGE
+import usage
+from events import EventLog, LONGPOLL_TIMEOUT
+from scenes import STORE_RUN
+from rules import RuleEngine
+from minidodevices import Exo, Exodict, Exi, UNKNOWN
 from devices import *
-# from minido.protocol import MinidoProtocol
+from minido.protocol import MinidoProtocol
 
 MORBIDQ_HOST = 'localhost'
 MORBIDQ_PORT = 61613
+XMLRPC_PORT = 8000
+# Most calls in one system.multicall
+MULTICALL_MAX = 500
+# Broker-less mode : connect the bus adapter directly to this process.
+# STOMP is then only a mirror of the bus for external listeners.
+DIRECT_MODE = False
+STOMP_MIRROR = True
+MINIDO_ADAPTER_HOST = 'minidoadt'
+MINIDO_ADAPTER_PORT = 23
+# Serial adapter for the broker-less mode : set the device
+# (e.g. '/dev/ttyUSB0') to use it instead of the TCP/IP adapter.
+MINIDO_SERIAL_DEVICE = None
+MINIDO_SERIAL_BAUDRATE = 19200
+# pyserial read timeout (seconds), see minidoserial.TIMEOUT
+MINIDO_SERIAL_TIMEOUT = 0
+# Broker-less mode : record the bus traffic in this file (see
+# minidocapture), e.g. 'bus.mucap', to replay it with mu/minidoreplay.py.
+CAPTURE_FILE = None
+KASEC = 15.0
+# Broker-less mode : drop an incomplete packet after RXTIMEOUT seconds of
+# silence (disabled if 0.0, 0.1 is a good value with a serial adapter)
+RXTIMEOUT = 0.0
 CHANNEL_MINIDO_NAME  = "/mu/minido"
 CHANNEL_DISPLAY_NAME = "/mu/display"
 CHANNEL_MINIDO_WRITE = "/mu/write"
@@ -81,6 +111,11 @@ CHANNEL_MINIDO_READ  = "/mu/read"
 CHANNEL_MINIDO_LAYOUT  = "/mu/layout"
 HIST = 5
 EXIID = 0x17
+# Encoding of the packets sent to STOMP : 'json' or 'base64'
+STOMP_ENCODING = 'json'
+# Level of each logger (see mulog) : 'mu.decoder', 'mu.devices',
+# 'mu.protocol', 'mu.db'... Use DEBUG to see every packet.
+LOG_LEVELS = {'mu': 'INFO'}
 
 # Never change the following values, it's only for readability of the code:
 EXOOFFSET = 0x3B
@@ -93,11 +128,64 @@ CMD = {
     'EXO_ECHO_REQUEST': 0x49,
     'EXO_ECHO_REPLY': 0x05,
     }
+D2000 = 0x0B
 DST = 1
 SRC = 2
 LEN = 3
 COM = 4
 
+log = logging.getLogger('mu.decoder')
+
+def address_class(address):
+    """ Class of a bus address : 'EXO', 'EXI', 'D2000' or None """
+    if EXOOFFSET < address <= EXOOFFSET + 16:
+        return 'EXO'
+    if EXIOFFSET < address <= EXIOFFSET + 16:
+        return 'EXI'
+    if address == D2000:
+        return 'D2000'
+    return None
+
+ADDRESS_CLASS = tuple([address_class(address) for address in range(256)])
+ADDRESS_CLASSES = ('EXO', 'EXI', 'D2000', None)
+
+# Packet kinds : (destination class, source class, command) -> handler,
+# see MinidoProtocolDecoder.handle_<kind>.
+# None as source class or command matches what is not listed.
+PACKET_KINDS = {
+    ('EXO', None, CMD['EXO_UPDATE']): 'exo_update',
+    ('EXO', None, CMD['EXO_ECHO_REQUEST']): 'exo_echo_request',
+    ('EXO', None, None): 'ignore',
+    ('EXI', 'EXO', CMD['EXO_ECHO_REPLY']): 'exo_echo_reply',
+    ('EXI', 'EXO', None): 'exo2exi_unknown',
+    ('EXI', None, CMD['EXI_ECHO_REQUEST']): 'exi_echo_request',
+    ('EXI', None, CMD['EXI_ECHO_REPLY']): 'exi_echo_reply',
+    ('EXI', None, None): 'exi_unknown',
+    ('D2000', None, CMD['EXICENT']): 'd2000_button',
+    ('D2000', None, None): 'ignore',
+    (None, None, None): 'unknown',
+    }
+
+def build_dispatch():
+    """
+    Expand PACKET_KINDS to every (destination class, source class, command)
+    so that a packet is classified with a single lookup.
+    """
+    table = dict()
+    for dstclass in ADDRESS_CLASSES:
+        for srcclass in ADDRESS_CLASSES:
+            for cmd in range(256):
+                for key in ((dstclass, srcclass, cmd),
+                        (dstclass, srcclass, None),
+                        (dstclass, None, cmd),
+                        (dstclass, None, None)):
+                    if key in PACKET_KINDS:
+                        table[(dstclass, srcclass, cmd)] = PACKET_KINDS[key]
+                        break
+    return table
+
+DISPATCH = build_dispatch()
+
 class WebService(xmlrpc.XMLRPC):
     """
     Gather all methods exposed through the XML-RPC web service
@@ -116,14 +204,18 @@ class WebService(xmlrpc.XMLRPC):
                 int(output), int(value))
         except(KeyError):
             pass
+        except(ValueError) as error:
+            raise xmlrpc.Fault(1, str(error))
         return(newdata)
         xmlrpc_set_output.signature = [['int', 'int', 'string', 
             'int', 'string']]
 
     def xmlrpc_get_output(self, exo, output):
-        """ Get the value of an output """
+        """ Get the value of an output, UNKNOWN (-1) until it is known """
         try:
-            return(self.morbidq_factory.mpd.exodict[exo].status(output))
+            value = self.morbidq_factory.mpd.exodict[exo].get_output(
+                int(output))
+            return(UNKNOWN if value is None else value)
         except(KeyError):
             return('No such exo in memory')
         return('Unexpected Error')
@@ -141,18 +233,18 @@ class WebService(xmlrpc.XMLRPC):
         """ Set an exo output in Learn, Delete or stop Learn/Delete mode."""
         data = list()
         if mode == "add":
-            print('Entering learning mode (add) for exo ' + str(exo)
-                + ' output ' + str(output))
+            log.info('Entering learning mode (add) for exo %s output %s',
+                exo, output)
             #data.append( 0x01 )
             data = [0x01]
         elif mode == "cancel":
-            print('Cancelling learn or delete mode for exo ' + str(exo)
-                + ' output ' + str(output))
+            log.info('Cancelling learn or delete mode for exo %s output %s',
+                exo, output)
             #data.append( 0x00 )
             data = [0x00]
         elif mode == "remove":
-            print('Entering delete mode (remove) for exo ' + str(exo)
-                + ' output ' + str(output))
+            log.info('Entering delete mode (remove) for exo %s output %s',
+                exo, output)
             #data.append( 0x02 )
             data = [0x02]
         data.append( exo )
@@ -160,19 +252,20 @@ class WebService(xmlrpc.XMLRPC):
         data.append( 0x00 )
         self.exilist = [0x14, 0x15, 0x16, 0x18]
         for exi in self.exilist:
-            self.morbidq_factory.mpd.send_command( exi, 0x31, data )
+            self.morbidq_factory.mpd.send_command( exi, 0x31, data,
+                priority='interactive' )
         return(0)
 
     def xmlrpc_set_device_on(self, devid):
         """ Update the device status """
-        print(self.morbidq_factory.mpd.devdict[devid])
+        log.debug('%s', self.morbidq_factory.mpd.devdict[devid])
         if self.morbidq_factory.mpd.devdict[devid].type_ == "Light":
             self.morbidq_factory.mpd.devdict[devid].on()
         return('Ok')
 
     def xmlrpc_set_device_off(self, devid):
         """ Update the device status """
-        print(self.morbidq_factory.mpd.devdict[devid])
+        log.debug('%s', self.morbidq_factory.mpd.devdict[devid])
         if self.morbidq_factory.mpd.devdict[devid].type_ == "Light":
             self.morbidq_factory.mpd.devdict[devid].off()
         return('Ok')
@@ -183,39 +276,212 @@ class WebService(xmlrpc.XMLRPC):
 
     def xmlrpc_get_device_dict(self):
         """ Get list of devices """
-        print("Get list of devices from devdict")
+        log.debug('Get list of devices from devdict')
         result = dict()
         for key in self.morbidq_factory.mpd.devdict.keys():
             result[key] = str(self.morbidq_factory.mpd.devdict[key])
-        print(result)
+        log.debug('%s', result)
         return(result)
 
+    def xmlrpc_get_state_snapshot(self, since_version=-1, boot=''):
+        """
+        State of the whole installation in one call :
+        {'version': v, 'boot': b, 'exo': {'1': [8 outputs], ...},
+        'devices': {devid: value}}, UNKNOWN (-1) for what is not known
+        yet. The version grows at each change : give it back as
+        since_version, with boot, to get only {'version': v, 'boot': b,
+        'unchanged': True} if nothing changed since.
+        """
+        mpd = self.morbidq_factory.mpd
+        if since_version == mpd.exodict.store.version and (not boot
+                or boot == mpd.boot):
+            return(dict(version=since_version, boot=mpd.boot,
+                unchanged=True))
+        return(mpd.state_snapshot())
+
+    def xmlrpc_get_nextevent(self, since=-1, timeout=LONGPOLL_TIMEOUT):
+        """
+        Changes after the sequence since (-1 : from now) : {'events':
+        [[seq, dtime, type, busid, channel, value, old], ...], 'seq': last
+        sequence, 'lost': True if some were dropped from the ring}. Waits
+        up to timeout seconds for the next change if there is none yet.
+        Call again with the seq returned.
+        """
+        return(self.morbidq_factory.mpd.events.wait(int(since),
+            float(timeout)))
+
+    def xmlrpc_list_scenes(self):
+        """ {name: {'description':, 'targets': [[devid, value], ...]}} """
+        return(self.morbidq_factory.mpd.mydb.get_scenes())
+
+    def xmlrpc_apply_scene(self, name):
+        """
+        Set the outputs of all the devices of a scene, with at most one
+        EXO_UPDATE per EXO. Returns the number of EXO_UPDATE once sent.
+        """
+        try:
+            return(self.morbidq_factory.mpd.apply_scene(name))
+        except KeyError:
+            raise xmlrpc.Fault(1, 'No such scene : {0}'.format(name))
+        except ValueError as error:
+            raise xmlrpc.Fault(1, str(error))
+
+    def xmlrpc_save_scene(self, name, targets, description=''):
+        """
+        Create or replace a scene, targets is [[devid, value], ...] with
+        value on, off, 0 to 255 (lights), up, down or stop (stores).
+        """
+        try:
+            return(self.morbidq_factory.mpd.mydb.save_scene(name,
+                [(str(devid), str(value)) for devid, value in targets],
+                description))
+        except ValueError as error:
+            raise xmlrpc.Fault(1, str(error))
+
+    def xmlrpc_delete_scene(self, name):
+        """ Delete a scene, returns 0 if it does not exist """
+        return(self.morbidq_factory.mpd.mydb.delete_scene(name))
+
+    def xmlrpc_get_rule_stats(self):
+        """ Counters of the rules and time spent (see RuleEngine.stats) """
+        return(self.morbidq_factory.mpd.rules.stats())
+
+    def xmlrpc_reload_rules(self):
+        """ Read the rules again after a change of the rule tables """
+        mpd = self.morbidq_factory.mpd
+        return(mpd.rules.load(mpd.mydb.load_rules()))
+
     def xmlrpc_get_device_details(self):
         """ List devices from DB """
-        print("Get list of devices from DB")
+        log.debug('Get list of devices from DB')
         return(self.morbidq_factory.mpd.mydb.get_device_details())
 
+    def xmlrpc_get_history(self, exo, output, start='', end='',
+            limit=HISTORY_PAGE, cursor=''):
+        """
+        History of an output between start and end ('YYYY-MM-DD
+        HH:MM:SS', '' : no limit), by pages of at most limit changes :
+        {'rows': [[dtime, status], ...], 'cursor': ...}. Call again with
+        the cursor returned until it is ''.
+        """
+        if start:
+            start = str(usage.parse_dtime(start))
+        if end:
+            end = str(usage.parse_dtime(end))
+        return(self.morbidq_factory.mpd.mydb.get_history(int(exo),
+            int(output), start, end, limit, cursor))
+
+    def xmlrpc_get_usage(self, exo, output, period='hour', start=None,
+            end=None):
+        """
+        Usage of an output per hour or day between start and end
+        ('YYYY-MM-DD HH:MM:SS', by default the last day or week) : list of
+        {'start', 'ontime' (seconds on), 'switches', 'status' (at the
+        end of the period)}
+        """
+        if period not in ('hour', 'day'):
+            raise xmlrpc.Fault(1, 'period must be hour or day')
+        end = usage.parse_dtime(end) if end else datetime.datetime.now()
+        if start:
+            start = usage.parse_dtime(start)
+        elif period == 'hour':
+            start = end - datetime.timedelta(days=1)
+        else:
+            start = end - datetime.timedelta(days=7)
+        result = list()
+        for bucket, ontime, switches, status in \
+                self.morbidq_factory.mpd.mydb.usage.query(int(exo),
+                int(output), period, start, end):
+            row = dict(start=bucket, ontime=ontime, switches=switches)
+            if status is not None:
+                row['status'] = int(status)
+            result.append(row)
+        return(result)
+
+    def xmlrpc_get_ontime(self, exo, output, start, end=None):
+        """ Seconds an output was on between start and end (to the hour) """
+        end = usage.parse_dtime(end) if end else datetime.datetime.now()
+        return(self.morbidq_factory.mpd.mydb.usage.ontime(int(exo),
+            int(output), usage.parse_dtime(start), end))
+
+    def xmlrpc_rebuild_usage(self):
+        """ Compute the usage aggregates again from the history """
+        return(self.morbidq_factory.mpd.mydb.usage.rebuild())
+
+    def xmlrpc_get_db_stats(self):
+        """ Backpressure metrics of the DB writer (see DbWriter.stats) """
+        return(self.morbidq_factory.mpd.mydb.writer.stats())
+
+    def xmlrpc_reload_devices(self):
+        """ Read the devices again after a change of the device tables """
+        mpd = self.morbidq_factory.mpd
+        mpd.mydb.invalidate_registry()
+        mpd.devdict = mpd.mydb.populate_devdict(mpd.exodict)
+        # The device values of the snapshot change too
+        mpd.exodict.store.version += 1
+        log.info('Devices reloaded : %i devices', len(mpd.devdict))
+        return(len(mpd.devdict))
+
+
+class SystemService(xmlrpc.XMLRPCIntrospection):
+    """
+    The system. methods of the WebService : the introspection, and
+    system.multicall to make many calls in one HTTP request.
+    """
+    def xmlrpc_multicall(self, calls):
+        """
+        Make a list of calls [{'methodName': name, 'params': [...]}, ...]
+        in order, returns [[result] or {'faultCode', 'faultString'}, ...].
+        The calls returning a Deferred are waited for.
+        """
+        if len(calls) > MULTICALL_MAX:
+            raise xmlrpc.Fault(self.FAILURE,
+                'At most {0} calls per multicall'.format(MULTICALL_MAX))
+        results = list()
+        for call in calls:
+            try:
+                name = call['methodName']
+                if name == 'system.multicall':
+                    raise xmlrpc.Fault(self.FAILURE,
+                        'system.multicall can not be nested')
+                function = self._xmlrpc_parent.lookupProcedure(name)
+                d = defer.maybeDeferred(function, *call.get('params', ()))
+            except Exception:
+                d = defer.fail()
+            results.append(d.addCallbacks(lambda result: [result],
+                self.multicall_fault))
+        return(defer.gatherResults(results))
+
+    def multicall_fault(self, failure):
+        """ Fault of one call, as XMLRPC.render would send it """
+        fault = failure.value
+        if not isinstance(fault, xmlrpc.Fault):
+            log.error('multicall : %s', failure.getTraceback())
+            fault = xmlrpc.Fault(self.FAILURE, 'error')
+        return(dict(faultCode=fault.faultCode, faultString=fault.faultString))
+
 
 class MorbidQClientFactory(StompClientFactory):
     def recv_connected(self, msg):
         self.subscribe(CHANNEL_DISPLAY_NAME)
         self.subscribe(CHANNEL_MINIDO_READ)
         self.subscribe(CHANNEL_MINIDO_LAYOUT)
-        self.subscribe(CHANNEL_xPL)
         # mpd is reinitialized at every STOMP server reconnection
         self.mpd = MinidoProtocolDecoder(self.send_data)
 
     def recv_message(self, msg):
-        message = json.decode(msg['body'])
+        message = stompcodec.decode(msg)
         if msg['headers']['destination'] == CHANNEL_DISPLAY_NAME:
-            print(message)
+            log.debug('%s', message)
             if 'ButtonClicked' in message and message['ButtonClicked'] == '1':
                 self.send_data({'ButtonClicked': '2'})
             if 'ListGroups' in message and message['ListGroups'] == '1':
                 self.send_data({'Group1': 'RDC', 
                     'Group2': 'Etage', 'Group3': 'Grenier'})
         elif msg['headers']['destination'] == CHANNEL_MINIDO_READ:
-            self.mpd.recv_minido_packet(message)
+            # A single packet, or a batch from the RS485 bridge
+            for packet in stompcodec.packets(message):
+                self.mpd.recv_minido_packet(packet)
         elif msg['headers']['destination'] == CHANNEL_MINIDO_LAYOUT:
             if 'query' in message.keys():
                 if message['query'] == 'getLayout':
@@ -225,9 +491,19 @@ class MorbidQClientFactory(StompClientFactory):
                     self.send(CHANNEL_MINIDO_LAYOUT, 
                         json.encode({'status': 'This is a status line'}))
  
-    def send_data(self, data):
-        print("Sending : " + str(data))
-        self.send(CHANNEL_MINIDO_WRITE, json.encode(data))
+    def send_data(self, data, priority='normal'):
+        """
+        priority is the transmit class on the bus :
+        interactive, normal or background (see MinidoProtocol)
+        Returns a Deferred fired with True once the packet is handed to
+        the broker : the RS485 bridge queues it, when it is written on the
+        bus is not known here.
+        """
+        log.debug('Sending : %s', data)
+        body, headers = stompcodec.encode(data, STOMP_ENCODING)
+        headers['priority'] = priority
+        self.send(CHANNEL_MINIDO_WRITE, body, **headers)
+        return defer.succeed(True)
 
     def clientConnectionLost(self, connector, reason):
         time.sleep(1.0)
@@ -238,15 +514,105 @@ class MorbidQClientFactory(StompClientFactory):
         for key in devdict.keys():
             id_ = key
             floor = devdict[key].floor
-            room = 
+            room = devdict[key].room
             name = devdict[key].name
             functions = list()
-            for f in dir(devdict[key])
+            for f in dir(devdict[key]):
                 pass
         return res
 
+
+class MinidoDirectFactory(ReconnectingClientFactory):
+    """
+    Broker-less mode : the bus adapter connection feeds the
+    MinidoProtocolDecoder directly, without the RS485 bridge and STOMP.
+    send_data is the same internal transport interface as
+    MorbidQClientFactory.send_data, so Exo and the decoder do not see the
+    difference. If a mirror (MorbidQMirrorFactory) is set, the bus traffic
+    is also published on STOMP for external listeners.
+    capture is an optional minidocapture.CaptureWriter for the bus traffic.
+    """
+    def __init__(self, mirror=None, capture=None):
+        self.connections = list()
+        self.mirror = mirror
+        self.capture = capture
+        self.mpd = None
+
+    def buildProtocol(self, addr):
+        log.info('Connected to the bus adapter.')
+        self.resetDelay()
+        # mpd is reinitialized at every bus adapter reconnection,
+        # once the connection is made so that the EXI scan is sent.
+        reactor.callLater(0, self.init_decoder)
+        return MinidoProtocol(self, KASEC, rxtimeout=RXTIMEOUT,
+            capture=self.capture)
+
+    def init_decoder(self):
+        self.mpd = MinidoProtocolDecoder(self.send_data)
+
+    def clientConnectionLost(self, connector, reason):
+        log.info('Lost connection to the bus adapter. Reason: %s', reason)
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        log.warning('Connection to the bus adapter failed. Reason: %s',
+            reason)
+        ReconnectingClientFactory.clientConnectionFailed(self, connector,
+                                                         reason)
+
+    def recv_message(self, data):
+        """ Called by MinidoProtocol for every valid packet """
+        # mpd is None until the first connection, and still being built
+        # while it sends its first EXI scan packet.
+        if self.mpd is not None:
+            self.mpd.recv_minido_packet(data)
+        if self.mirror is not None:
+            self.mirror.publish(data)
+
+    def send_data(self, data, priority='normal'):
+        """
+        priority is the transmit class on the bus :
+        interactive, normal or background (see MinidoProtocol)
+        Returns a Deferred fired with True when the packet is written on
+        the bus, False if it is not (no connection, dropped).
+        """
+        log.debug('Sending : %s', HexData(data))
+        sent = [conn.send_data(data, priority) for conn in self.connections]
+        # Like the RS485 bridge, copy it for the decoder and the listeners.
+        self.recv_message(data)
+        return defer.gatherResults(sent).addCallback(any)
+
+
+class MorbidQMirrorFactory(StompClientFactory):
+    """
+    STOMP side of the broker-less mode : publish the bus traffic on
+    /mu/read, and forward /mu/write to the bus like the RS485 bridge.
+    """
+    connected = False
+
+    def recv_connected(self, msg):
+        self.connected = True
+        self.subscribe(CHANNEL_MINIDO_WRITE)
+
+    def recv_message(self, msg):
+        if msg['headers']['destination'] == CHANNEL_MINIDO_WRITE:
+            message = stompcodec.decode(msg)
+            priority = msg['headers'].get('priority', 'normal')
+            for packet in stompcodec.packets(message):
+                self.minido_factory.send_data(packet, priority)
+
+    def publish(self, data):
+        if self.connected:
+            body, headers = stompcodec.encode(data, STOMP_ENCODING)
+            self.send(CHANNEL_MINIDO_READ, body, **headers)
+
+    def clientConnectionLost(self, connector, reason):
+        self.connected = False
+        time.sleep(1.0)
+        reactor.connectTCP(MORBIDQ_HOST, MORBIDQ_PORT, self)
+
  
-class MinidoProtocolDecoder():
+class MinidoProtocolDecoder(object):
     """ 
     AnB protocol (high level), also used for Minido, D2000 and C2000 
     The constructor builds exodict and devdict from mydb.populate...
@@ -263,146 +629,188 @@ class MinidoProtocolDecoder():
     _instance = None
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
-            cls._instance = super(MinidoProtocolDecoder, cls).__new__(cls, 
-                *args, **kwargs)
+            cls._instance = super(MinidoProtocolDecoder, cls).__new__(cls)
         return cls._instance
 
     def __init__(self, send_data):
         # FixMe
         # Remove the self and the SQLITEDB from the constructor
         self.mydb = Db()
-        print('Creating exodict...')
+        log.info('Creating exodict...')
         self.send_data = send_data
-        self.exodict = Exodict(self.send_data)
-        print('Creating exidict...')
+        # Kept across the reconnections : the waiting clients and the
+        # sequence go on.
+        if not hasattr(self, 'events'):
+            self.events = EventLog()
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                self.events.close)
+        self.exodict = Exodict(self.send_data, self.events)
+        log.info('Creating exidict...')
         self.exidict = dict()
-        print('Creating devdict...')
+        log.info('Creating devdict...')
         self.devdict = self.mydb.populate_devdict(self.exodict)
-        print('MinidoProtocolDecoder Singleton initialized')
+        log.info('Loading rules...')
+        # The counters of the rules are kept across the reconnections
+        if not hasattr(self, 'rules'):
+            self.rules = RuleEngine(self)
+        self.rules.load(self.mydb.load_rules())
+        # Start of this process, tells the clients of get_state_snapshot
+        # that the versions started again (not changed by a reconnection).
+        if not hasattr(self, 'boot'):
+            self.boot = str(datetime.datetime.now())
+        self.snapshot = None
+        self.dispatch = dict([(key, getattr(self, 'handle_' + kind))
+            for key, kind in DISPATCH.items()])
+        log.info('MinidoProtocolDecoder Singleton initialized')
         self.scan_exi()
         # self.scan_exo()
 
+    def state_snapshot(self):
+        """
+        State of the EXO outputs and of the devices (see
+        WebService.xmlrpc_get_state_snapshot), built once per version.
+        """
+        store = self.exodict.store
+        if self.snapshot is None or self.snapshot['version'] != store.version:
+            version = store.version
+            devices = dict()
+            for devid, device in self.devdict.items():
+                value = device.get_value()
+                devices[str(devid)] = UNKNOWN if value is None else value
+            self.snapshot = dict(version=version, boot=self.boot,
+                exo=dict([(str(exoid), store.exo_outputs(exoid))
+                    for exoid in self.exodict]),
+                devices=devices)
+        return self.snapshot
+
+    def apply_scene(self, name):
+        """
+        Send the outputs of a scene (see Db.get_scene_frames) : one
+        EXO_UPDATE per EXO, all queued at once. The stores moved are
+        stopped after STORE_RUN seconds. Returns a Deferred fired with
+        the number of EXO_UPDATE.
+        """
+        frames, stops = self.mydb.get_scene_frames(name)
+        log.info('Scene %s : %i EXO to update', name, len(frames))
+        # The stops are the timers of the StoreDevice, so that a later
+        # move of the store (by hand or by a scene) cancels them.
+        stores = dict()
+        for device in self.devdict.values():
+            if device.type_ == 'Store':
+                stores[(device.exoup.exoid, device.channelup)] = device
+                stores[(device.exodown.exoid, device.channeldown)] = device
+        for exo, outputs in frames.items():
+            for channel in outputs:
+                if (exo, channel) in stores:
+                    stores[(exo, channel)].cancel()
+        for exo, outputs in stops.items():
+            for channel in outputs:
+                if (exo, channel) in stores:
+                    stores[(exo, channel)].stop_later(self.exodict[exo],
+                        channel)
+                else:
+                    reactor.callLater(STORE_RUN, self.exodict[exo].set_output,
+                        channel, 0)
+        d = self.set_exo_outputs(frames)
+        return d.addCallback(lambda results: len(results))
+
+    def set_exo_outputs(self, frames):
+        """ Set the outputs {exo: {channel: value}} of several EXO """
+        return defer.gatherResults([self.exodict[exo].set_outputs(outputs)
+            for exo, outputs in sorted(frames.items())])
+
     def recv_minido_packet(self, message):
         """
         Called when a new packet is validated by the protocol (low level).
-        This methods decodes the packet
+        This methods decodes the packet : it is classified by the class of
+        its destination and source, and its command, and handed to the
+        handle_<kind> method found in PACKET_KINDS.
         """
-        print(' '.join(['{0:02x}'.format(x) for x in message]))
-        if EXOOFFSET < message[DST] <= EXOOFFSET + 16:
-            # This is a packet for an EXO module : EXI2EXO
-            # No need of additional test as EXO2EXO does not exists.
-            exoid = message[DST] - EXOOFFSET
-            exiid = message[SRC] - EXIOFFSET
-            # EXO_UPDATE :
-            # We must call the exo to check if a change occured.
-            if message[COM] == CMD['EXO_UPDATE']:
-                try:
-                    list_of_changes = self.exodict[exoid].update(exiid, 
-                        message[5:-1])
-                    for change in list_of_changes:
-                        print( ('{0!s:.23} : EXI-{1:02}->EXO-{2:02} : ' + \
-                            'Output {3:1} = {4:3}  ( was {5:3})').format(
-                            datetime.datetime.now(),
-                            exiid, exoid,
-                            change[0],
-                            change[1],
-                            change[2]
-                            ))
-                except(KeyError):
-                    print("This should never happen : all EXO are created")
-            elif message[COM] == CMD['EXO_ECHO_REQUEST']:
-                print( ('{0!s:.23} : EXI-{1:02}->EXO-{2:02} : ' + \
-                    'EXI2EXO_ECHO_REQUEST').format(
-                    datetime.datetime.now(),
-                    exiid, exoid,
-                    ))
-                # Nothing more to do, as it's probably comming from us.
-
-        elif EXIOFFSET < message[DST] <= EXIOFFSET + 16:
-            # This is a packet to an EXI module
-            exiid = message[DST] - EXIOFFSET
-            if EXOOFFSET < message[SRC] <= EXOOFFSET + 16:
-                # From an EXO module : EXO2EXI
-                exoid = message[SRC] - EXOOFFSET
-                # EXO_ECHO_REPLY
-                if message[COM] == CMD['EXO_ECHO_REPLY']:
-                    print( ( '{0!s:.23} : EXO-{1:02}->MU ' +
-                        'EXO2EXI_ECHO_REPLY').format(
-                        datetime.datetime.now(),
-                        exoid
-                        ))
-                    self.exodict[exoid].is_present = True
-                else:
-                    print('Problem here. AFAIK an EXO never send anything \
-                        to EXI except for EXO_ECHO_REPLY')
-                    print('{0!s:.23} : EXO-{2:02}->EXI-{1:02} : \
-                        CMD:{3:2} DATA:{4!s:10}'.format(
-                        datetime.datetime.now(),
-                        exiid,exoid,
-                        message[COM],
-                        message[5:-1]
-                        ))
-            else:
-                # From an EXI module : EXI2EXI
-                if message[COM] == CMD['EXI_ECHO_REQUEST']:
-                    print( '{0!s:.23} : EXI-{2:02}->EXI-{1:02} : \
-                        EXI2EXI_ECHO_REQUEST'.format(
-                        datetime.datetime.now(),
-                        message[DST] - EXIOFFSET,
-                        message[SRC] - EXIOFFSET,
-                        ))
-                elif message[COM] == CMD['EXI_ECHO_REPLY']:
-                    srcexiid = message[SRC] - EXIOFFSET
-                    print( '{0!s:.23} : EXI-{2:02}->EXI-{1:02} : \
-                        EXI2EXI_ECHO_REPLY'.format(
-                        datetime.datetime.now(),
-                        message[DST] - EXIOFFSET,
-                        srcexiid,
-                        ))
-                    self.exidict[srcexiid] = Exi(self.send_data)
-                else:
-                    print( '{0!s:.23} : SRC-{2:02}->EXI-{1:02} : \
-                        CMD:{3:2} DATA:{4!s:10}'.format(
-                        datetime.datetime.now(),
-                        message[DST] - EXIOFFSET,
-                        message[SRC],
-                        message[COM],
-                        message[5:-1]
-                        ))
-        elif message[DST] == 0x0b:
-            # This is a packet for the D2000
-            if message[COM] == CMD['EXICENT'] and \
-                message[SRC]-EXIOFFSET == message[5:-1][0]:
-                # This is packet normally used by D2000
-                # The EXI info is twice in the packet, 
-                # that's why we make the second check.
-                print( ( '{0!s:.23} : EXI-{1:02}->D-2000 : ' +
-                    'Button {2:2}').format(
-                    datetime.datetime.now(),
-                    message[SRC]-EXIOFFSET,
-                    message[6],
-                    ))
-        else:
-            print( ( '{0!s:.23} : SRC-{2:02x}->DST-{1:02x} : ' +
-                'Unable to decode - ' +
-                'CMD (hex):{3:02x} DATA (hex):{4!s:10}' ).format(
-                datetime.datetime.now(),
-                message[DST],
-                message[SRC],
-                message[COM],
-                ' '.join(['{0:02x}'.format(x) 
-                    for x in message[5:-1]])
-                ))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s', HexData(message))
+        self.dispatch[(ADDRESS_CLASS[message[DST]],
+            ADDRESS_CLASS[message[SRC]], message[COM])](message)
+
+    def handle_exo_update(self, message):
+        """
+        This is a packet for an EXO module : EXI2EXO
+        No need of additional test as EXO2EXO does not exists.
+        We must call the exo to check if a change occured.
+        """
+        exoid = message[DST] - EXOOFFSET
+        exiid = message[SRC] - EXIOFFSET
+        try:
+            list_of_changes = self.exodict[exoid].update(exiid,
+                message[5:-1])
+        except(KeyError):
+            log.error("This should never happen : all EXO are created")
+            return
+        for change in list_of_changes:
+            log.info('EXI-%02d->EXO-%02d : Output %1d = %3d  ( was %3s)',
+                exiid, exoid, change[0], change[1], change[2])
+            self.rules.event('EXO', exoid, change[0], change[1])
+
+    def handle_exo_echo_request(self, message):
+        # Nothing more to do, as it's probably comming from us.
+        log.debug('EXI-%02d->EXO-%02d : EXI2EXO_ECHO_REQUEST',
+            message[SRC] - EXIOFFSET, message[DST] - EXOOFFSET)
+
+    def handle_exo_echo_reply(self, message):
+        exoid = message[SRC] - EXOOFFSET
+        log.debug('EXO-%02d->MU EXO2EXI_ECHO_REPLY', exoid)
+        self.exodict[exoid].is_present = True
+
+    def handle_exo2exi_unknown(self, message):
+        log.warning('EXO-%02d->EXI-%02d : CMD:%2d DATA:%s : '
+            'AFAIK an EXO never send anything to EXI '
+            'except for EXO_ECHO_REPLY',
+            message[SRC] - EXOOFFSET, message[DST] - EXIOFFSET,
+            message[COM], message[5:-1])
+
+    def handle_exi_echo_request(self, message):
+        log.debug('EXI-%02d->EXI-%02d : EXI2EXI_ECHO_REQUEST',
+            message[SRC] - EXIOFFSET, message[DST] - EXIOFFSET)
+
+    def handle_exi_echo_reply(self, message):
+        srcexiid = message[SRC] - EXIOFFSET
+        log.debug('EXI-%02d->EXI-%02d : EXI2EXI_ECHO_REPLY',
+            srcexiid, message[DST] - EXIOFFSET)
+        if srcexiid not in self.exidict:
+            self.exidict[srcexiid] = Exi(self.send_data)
+
+    def handle_exi_unknown(self, message):
+        log.info('SRC-%02d->EXI-%02d : CMD:%2d DATA:%s',
+            message[SRC], message[DST] - EXIOFFSET,
+            message[COM], message[5:-1])
+
+    def handle_d2000_button(self, message):
+        # This is packet normally used by D2000
+        # The EXI info is twice in the packet, 
+        # that's why we make the second check.
+        if message[SRC] - EXIOFFSET == message[5]:
+            log.info('EXI-%02d->D-2000 : Button %2d',
+                message[SRC] - EXIOFFSET, message[6])
+            self.rules.event('EXI', message[SRC] - EXIOFFSET, message[6])
+
+    def handle_ignore(self, message):
+        pass
+
+    def handle_unknown(self, message):
+        log.info('SRC-%02x->DST-%02x : Unable to decode - '
+            'CMD (hex):%02x DATA (hex):%s',
+            message[SRC], message[DST], message[COM],
+            HexData(message[5:-1]))
 
     def send_packet(self, data):
         self.send_data(data)
 
-    def send_command(self, dst, cmd, cmd_data = list(), src = EXIID):
+    def send_command(self, dst, cmd, cmd_data = list(), src = EXIID,
+            priority = 'normal'):
         """
         This is a helper to build packet.
         """
         packet = [ 35, dst, src, len(cmd_data) + 2, cmd ] + cmd_data
-        self.send_data(packet)
+        self.send_data(packet, priority)
 
     def scan_exo(self):
         self.d = defer.Deferred()
@@ -411,7 +819,8 @@ class MinidoProtocolDecoder():
             if self.exo >= 16:
                 self.loop.stop()
                 self.d.callback(None)
-            self.send_command(self.exo + EXOOFFSET, CMD['EXO_ECHO_REQUEST'])
+            self.send_command(self.exo + EXOOFFSET, CMD['EXO_ECHO_REQUEST'],
+                priority='background')
             self.exo += 1
         self.loop = LoopingCall(scanNext)
         self.loop.start(0.1)
@@ -430,17 +839,42 @@ class MinidoProtocolDecoder():
                 self.exid.callback(None)
             packet = [35, 00, 11, 2, CMD['EXI_ECHO_REQUEST']]
             packet[1] = self.exi + EXIOFFSET
-            self.send_command(self.exi + EXIOFFSET, CMD['EXI_ECHO_REQUEST'])
+            self.send_command(self.exi + EXIOFFSET, CMD['EXI_ECHO_REQUEST'],
+                priority='background')
             self.exi += 1
         self.exiloop = LoopingCall(scanNext)
         self.exiloop.start(0.1)
 
-if __name__ == '__main__':
-    from twisted.internet import reactor
-    morbidq_factory = MorbidQClientFactory()
+def mu_main():
+    mulog.setup(LOG_LEVELS)
     ws = WebService()
-    ws.morbidq_factory = morbidq_factory
-    xmlrpc.addIntrospection(ws)
-    reactor.listenTCP( 8000, server.Site(ws) )
-    reactor.connectTCP(MORBIDQ_HOST, MORBIDQ_PORT, morbidq_factory)
+    if DIRECT_MODE:
+        minido_factory = MinidoDirectFactory()
+        if CAPTURE_FILE:
+            minido_factory.capture = CaptureWriter(CAPTURE_FILE)
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                minido_factory.capture.close)
+        # The web service only needs the factory holding mpd.
+        ws.morbidq_factory = minido_factory
+        if MINIDO_SERIAL_DEVICE:
+            from minido.minidoserial import SerialClient
+            SerialClient(minido_factory, MINIDO_SERIAL_DEVICE,
+                MINIDO_SERIAL_BAUDRATE, MINIDO_SERIAL_TIMEOUT).startService()
+        else:
+            reactor.connectTCP(MINIDO_ADAPTER_HOST, MINIDO_ADAPTER_PORT,
+                minido_factory)
+        if STOMP_MIRROR:
+            mirror = MorbidQMirrorFactory()
+            mirror.minido_factory = minido_factory
+            minido_factory.mirror = mirror
+            reactor.connectTCP(MORBIDQ_HOST, MORBIDQ_PORT, mirror)
+    else:
+        morbidq_factory = MorbidQClientFactory()
+        ws.morbidq_factory = morbidq_factory
+        reactor.connectTCP(MORBIDQ_HOST, MORBIDQ_PORT, morbidq_factory)
+    ws.putSubHandler('system', SystemService(ws))
+    reactor.listenTCP( XMLRPC_PORT, server.Site(ws) )
     reactor.run()
+
+if __name__ == '__main__':
+    mu_main()
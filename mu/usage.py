@@ -0,0 +1,277 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Usage aggregates of the EXO outputs, per hour and per day, in the
+    tables usage_hour and usage_day (see the migrations of db.py) :
+        start      : start of the hour or day, same format as history.dtime
+        ontime     : seconds with the output on (status != 0)
+        switches   : changes of the output
+        laststatus : status of the output at the end of the period, or
+                     at the last change
+    The time between two changes of an output is counted when the second
+    one is recorded (Usage.record), in the periods it spans. The deltas
+    are merged in memory and written every FLUSH_DELAY seconds, in a
+    single call of the DbWriter. The current state is added by
+    Usage.query, without being stored.
+    rebuild() computes the tables again from the whole history.
+"""
+
+import datetime
+import logging
+from twisted.internet import reactor
+
+PERIODS = ('hour', 'day')
+# The deltas of the changes are written every FLUSH_DELAY seconds
+FLUSH_DELAY = 0.5
+USAGE_INSERT = ('INSERT OR IGNORE INTO usage_{0} (start, exo, channel, '
+    'ontime, switches) VALUES (?, ?, ?, 0, 0)')
+USAGE_UPDATE = ('UPDATE usage_{0} SET ontime = ontime + ?, '
+    'switches = switches + ?, laststatus = ? '
+    'WHERE start = ? AND exo = ? AND channel = ?')
+USAGE_SELECT = ('SELECT start, ontime, switches, laststatus FROM usage_{0} '
+    'WHERE exo = ? AND channel = ? AND start >= ? AND start < ? '
+    'ORDER BY start')
+
+log = logging.getLogger('mu.usage')
+
+
+def parse_dtime(value):
+    """
+    datetime of a history.dtime (stored as str(datetime)) :
+    'YYYY-MM-DD HH:MM:SS[.ffffff]', or 'YYYY-MM-DD'
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    if len(value) == 10:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    # Much faster than strptime, for rebuild()
+    return datetime.datetime(int(value[0:4]), int(value[5:7]),
+        int(value[8:10]), int(value[11:13]), int(value[14:16]),
+        int(value[17:19]), int(value[20:26].ljust(6, '0') or 0))
+
+
+def period_start(dtime, period):
+    if period == 'hour':
+        return dtime.replace(minute=0, second=0, microsecond=0)
+    return dtime.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def period_end(start, period):
+    if period == 'hour':
+        return start + datetime.timedelta(hours=1)
+    return start + datetime.timedelta(days=1)
+
+
+def split(start, end, period):
+    """ Yield (period start, seconds) of the time between start and end """
+    current = period_start(start, period)
+    while current < end:
+        following = period_end(current, period)
+        seconds = (min(end, following) - max(start, current)).total_seconds()
+        if seconds > 0.0:
+            yield current, seconds
+        current = following
+
+
+def changes(since, dtime, laststatus, status):
+    """
+    Contributions of a change of an output, at dtime to status, the
+    previous one being at since to laststatus (since is None if unknown).
+    Returns {period: [(start, ontime, switches, laststatus)]} in time
+    order.
+    """
+    result = dict()
+    for period in PERIODS:
+        rows = list()
+        if since is not None and laststatus:
+            for start, seconds in split(since, dtime, period):
+                rows.append((start, seconds, 0, laststatus))
+        rows.append((period_start(dtime, period), 0.0, 1, status))
+        result[period] = rows
+    return result
+
+
+def write(cur, deltas):
+    """
+    Add the deltas {period: {(start, exo, channel): [ontime, switches,
+    laststatus]}} to the tables (run in the DB writer thread)
+    """
+    for period, rows in deltas.items():
+        cur.executemany(USAGE_INSERT.format(period), list(rows))
+        cur.executemany(USAGE_UPDATE.format(period),
+            [total + list(key) for key, total in rows.items()])
+    return sum([len(rows) for rows in deltas.values()])
+
+
+class Usage(object):
+    """
+    Incremental update of the aggregates. record() is called for every
+    change of an EXO output, the writes go through the DbWriter.
+    """
+    def __init__(self, conn, writer):
+        self.conn = conn
+        self.writer = writer
+        # (exo, channel) : (datetime, status) of the last change
+        self.last = dict()
+        # Deltas not written yet, see write()
+        self.deltas = dict([(period, dict()) for period in PERIODS])
+        self.flushcall = None
+
+    def restore(self, exo, channel, dtime, status):
+        """ Last change of an output before the start, from the history """
+        self.last[(exo, channel)] = (parse_dtime(dtime), status)
+
+    def record(self, dtime, exo, channel, status):
+        """ An output changed to status at dtime """
+        key = (exo, channel)
+        since, laststatus = self.last.get(key, (None, None))
+        self.last[key] = (dtime, status)
+        for period, rows in changes(since, dtime, laststatus,
+                status).items():
+            deltas = self.deltas[period]
+            for start, ontime, switches, state in rows:
+                total = deltas.get((str(start), exo, channel))
+                if total is None:
+                    deltas[(str(start), exo, channel)] = [ontime, switches,
+                        state]
+                else:
+                    total[0] += ontime
+                    total[1] += switches
+                    total[2] = state
+        if self.flushcall is None:
+            self.flushcall = reactor.callLater(FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        """ Queue the deltas in the DbWriter """
+        if self.flushcall is not None and self.flushcall.active():
+            self.flushcall.cancel()
+        self.flushcall = None
+        deltas = self.deltas
+        self.deltas = dict([(period, dict()) for period in PERIODS])
+        if any(deltas.values()):
+            self.writer.call(write, deltas).addErrback(self.write_failed)
+
+    def write_failed(self, reason):
+        log.error('Usage aggregates not written : %s',
+            reason.getErrorMessage())
+
+    def rebuild(self):
+        """ Compute the tables again, see rebuild() """
+        self.flush()
+        return self.writer.call(rebuild)
+
+    def query(self, exo, channel, period, start, end, now=None):
+        """
+        Aggregates of an output between start and end (datetime) :
+        list of (start, ontime, switches, laststatus), the current state
+        of the output included.
+        """
+        rows = dict()
+        first = str(period_start(start, period))
+        for row in self.conn.execute(USAGE_SELECT.format(period),
+                [exo, channel, first, str(end)]):
+            rows[row[0]] = [row[1], row[2], row[3]]
+        # The deltas not written yet
+        for (bucket, rowexo, rowchannel), total in sorted(
+                self.deltas[period].items()):
+            if (rowexo, rowchannel) == (exo, channel) and \
+                    first <= bucket < str(end):
+                row = rows.setdefault(bucket, [0.0, 0, total[2]])
+                row[0] += total[0]
+                row[1] += total[1]
+                row[2] = total[2]
+        since, status = self.last.get((exo, channel), (None, None))
+        if since is not None:
+            now = now or datetime.datetime.now()
+            for bucket, seconds in split(since, min(now, end), period):
+                bucket = str(bucket)
+                if bucket < first:
+                    continue
+                row = rows.setdefault(bucket, [0.0, 0, status])
+                if status:
+                    row[0] += seconds
+                row[2] = status
+        return [(bucket,) + tuple(rows[bucket]) for bucket in sorted(rows)]
+
+    def ontime(self, exo, channel, start, end, now=None):
+        """ Seconds an output was on between start and end, to the hour """
+        return sum([row[1] for row in self.query(exo, channel, 'hour',
+            start, end, now)])
+
+
+def rebuild(cur):
+    """
+    Compute the usage tables again from the whole EXO history, in a
+    single pass over the history_channel_dtime index. Meant to run in
+    the DB writer thread (see DbWriter.call). Returns the number of
+    history rows read.
+    The periods are taken from the dtime strings, the time is only split
+    between periods (split()) when a change is not in the same hour as
+    the previous one.
+    """
+    totals = dict([(period, dict()) for period in PERIODS])
+    hours = totals['hour']
+    days = totals['day']
+    key = None
+    count = 0
+    read = cur.connection.cursor()
+    read.execute("SELECT busid, channel, dtime, status FROM history \
+        WHERE type = 'EXO' ORDER BY type, busid, channel, dtime")
+    for busid, channel, dtime, status in read:
+        count += 1
+        if (busid, channel) != key:
+            key = (busid, channel)
+            since = laststatus = lasthour = None
+        dtime = str(dtime)
+        moment = parse_dtime(dtime)
+        status = int(status)
+        hour = (dtime[:13] + ':00:00', busid, channel)
+        day = (dtime[:10] + ' 00:00:00', busid, channel)
+        if laststatus:
+            if hour == lasthour:
+                seconds = (moment - since).total_seconds()
+                hours[hour][0] += seconds
+                days[day][0] += seconds
+            else:
+                for period in PERIODS:
+                    table = totals[period]
+                    for start, seconds in split(since, moment, period):
+                        total = table.setdefault((str(start), busid,
+                            channel), [0.0, 0, laststatus])
+                        total[0] += seconds
+                        total[2] = laststatus
+        for table, bucket in ((hours, hour), (days, day)):
+            total = table.get(bucket)
+            if total is None:
+                table[bucket] = [0.0, 1, status]
+            else:
+                total[1] += 1
+                total[2] = status
+        since, laststatus, lasthour = moment, status, hour
+    read.close()
+    for period in PERIODS:
+        cur.execute('DELETE FROM usage_{0}'.format(period))
+        cur.executemany('INSERT INTO usage_{0} (start, exo, channel, ontime, '
+            'switches, laststatus) VALUES (?, ?, ?, ?, ?, ?)'.format(period),
+            [bucket + tuple(total)
+                for bucket, total in totals[period].items()])
+    log.info('Usage rebuilt from %i history rows', count)
+    return count
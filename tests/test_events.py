@@ -0,0 +1,95 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    EventLog of mu/events.py : reads after a sequence, lost events and
+    clients from before a restart.
+    Usage : python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'mu'))
+from events import EventLog, UNKNOWN
+
+
+def sequences(reply):
+    return [event[0] for event in reply['events']]
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log = EventLog(size=4)
+
+    def append(self, count):
+        for i in range(count):
+            self.log.append('EXO', 1, 1, i, None)
+
+    def test_empty(self):
+        reply = self.log.since(0)
+        self.assertEqual(reply, dict(events=[], seq=0, lost=False))
+
+    def test_since(self):
+        self.append(3)
+        self.assertEqual(sequences(self.log.since(0)), [1, 2, 3])
+        self.assertEqual(sequences(self.log.since(2)), [3])
+        reply = self.log.since(3)
+        self.assertEqual(reply['events'], [])
+        self.assertEqual(reply['seq'], 3)
+        self.assertFalse(reply['lost'])
+        # The old value not known yet
+        self.assertEqual(self.log.since(0)['events'][0][6], UNKNOWN)
+
+    def test_lost(self):
+        self.append(7)
+        # 1 to 3 are out of the ring
+        reply = self.log.since(1)
+        self.assertTrue(reply['lost'])
+        self.assertEqual(sequences(reply), [4, 5, 6, 7])
+        reply = self.log.since(3)
+        self.assertFalse(reply['lost'])
+        self.assertEqual(sequences(reply), [4, 5, 6, 7])
+        self.assertEqual(sequences(self.log.since(5)), [6, 7])
+
+    def test_restart(self):
+        # A client still at sequence 50 of the previous run
+        self.append(2)
+        reply = self.log.since(50)
+        self.assertEqual(sequences(reply), [1, 2])
+        self.assertEqual(reply['seq'], 2)
+        self.assertFalse(reply['lost'])
+        self.append(5)
+        reply = self.log.since(50)
+        self.assertEqual(sequences(reply), [4, 5, 6, 7])
+        self.assertTrue(reply['lost'])
+
+    def test_wait_with_events(self):
+        self.append(3)
+        replies = list()
+        self.log.wait(1).addCallback(replies.append)
+        self.assertEqual(sequences(replies[0]), [2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    ExoStore of mu/minidodevices.py : outputs and ring of the last changes.
+    Usage : python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'mu'))
+from minidodevices import ExoStore, UNKNOWN
+
+
+class ExoStoreTest(unittest.TestCase):
+
+    def test_unknown_outputs(self):
+        store = ExoStore(exos=2, hist=3)
+        self.assertEqual(store.exo_outputs(2), [UNKNOWN] * 8)
+        store.record(9, 1.0, 200)
+        self.assertEqual(store.exo_outputs(2), [UNKNOWN, 200] + [UNKNOWN] * 6)
+        for slot in range(8, 16):
+            store.record(slot, 2.0, slot)
+        self.assertEqual(store.exo_outputs(2), list(range(8, 16)))
+        self.assertEqual(store.exo_outputs(1), [UNKNOWN] * 8)
+
+    def test_ring_wraparound(self):
+        store = ExoStore(exos=2, hist=3)
+        store.record(5, 1.0, 10)
+        store.record(5, 2.0, 20)
+        self.assertEqual(store.history(5), [(1.0, 10), (2.0, 20)])
+        store.record(5, 3.0, 30)
+        store.record(5, 4.0, 40)
+        store.record(5, 5.0, 50)
+        # Only the last 3 changes, oldest first
+        self.assertEqual(store.history(5), [(3.0, 30), (4.0, 40), (5.0, 50)])
+        self.assertEqual(store.exo_outputs(1)[5], 50)
+        # The neighbour outputs are not touched
+        self.assertEqual(store.history(4), [])
+        self.assertEqual(store.history(6), [])
+
+    def test_version(self):
+        store = ExoStore(exos=1, hist=2)
+        for i in range(5):
+            store.record(0, float(i), i)
+        self.assertEqual(store.version, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Rule and RuleEngine of mu/rules.py : conditions of a trigger, and
+    reload of the rules.
+    Usage : python -m unittest discover tests
+"""
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'mu'))
+from rules import Rule, RuleEngine, parse_time
+
+# 2024-01-06 is a saturday
+SATURDAY = datetime.datetime(2024, 1, 6)
+
+
+def trigger(id_=1, on_status=None, from_time=None, to_time=None,
+        weekdays=None):
+    """ A trigger as read by Db.load_rules """
+    return dict(id=id_, name=None, on_status=on_status, from_time=from_time,
+        to_time=to_time, weekdays=weekdays, src_type='EXO', src_busid=1,
+        src_channel=2, actions=[])
+
+
+def at(hour, minute, day=SATURDAY):
+    return day.replace(hour=hour, minute=minute)
+
+
+class RuleTest(unittest.TestCase):
+
+    def test_status(self):
+        rule = Rule(trigger(on_status='on'), [])
+        self.assertTrue(rule.matches(128, at(12, 0)))
+        self.assertFalse(rule.matches(0, at(12, 0)))
+        rule = Rule(trigger(on_status='off'), [])
+        self.assertTrue(rule.matches(0, at(12, 0)))
+        self.assertFalse(rule.matches(255, at(12, 0)))
+        rule = Rule(trigger(on_status='128'), [])
+        self.assertTrue(rule.matches(128, at(12, 0)))
+        self.assertFalse(rule.matches(255, at(12, 0)))
+
+    def test_time_range(self):
+        rule = Rule(trigger(from_time='08:00', to_time='18:30'), [])
+        self.assertFalse(rule.matches(None, at(7, 59)))
+        self.assertTrue(rule.matches(None, at(8, 0)))
+        self.assertTrue(rule.matches(None, at(18, 29)))
+        self.assertFalse(rule.matches(None, at(18, 30)))
+
+    def test_over_midnight(self):
+        rule = Rule(trigger(from_time='22:00', to_time='6:00'), [])
+        self.assertTrue(rule.matches(None, at(22, 0)))
+        self.assertTrue(rule.matches(None, at(23, 59)))
+        self.assertTrue(rule.matches(None, at(0, 0)))
+        self.assertTrue(rule.matches(None, at(5, 59)))
+        self.assertFalse(rule.matches(None, at(6, 0)))
+        self.assertFalse(rule.matches(None, at(12, 0)))
+        self.assertFalse(rule.matches(None, at(21, 59)))
+
+    def test_open_range(self):
+        rule = Rule(trigger(from_time='20:00'), [])
+        self.assertTrue(rule.matches(None, at(23, 59)))
+        self.assertFalse(rule.matches(None, at(0, 0)))
+        rule = Rule(trigger(to_time='7:30'), [])
+        self.assertTrue(rule.matches(None, at(0, 0)))
+        self.assertFalse(rule.matches(None, at(7, 30)))
+
+    def test_weekdays(self):
+        rule = Rule(trigger(weekdays='67'), [])
+        self.assertTrue(rule.matches(None, SATURDAY))
+        self.assertTrue(rule.matches(None, SATURDAY +
+            datetime.timedelta(days=1)))
+        self.assertFalse(rule.matches(None, SATURDAY +
+            datetime.timedelta(days=2)))
+        # Weekdays and time : saturday night only
+        rule = Rule(trigger(from_time='22:00', to_time='06:00',
+            weekdays='6'), [])
+        self.assertTrue(rule.matches(None, at(23, 0)))
+        self.assertFalse(rule.matches(None, at(1, 0,
+            SATURDAY + datetime.timedelta(days=1))))
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time('7:05'), '07:05')
+        self.assertEqual(parse_time(' 24:00 '), '24:00')
+        self.assertEqual(parse_time(''), None)
+        self.assertEqual(parse_time(None), None)
+        for value in ('24:01', '12:60', '1200', 'noon', '-1:00'):
+            self.assertRaises(ValueError, parse_time, value)
+
+
+class RuleEngineTest(unittest.TestCase):
+
+    def test_load(self):
+        engine = RuleEngine(None)
+        count = engine.load([trigger(1), trigger(2, from_time='25:00'),
+            trigger(3, weekdays='12345')])
+        self.assertEqual(count, 2)
+        self.assertEqual([rule.id for rule in engine.index[('EXO', 1, 2)]],
+            [1, 3])
+
+    def test_reload_keeps_counters(self):
+        engine = RuleEngine(None)
+        engine.load([trigger(1), trigger(2)])
+        engine.rules[0].hits, engine.rules[0].runs = 5, 3
+        engine.load([trigger(1, on_status='on'), trigger(4)])
+        stats = engine.stats()['rules']
+        self.assertEqual((stats['1']['hits'], stats['1']['runs']), (5, 3))
+        self.assertEqual(stats['4']['hits'], 0)
+        self.assertFalse('2' in stats)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    compile_scene of mu/scenes.py : outputs per EXO and store stops.
+    Usage : python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'mu'))
+from scenes import compile_scene, target_outputs
+
+# Registry of load_registry : devid : {'channels': {cmdtype: (exo, channel)}}
+DEVICES = {
+    '1': {'channels': {'power': (1, 1)}},
+    '2': {'channels': {'power': (1, 2)}},
+    '3': {'channels': {'power': (2, 1)}},
+    '4': {'channels': {'up': (3, 1), 'down': (3, 2)}},
+    # Light wired on the same output as device 1
+    '5': {'channels': {'power': (1, 1)}},
+    }
+
+
+class CompileSceneTest(unittest.TestCase):
+
+    def test_frames_per_exo(self):
+        frames, stops = compile_scene([(1, 'on'), (2, '128'), (3, 'off')],
+            DEVICES)
+        self.assertEqual(frames, {1: {1: 255, 2: 128}, 2: {1: 0}})
+        self.assertEqual(stops, {})
+
+    def test_last_wins(self):
+        frames, stops = compile_scene([(1, 'on'), (2, 'on'), (1, 'off')],
+            DEVICES)
+        self.assertEqual(frames, {1: {1: 0, 2: 255}})
+        frames, stops = compile_scene([(1, 'on'), (5, '64')], DEVICES)
+        self.assertEqual(frames, {1: {1: 64}})
+
+    def test_store_stops(self):
+        frames, stops = compile_scene([(4, 'up')], DEVICES)
+        self.assertEqual(frames, {3: {1: 255, 2: 0}})
+        self.assertEqual(stops, {3: {1: 0}})
+        frames, stops = compile_scene([(4, 'up'), (4, 'down')], DEVICES)
+        self.assertEqual(frames, {3: {1: 0, 2: 255}})
+        self.assertEqual(stops, {3: {2: 0}})
+        frames, stops = compile_scene([(4, 'down'), (4, 'stop')], DEVICES)
+        self.assertEqual(frames, {3: {1: 0, 2: 0}})
+        self.assertEqual(stops, {})
+
+    def test_invalid_targets(self):
+        self.assertRaises(ValueError, compile_scene, [(9, 'on')], DEVICES)
+        self.assertRaises(ValueError, compile_scene, [(1, 'up')], DEVICES)
+        self.assertRaises(ValueError, compile_scene, [(1, '256')], DEVICES)
+        self.assertRaises(ValueError, target_outputs, 'dim')
+        self.assertEqual(target_outputs(' ON '), {'power': 255})
+
+
+if __name__ == '__main__':
+    unittest.main()
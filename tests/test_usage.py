@@ -0,0 +1,165 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Usage aggregates of mu/usage.py : the tables kept up to date by
+    Usage.record are the ones computed again by rebuild().
+    Usage : python -m unittest discover tests
+"""
+
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'mu'))
+from twisted.internet import defer
+import db
+import usage
+
+HISTORY = ('CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+    'dtime DATETIME, type TEXT NOT NULL, busid NUMERIC NOT NULL, '
+    'channel NUMERIC NOT NULL, status TEXT NOT NULL)')
+START = datetime.datetime(2024, 3, 30, 21, 10, 5, 250000)
+
+
+class Writer(object):
+    """ DbWriter executing the statements at once """
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = 0
+
+    def execute(self, statement, params):
+        self.conn.execute(statement, params)
+
+    def call(self, func, *args):
+        self.calls += 1
+        return defer.succeed(func(self.conn.cursor(), *args))
+
+
+def open_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute(HISTORY)
+    for version, description, statements in db.MIGRATIONS:
+        if version == 3:
+            for statement in statements:
+                if not callable(statement):
+                    conn.execute(statement)
+    return conn
+
+
+def tables(conn):
+    return dict([(period, conn.execute('SELECT start, exo, channel, ontime, '
+        'switches, laststatus FROM usage_{0} ORDER BY exo, channel, '
+        'start'.format(period)).fetchall()) for period in usage.PERIODS])
+
+
+class UsageTest(unittest.TestCase):
+
+    def assertSameTables(self, first, second):
+        for period in usage.PERIODS:
+            self.assertEqual(len(first[period]), len(second[period]))
+            for row, other in zip(first[period], second[period]):
+                self.assertEqual(row[:3] + row[4:], other[:3] + other[4:])
+                self.assertAlmostEqual(row[3], other[3], places=3)
+
+    def check(self, changes):
+        """ Record the changes [(dtime, exo, channel, status)], rebuild """
+        conn = open_db()
+        writer = Writer(conn)
+        recorder = usage.Usage(conn, writer)
+        for dtime, exo, channel, status in changes:
+            conn.execute(db.HISTORY_INSERT, [str(dtime), 'EXO', exo, channel,
+                str(status)])
+            recorder.record(dtime, exo, channel, status)
+        # All the deltas in a single write
+        self.assertEqual(writer.calls, 0)
+        recorder.flush()
+        self.assertEqual(writer.calls, 1)
+        recorded = tables(conn)
+        cur = conn.cursor()
+        self.assertEqual(usage.rebuild(cur), len(changes))
+        self.assertSameTables(recorded, tables(conn))
+        return recorded
+
+    def test_same_hour(self):
+        recorded = self.check([
+            (START, 1, 1, 255),
+            (START + datetime.timedelta(minutes=10), 1, 1, 0),
+            (START + datetime.timedelta(minutes=20), 1, 1, 128),
+            (START + datetime.timedelta(minutes=30), 1, 1, 0),
+            ])
+        self.assertEqual(len(recorded['hour']), 1)
+        start, exo, channel, ontime, switches, laststatus = \
+            recorded['hour'][0]
+        self.assertEqual(start, '2024-03-30 21:00:00')
+        self.assertAlmostEqual(ontime, 1200.0)
+        self.assertEqual((switches, laststatus), (4, 0))
+
+    def test_over_hours_and_midnight(self):
+        recorded = self.check([
+            (START, 2, 3, 255),
+            (START + datetime.timedelta(hours=4, minutes=5), 2, 3, 0),
+            ])
+        hours = [row[0] for row in recorded['hour']]
+        self.assertEqual(hours[0], '2024-03-30 21:00:00')
+        self.assertEqual(hours[-1], '2024-03-31 01:00:00')
+        self.assertEqual(len(hours), 5)
+        days = recorded['day']
+        self.assertEqual([row[0] for row in days],
+            ['2024-03-30 00:00:00', '2024-03-31 00:00:00'])
+        self.assertAlmostEqual(days[0][3] + days[1][3], 4 * 3600 + 300)
+        self.assertEqual((days[0][4], days[1][4]), (1, 1))
+        self.assertEqual((days[0][5], days[1][5]), (255, 0))
+
+    def test_query_before_flush(self):
+        conn = open_db()
+        recorder = usage.Usage(conn, Writer(conn))
+        end = START + datetime.timedelta(hours=3)
+        for minutes, status in ((0, 255), (50, 0), (70, 128), (100, 0)):
+            recorder.record(START + datetime.timedelta(minutes=minutes), 1,
+                1, status)
+        pending = recorder.query(1, 1, 'hour', START, end, end)
+        recorder.flush()
+        self.assertEqual(recorder.query(1, 1, 'hour', START, end, end),
+            pending)
+        self.assertAlmostEqual(sum([row[1] for row in pending]), 80 * 60)
+        self.assertEqual(sum([row[2] for row in pending]), 4)
+        recorder.record(end - datetime.timedelta(minutes=1), 1, 2, 255)
+        self.assertEqual(recorder.query(1, 1, 'hour', START, end, end),
+            pending)
+        recorder.flush()
+
+    def test_random_history(self):
+        rand = random.Random(42)
+        changes = list()
+        dtime = START
+        for i in range(2000):
+            dtime += datetime.timedelta(seconds=rand.expovariate(1 / 900.0))
+            changes.append((dtime, rand.randint(1, 3), rand.randint(1, 8),
+                rand.choice((0, 0, 64, 255))))
+        self.check(changes)
+
+
+if __name__ == '__main__':
+    unittest.main()
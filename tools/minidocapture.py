@@ -0,0 +1,157 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Capture files of the bus traffic, written by MinidoProtocol (see its
+    capture argument) and replayed by mu/minidoreplay.py.
+
+    The file starts with MAGIC, followed by one record per packet :
+        timestamp : float64, seconds of clock(), a monotonic clock : an
+                    NTP step does not break the replay timing
+        direction : uint8, RX (received from the bus) or TX (sent to it)
+        length    : uint16, length of the packet
+        packet    : the raw bytes, checksum included
+    All values are little endian. A capture file can be appended to by
+    several connections or runs of a program. The timestamps of a new
+    run may restart from a lower value (after a reboot), the replayer
+    does not wait in that case.
+    CaptureReader maps the file in memory, so a capture of several days
+    is replayed without being loaded in RAM.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'MUCAP01\n'
+RECORD = struct.Struct('<dBH')
+RX = 0
+TX = 1
+DIRECTIONS = {'rx': (RX,), 'tx': (TX,), 'all': (RX, TX)}
+# Maximum time (seconds) the records may stay in the write buffer
+FLUSH = 1.0
+
+
+
+def monotonic_clock():
+    """
+    A monotonic clock in seconds : time.monotonic with python 3.3+, else
+    the monotonic module if installed, else CLOCK_MONOTONIC through ctypes
+    (Linux), else os.times() (10 ms resolution only).
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        from monotonic import monotonic
+        return monotonic
+    except (ImportError, RuntimeError):
+        pass
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+            use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        spec = timespec()
+
+        def clock():
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(spec)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+        clock()
+        return clock
+    except (OSError, AttributeError):
+        return lambda: os.times()[4]
+
+clock = monotonic_clock()
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureWriter(object):
+    """ Append the packets to a capture file """
+    def __init__(self, filename, flush=FLUSH):
+        self.filename = filename
+        self.file = open(filename, 'ab')
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.flushdelay = flush
+        self.lastflush = clock()
+        self.records = 0
+
+    def write(self, direction, data):
+        """ Record a packet (byte string) sent or received now """
+        now = clock()
+        self.file.write(RECORD.pack(now, direction, len(data)))
+        self.file.write(data)
+        self.records += 1
+        if now - self.lastflush >= self.flushdelay:
+            self.file.flush()
+            self.lastflush = now
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class CaptureReader(object):
+    """
+    Iterate over the records of a capture file :
+        for timestamp, direction, packet in CaptureReader(filename):
+    packet is a byte string. A truncated last record (file still being
+    written) is ignored.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(MAGIC):
+            self.file.close()
+            raise CaptureError('%s is not a capture file' % filename)
+        self.map = mmap.mmap(self.file.fileno(), size,
+            access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise CaptureError('%s is not a capture file' % filename)
+        self.size = size
+
+    def __iter__(self):
+        mapped = self.map
+        offset = len(MAGIC)
+        while offset + RECORD.size <= self.size:
+            timestamp, direction, length = RECORD.unpack_from(mapped, offset)
+            start = offset + RECORD.size
+            offset = start + length
+            if offset > self.size:
+                break
+            yield timestamp, direction, mapped[start:offset]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
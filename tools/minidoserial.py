@@ -0,0 +1,121 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Serial adapter : drive the MinidoProtocol over a local serial device
+    (RS485 converter) instead of the TCP/IP adapter.
+    The protocol is built by the same factory as for the TCP/IP adapter,
+    so framing and pacing are identical.
+    Requires pyserial.
+"""
+
+from __future__ import print_function
+from twisted.application import service
+from twisted.internet import reactor
+from twisted.internet.serialport import SerialPort
+import logging
+import serial
+
+BAUDRATE = 19200
+# pyserial read timeout (seconds), reads are non blocking with Twisted.
+TIMEOUT = 0
+# Delay before trying to open the device again (seconds)
+RETRY = 5.0
+
+log = logging.getLogger('mu.serial')
+
+
+class MinidoSerialPort(SerialPort):
+    """
+    SerialPort over a serial.Serial already opened by its SerialClient,
+    telling it when it is closed
+    """
+    def __init__(self, client, protocol, port):
+        self.client = client
+        self.device = port.port
+        self.opened = port
+        SerialPort.__init__(self, protocol, port.port, reactor)
+
+    def _serialFactory(self, *args, **kwargs):
+        return self.opened
+
+    def getPeer(self):
+        """ Used by MinidoProtocol to log the connection """
+        return 'serial:' + str(self.device)
+
+    def connectionLost(self, reason):
+        SerialPort.connectionLost(self, reason)
+        self.client.port_lost(reason)
+
+
+class SerialClient(service.Service):
+    """
+    Keep the serial device open, as internet.TCPClient does with a
+    ReconnectingClientFactory :
+        minidoclient = SerialClient(minido_factory, '/dev/ttyUSB0')
+        minidoclient.setServiceParent(application)
+    timeout is the pyserial read timeout (see TIMEOUT).
+    """
+    def __init__(self, factory, device, baudrate=BAUDRATE, timeout=TIMEOUT,
+            retry=RETRY):
+        self.factory = factory
+        self.device = device
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.retry = retry
+        self.port = None
+        self.retrycall = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.open()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.retrycall is not None and self.retrycall.active():
+            self.retrycall.cancel()
+        self.retrycall = None
+        if self.port is not None:
+            self.port.loseConnection()
+
+    def open(self):
+        self.retrycall = None
+        # The protocol is only built once the device is open : the factory
+        # may do some work for each new connection.
+        try:
+            port = serial.Serial(self.device, baudrate=self.baudrate,
+                timeout=self.timeout)
+        except (serial.SerialException, OSError, IOError) as e:
+            log.warning('Unable to open %s : %s', self.device, e)
+            self.schedule_open()
+            return
+        protocol = self.factory.buildProtocol(self.device)
+        self.port = MinidoSerialPort(self, protocol, port)
+        log.info('Serial device %s opened at %s bauds.', self.device,
+            self.baudrate)
+
+    def port_lost(self, reason):
+        log.warning('Lost serial device %s. Reason: %s', self.device, reason)
+        self.port = None
+        self.schedule_open()
+
+    def schedule_open(self):
+        if self.running and self.retrycall is None:
+            self.retrycall = reactor.callLater(self.retry, self.open)
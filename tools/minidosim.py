@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Bus simulator : a stand-in for the minidoadt TCP/IP adapter and the
+    modules behind it, to run the bridges and MU without the hardware.
+
+    - Bus          : one frame at a time, each frame lasting its length at
+                     the given baudrate (10 bits per byte), followed by an
+                     inter-frame gap. Noise (random bytes between frames)
+                     and corrupted checksums can be injected in what the
+                     TCP/IP clients receive.
+    - SimExo       : answers EXO_ECHO_REQUEST and applies EXO_UPDATE.
+    - SimExi       : answers EXI_ECHO_REQUEST, and presses its buttons at
+                     random : EXICENT to the D2000, then EXO_UPDATE to
+                     the EXO outputs linked to the button (toggled).
+    - AdapterFactory : TCP/IP server, every frame of the bus is sent to
+                     the clients (except the one who wrote it), and every
+                     frame written by a client is put on the bus.
+
+    Usage : ./minidosim.py [--port 10023] [--exi 1,2,3] [--press-rate 1]
+    then set MINIDO_ADAPTER_HOST/PORT to localhost/10023 in the bridge.
+"""
+
+from __future__ import print_function
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from collections import deque
+import argparse
+import logging
+import random
+
+from protocol import MinidoProtocol, checksum
+import mulog
+from mulog import HexData
+
+LISTEN_PORT = 10023
+BAUDRATE = 19200
+# Silence between two frames on the bus (seconds)
+GAP = 0.002
+# Delay before a module answers (seconds)
+RESPONSE_DELAY = 0.005
+# Probability, for each frame sent to the clients, to send some random
+# bytes before it, and to corrupt its checksum.
+NOISE = 0.0
+CORRUPT = 0.0
+STATS_PERIOD = 60.0
+LOG_LEVELS = {'mu': 'INFO'}
+
+# Never change the following values, they are the bus addresses :
+EXOOFFSET = 0x3B
+EXIOFFSET = 0x13
+D2000 = 0x0B
+CMD = {
+    'EXO_UPDATE': 0x01,
+    'EXICENT'   : 0x31,
+    'EXI_ECHO_REQUEST': 0x39,
+    'EXI_ECHO_REPLY': 0x38,
+    'EXO_ECHO_REQUEST': 0x49,
+    'EXO_ECHO_REPLY': 0x05,
+    }
+DST = 1
+SRC = 2
+COM = 4
+# Sent by the MinidoProtocol keepalive to the adapter, not to the bus
+KEEPALIVE = b'\x31\x00\x00\x01\x00'
+
+log = logging.getLogger('mu.sim')
+
+
+def frame(dst, src, cmd, data=()):
+    """ Build a complete frame as a bytearray """
+    data = [cmd] + list(data)
+    return bytearray([0x23, dst, src, len(data) + 1] + data +
+        [checksum(data)])
+
+
+class Bus(object):
+    """
+    The RS485 bus : frames are sent one after the other, and delivered to
+    every module and client once sent.
+    """
+    def __init__(self, baudrate=BAUDRATE, gap=GAP, noise=NOISE,
+            corrupt=CORRUPT, rng=None):
+        self.baudrate = baudrate
+        self.gap = gap
+        self.noise = noise
+        self.corrupt = corrupt
+        self.random = rng or random.Random()
+        self.modules = dict()
+        self.clients = list()
+        self.queue = deque()
+        self.call = None
+        self.stats = dict(frames=0, bytes=0, busy=0.0, depth_max=0,
+            noise=0, corrupted=0)
+
+    def add_module(self, module):
+        self.modules[module.address] = module
+        module.bus = self
+
+    def send(self, data, origin=None):
+        """ Queue a frame (bytearray), origin is the client writing it """
+        self.queue.append((data, origin))
+        if len(self.queue) > self.stats['depth_max']:
+            self.stats['depth_max'] = len(self.queue)
+        if self.call is None:
+            self.start_frame()
+
+    def start_frame(self):
+        data, origin = self.queue[0]
+        duration = 0.0
+        if self.baudrate > 0:
+            duration = len(data) * 10.0 / self.baudrate
+        self.stats['busy'] += duration
+        self.call = reactor.callLater(duration, self.end_frame)
+
+    def end_frame(self):
+        data, origin = self.queue.popleft()
+        self.stats['frames'] += 1
+        self.stats['bytes'] += len(data)
+        self.deliver(data, origin)
+        if self.queue:
+            self.call = reactor.callLater(self.gap, self.start_frame)
+        else:
+            self.call = reactor.callLater(self.gap, self.idle)
+
+    def idle(self):
+        self.call = None
+        if self.queue:
+            self.start_frame()
+
+    def deliver(self, data, origin):
+        log.debug('Bus : %s', HexData(data))
+        module = self.modules.get(data[DST])
+        if module is not None:
+            module.received(data)
+        if not self.clients:
+            return
+        raw = bytes(data)
+        if self.corrupt and self.random.random() < self.corrupt:
+            self.stats['corrupted'] += 1
+            raw = raw[:-1] + bytes(bytearray([data[-1] ^ 0xFF]))
+        if self.noise and self.random.random() < self.noise:
+            self.stats['noise'] += 1
+            raw = bytes(bytearray([self.random.randrange(256)
+                for i in range(self.random.randint(1, 8))])) + raw
+        for client in self.clients:
+            if client is not origin:
+                client.transport.write(raw)
+
+    def log_stats(self, period):
+        stats = self.stats
+        log.info('Bus : %i frames, %i bytes, %.1f %% busy, queue max %i, '
+            '%i noise, %i corrupted', stats['frames'], stats['bytes'],
+            stats['busy'] * 100.0 / period, stats['depth_max'],
+            stats['noise'], stats['corrupted'])
+        stats['busy'] = 0.0
+
+
+class SimModule(object):
+    """ A module on the bus, answering after RESPONSE_DELAY """
+    def __init__(self, address, delay=RESPONSE_DELAY):
+        self.address = address
+        self.delay = delay
+        self.bus = None
+
+    def reply(self, data):
+        reactor.callLater(self.delay, self.bus.send, data)
+
+    def received(self, data):
+        pass
+
+
+class SimExo(SimModule):
+    """ EXO module : 8 outputs """
+    def __init__(self, exoid, delay=RESPONSE_DELAY):
+        SimModule.__init__(self, exoid + EXOOFFSET, delay)
+        self.exoid = exoid
+        self.outputs = bytearray(8)
+
+    def received(self, data):
+        if data[COM] == CMD['EXO_UPDATE'] and len(data) >= 14:
+            self.outputs[:] = data[5:13]
+        elif data[COM] == CMD['EXO_ECHO_REQUEST']:
+            self.reply(frame(data[SRC], self.address, CMD['EXO_ECHO_REPLY']))
+
+
+class SimExi(SimModule):
+    """
+    EXI module : buttons maps a button number to a list of
+    (SimExo, output) toggled when it is pressed.
+    """
+    def __init__(self, exiid, buttons=None, delay=RESPONSE_DELAY):
+        SimModule.__init__(self, exiid + EXIOFFSET, delay)
+        self.exiid = exiid
+        self.buttons = buttons or dict()
+
+    def received(self, data):
+        if data[COM] == CMD['EXI_ECHO_REQUEST']:
+            self.reply(frame(data[SRC], self.address, CMD['EXI_ECHO_REPLY']))
+
+    def press(self, button):
+        self.bus.send(frame(D2000, self.address, CMD['EXICENT'],
+            [self.exiid, button]))
+        exos = list()
+        for exo, output in self.buttons.get(button, ()):
+            exo.outputs[output - 1] ^= 0xFF
+            if exo not in exos:
+                exos.append(exo)
+        for exo in exos:
+            self.bus.send(frame(exo.address, self.address,
+                CMD['EXO_UPDATE'], exo.outputs))
+
+
+class AdapterProtocol(MinidoProtocol):
+    """ A TCP/IP client of the adapter """
+    def __init__(self, factory):
+        MinidoProtocol.__init__(self, factory, pacing=0.0)
+
+    def connectionMade(self):
+        MinidoProtocol.connectionMade(self)
+        self.factory.bus.clients.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.bus.clients.remove(self)
+        MinidoProtocol.connectionLost(self, reason)
+
+    def dataReceived(self, chardata):
+        # The keepalive of the client is for the adapter only.
+        while not self.buffer and chardata.startswith(KEEPALIVE):
+            chardata = chardata[len(KEEPALIVE):]
+        MinidoProtocol.dataReceived(self, chardata)
+
+    def newpacket(self, data):
+        self.factory.bus.send(bytearray(data), self)
+
+
+class AdapterFactory(Factory):
+    def __init__(self, bus):
+        self.bus = bus
+        self.connections = list()
+
+    def buildProtocol(self, addr):
+        return AdapterProtocol(self)
+
+
+class Presser(object):
+    """ Press random buttons of the EXI, rate presses per second """
+    def __init__(self, exis, rate, rng=None):
+        self.exis = [exi for exi in exis if exi.buttons]
+        self.rate = rate
+        self.random = rng or random.Random()
+        self.call = None
+
+    def start(self):
+        if self.rate > 0 and self.exis:
+            self.schedule()
+
+    def schedule(self):
+        self.call = reactor.callLater(self.random.expovariate(self.rate),
+            self.press)
+
+    def press(self):
+        exi = self.random.choice(self.exis)
+        exi.press(self.random.choice(sorted(exi.buttons)))
+        self.schedule()
+
+    def stop(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+
+def build(exos=16, exis=(1, 2, 3), buttons=8, baudrate=BAUDRATE, gap=GAP,
+        noise=NOISE, corrupt=CORRUPT, seed=None):
+    """
+    Build a simulated bus with EXO 1 to exos, and the given EXI.
+    Button b of EXI i toggles output b of the EXO (i - 1) * buttons + b
+    counted over all the outputs, so that every EXI drives other outputs.
+    Returns the bus, the list of SimExo and the list of SimExi.
+    """
+    rng = random.Random(seed)
+    bus = Bus(baudrate, gap, noise, corrupt, rng)
+    simexos = [SimExo(exoid) for exoid in range(1, exos + 1)]
+    simexis = list()
+    for exo in simexos:
+        bus.add_module(exo)
+    for idx, exiid in enumerate(exis):
+        links = dict()
+        for button in range(1, buttons + 1):
+            if simexos:
+                output = (idx * buttons + button - 1) % (len(simexos) * 8)
+                links[button] = [(simexos[output // 8], output % 8 + 1)]
+        exi = SimExi(exiid, links)
+        bus.add_module(exi)
+        simexis.append(exi)
+    return bus, simexos, simexis
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Minido bus and TCP/IP adapter simulator')
+    parser.add_argument('-p', '--port', type=int, default=LISTEN_PORT,
+        help='TCP/IP port of the adapter (default %i)' % LISTEN_PORT)
+    parser.add_argument('--exo', type=int, default=16,
+        help='Number of EXO modules, 1 to 16 (default 16)')
+    parser.add_argument('--exi', default='1,2,3',
+        help='Comma separated EXI numbers (default 1,2,3). MU uses EXI 4.')
+    parser.add_argument('--buttons', type=int, default=8,
+        help='Number of buttons of each EXI (default 8)')
+    parser.add_argument('--press-rate', type=float, default=0.0,
+        help='Button presses per second, over all EXI (default 0)')
+    parser.add_argument('--baudrate', type=int, default=BAUDRATE,
+        help='Bus speed in bits/s, 0 for no limit (default %i)' % BAUDRATE)
+    parser.add_argument('--gap', type=float, default=GAP,
+        help='Silence between frames in seconds (default %s)' % GAP)
+    parser.add_argument('--noise', type=float, default=NOISE,
+        help='Probability of random bytes before a frame (default 0)')
+    parser.add_argument('--corrupt', type=float, default=CORRUPT,
+        help='Probability of a corrupted checksum (default 0)')
+    parser.add_argument('--seed', type=int, default=None,
+        help='Random seed, for repeatable runs')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='Log every frame')
+    args = parser.parse_args()
+    if not 0 <= args.exo <= 16:
+        parser.error('--exo must be between 0 and 16')
+    exis = [int(exi) for exi in args.exi.split(',') if exi]
+    if [exi for exi in exis if not 1 <= exi <= 16]:
+        parser.error('--exi numbers must be between 1 and 16')
+
+    mulog.setup({'mu': 'DEBUG'} if args.verbose else LOG_LEVELS)
+    bus, simexos, simexis = build(args.exo, exis, args.buttons,
+        args.baudrate, args.gap, args.noise, args.corrupt, args.seed)
+    Presser(simexis, args.press_rate, bus.random).start()
+    LoopingCall(bus.log_stats, STATS_PERIOD).start(STATS_PERIOD, now=False)
+    reactor.listenTCP(args.port, AdapterFactory(bus))
+    log.info('Simulating %i EXO and EXI %s on port %i', len(simexos),
+        exis, args.port)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
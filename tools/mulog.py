@@ -0,0 +1,127 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Logging shared by the mu programs and the tools bridges.
+
+    Every module logs to its own logger ('mu.protocol', 'mu.decoder', ...)
+    with %-style arguments, so that nothing is formatted when the level
+    is disabled :
+        log = logging.getLogger('mu.protocol')
+        log.debug('Sending %s', HexData(packet))
+    The program calls setup() once, with the level of each logger.
+    The records are written by a separate thread, so a slow or blocked
+    sink (journal, NFS, terminal) never stalls the reactor. When the
+    buffer is full, new records are dropped and counted, and the count
+    is logged as soon as the writer has caught up.
+    Do not modify the arguments of a record after logging it, as it is
+    formatted later by the writer thread.
+"""
+
+import logging
+import sys
+import threading
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+FORMAT = '%(asctime)s %(name)s %(levelname)s : %(message)s'
+# Number of records waiting for the writer thread before dropping
+QUEUE_SIZE = 10000
+
+
+class HexData(object):
+    """ Hex dump of a packet, only built if the log record is written """
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return ' '.join(['{0:02x}'.format(x) for x in self.data])
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Queue the records for a writer thread, which formats them and hands
+    them to the target handler.
+    """
+    def __init__(self, target, queue_size=QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue(queue_size)
+        self.dropped = 0
+        self.reported = 0
+        self.thread = threading.Thread(target=self.writer, name='mulog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def writer(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.target.handle(record)
+            if self.dropped != self.reported and self.queue.empty():
+                dropped = self.dropped
+                self.target.handle(logging.LogRecord('mu.log',
+                    logging.WARNING, __file__, 0,
+                    '%i log records dropped (%i since startup)',
+                    (dropped - self.reported, dropped), None))
+                self.reported = dropped
+
+    def close(self):
+        """ Write what is still queued, then close the target """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def setup(levels=None, stream=None, filename=None, queue_size=QUEUE_SIZE):
+    """
+    Send every log record to a stream (stdout by default) or a file,
+    through an AsyncHandler, and return this handler.
+    levels maps logger names to levels, e.g. {'mu': 'INFO',
+    'mu.decoder': 'DEBUG'}. The root logger (other libraries) is set to
+    WARNING unless levels says otherwise.
+    """
+    if filename is not None:
+        target = logging.FileHandler(filename)
+    else:
+        target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(logging.Formatter(FORMAT))
+    handler = AsyncHandler(target, queue_size)
+
+    root = logging.getLogger()
+    # stompservice installs its own DEBUG handler on the root logger.
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(logging.WARNING)
+    for name, level in (levels or dict()).items():
+        logging.getLogger(name).setLevel(level)
+    return handler
@@ -24,10 +24,28 @@
 """
 
 from twisted.internet.protocol import Protocol
-from twisted.internet import task
-import datetime
+from twisted.internet import reactor, task, defer
+from collections import deque
+from mulog import HexData
+from minidocapture import RX, TX
+import logging
 import time
 
+# Minimum gap between two packets on the bus (seconds)
+PACING = 0.01
+# Transmit priority classes, the first non empty queue is sent first.
+# interactive : EXO writes requested by a user or a device
+# normal      : everything else
+# background  : keepalive, EXI/EXO echo scans
+PRIORITIES = ('interactive', 'normal', 'background')
+
+log = logging.getLogger('mu.protocol')
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
 def checksum(datalist):
     """ Calculate an XOR checksum """
     checksum_ = 0
@@ -35,6 +53,13 @@ def checksum(datalist):
         checksum_ ^= item
     return checksum_
 
+def checksum_at(buf, start, end):
+    """ Calculate an XOR checksum of buf[start:end] without copying it """
+    checksum_ = 0
+    for idx in xrange(start, end):
+        checksum_ ^= buf[idx]
+    return checksum_
+
 class MinidoProtocol(Protocol):
     """
     Bus protocol (low level), also used for Minido, D2000 and C2000
@@ -43,65 +68,157 @@ class MinidoProtocol(Protocol):
     or add the missing checksum before sending packets.
     The decoding is left to the MinidoProtocolDecoder class when receiving
     new packet.
+    If capture is a minidocapture.CaptureWriter, every validated packet
+    received and every packet sent is recorded in it.
     """
-    chardata = list()
-    def __init__(self, factory, kalive=0.0):
+    def __init__(self, factory, kalive=0.0, pacing=PACING, rxtimeout=0.0,
+            capture=None):
         self.factory = factory
-        print('MinidoProtocol initialized')
-        self.factory.connections = list()
+        self.capture = capture
+        # Receive buffer and read offset, one per connection.
+        self.buffer = bytearray()
+        self.offset = 0
+        # An incomplete packet is dropped if nothing more is received
+        # within rxtimeout seconds (disabled if 0.0)
+        self.rxtimeout = rxtimeout
+        self.rxcall = None
+        log.debug('MinidoProtocol initialized')
+        # Shared by all the connections of a server factory
+        if getattr(self.factory, 'connections', None) is None:
+            self.factory.connections = list()
         self.kalive = kalive
-        self.lastmsgtime = ( datetime.datetime.now() 
-            - datetime.timedelta(microseconds=10000))
+        self.pacing = pacing
+        self.lastmsgtime = time.time() - pacing
+        # Transmit queues, one per priority class, of (time queued, packet,
+        # Deferred of send_data)
+        self.txqueues = dict([(prio, deque()) for prio in PRIORITIES])
+        self.txcall = None
+        self.txstats = dict(sent=0, dropped=0, wait_total=0.0,
+            wait_max=0.0, depth_max=0)
 
     def connectionMade(self):
-        print(str(datetime.datetime.now()) + " :" +
-            "New connection :" + str(self.transport.getPeer()))
+        log.info('New connection : %s', self.transport.getPeer())
         self.factory.connections.append(self)
         if self.kalive > 0.0:
-            print('Starting the keepalive loop every ' + str(self.kalive) + ' seconds.')
+            log.info('Starting the keepalive loop every %s seconds.',
+                self.kalive)
             self.loopingcall = task.LoopingCall(self.keepalive)
             self.loopingcall.start(self.kalive)
         else:
-            print('Keepalive disabled for this connection')
+            log.info('Keepalive disabled for this connection')
 
     def connectionLost(self, reason):
         self.factory.connections.remove(self)
-        print("Lost connection : " + str(self.transport.getPeer()))
-        print("Reason : " + str(reason))
+        log.info('Lost connection : %s Reason : %s',
+            self.transport.getPeer(), reason)
         if self.kalive > 0.0:
             self.loopingcall.stop()
+        if self.txcall is not None and self.txcall.active():
+            self.txcall.cancel()
+        self.txcall = None
+        if self.rxcall is not None and self.rxcall.active():
+            self.rxcall.cancel()
+        self.rxcall = None
+        for queue in self.txqueues.values():
+            self.txstats['dropped'] += len(queue)
+            for queued, packet, d in queue:
+                d.callback(False)
+            queue.clear()
 
 
     def newpacket(self, data):
-        """ Called when a new packet is validated """
-        self.factory.recv_message(data)
-        self.lastmsgtime = datetime.datetime.now()
-
-    def send_data(self, data):
-        timed = datetime.datetime.now() - self.lastmsgtime 
-        if timed < datetime.timedelta(microseconds=10000):
-            print('Delayed send_data by 0.01s')
-            time.sleep(0.01)
-        self.lastmsgtime = datetime.datetime.now()
+        """
+        Called when a new packet is validated
+        data is the complete packet as an immutable byte string.
+        """
+        if self.capture is not None:
+            self.capture.write(RX, data)
+        self.factory.recv_message(list(bytearray(data)))
+        self.lastmsgtime = time.time()
+
+    def send_data(self, data, priority='normal'):
+        """
+        Validate the packet (adding the missing checksum if needed),
+        and queue it for transmission. Packets are released on the bus
+        by transmit(), at most one every self.pacing seconds.
+        Returns a Deferred fired with True when the packet is written, or
+        False if it is dropped (bad checksum, connection lost).
+        """
         if data[len(data)-1] == checksum( data[4:(len(data)-1)]):
-            # print(str(datetime.datetime.now()) + " : ",
-            #     ' '.join([ '%0.2x' % c for c in data ]))
-            packet = ''.join([chr(x) for x in data])
-            self.transport.write(packet)
+            packet = bytes(bytearray(data))
         else:
             # First check if the packet is complete, 
             # and build the missing checksum.
             if len(data) == data[3] + 3:
-                print(str(datetime.datetime.now()) + " :",
-                    "Adding the missing checksum")
+                log.debug('Adding the missing checksum')
+                # The caller's list is completed on purpose : the bridges
+                # forward the same list to the other listeners.
                 data.append(checksum ( data[4:(len(data))] ))
-                packet = ''.join([chr(x) for x in data])
-                self.transport.write(packet)
-
+                packet = bytes(bytearray(data))
             else:
-                print(str(datetime.datetime.now()) + " : " + 
-                    'Bad checksum for packet : ' + str(' '.join(
-                    [ '%0.2x' % c for c in data ])))
+                log.warning('Bad checksum for packet : %s', HexData(data))
+                return defer.succeed(False)
+        d = defer.Deferred()
+        queue = self.txqueues.get(priority, self.txqueues['normal'])
+        queue.append((time.time(), packet, d))
+        depth = self.txdepth()
+        if depth > self.txstats['depth_max']:
+            self.txstats['depth_max'] = depth
+        self.schedule_transmit()
+        return d
+
+    def schedule_transmit(self):
+        """ Make sure transmit() will be called when the bus is free """
+        if self.txcall is not None and self.txcall.active():
+            return
+        delay = self.lastmsgtime + self.pacing - time.time()
+        self.txcall = reactor.callLater(max(delay, 0.0), self.transmit)
+
+    def transmit(self):
+        """ Write the first packet of the highest priority queue """
+        self.txcall = None
+        now = time.time()
+        if now < self.lastmsgtime + self.pacing:
+            # Something was received on the bus in the meantime.
+            self.schedule_transmit()
+            return
+        for prio in PRIORITIES:
+            if self.txqueues[prio]:
+                queued, packet, d = self.txqueues[prio].popleft()
+                break
+        else:
+            return
+        wait = now - queued
+        self.txstats['sent'] += 1
+        self.txstats['wait_total'] += wait
+        if wait > self.txstats['wait_max']:
+            self.txstats['wait_max'] = wait
+        self.lastmsgtime = now
+        if self.capture is not None:
+            self.capture.write(TX, packet)
+        self.transport.write(packet)
+        if self.txdepth():
+            self.schedule_transmit()
+        d.callback(True)
+
+    def txdepth(self):
+        """ Number of packets waiting to be sent """
+        return sum([len(queue) for queue in self.txqueues.values()])
+
+    def get_txstats(self):
+        """
+        Transmit queue statistics :
+        current depth per priority, highest depth seen, packets sent
+        and dropped, average and maximum wait time in the queue (seconds).
+        """
+        stats = dict(self.txstats)
+        stats['depth'] = dict([(prio, len(self.txqueues[prio]))
+            for prio in PRIORITIES])
+        if stats['sent']:
+            stats['wait_avg'] = stats['wait_total'] / stats['sent']
+        else:
+            stats['wait_avg'] = 0.0
+        return stats
 
 #    def send_packet(self, dst, data):
 #        valuelist = [0x23, dst, EXIID, len(data) + 1] + data
@@ -112,51 +229,74 @@ class MinidoProtocol(Protocol):
 #        self.transport.write(packet)
 
     def dataReceived(self, chardata):
-        """ This method is called by Twisted  """
-        self.chardata.extend(chardata)
-            
-        while len(self.chardata) >= 6:
-            if ord(self.chardata[0]) != 0x23:
-                startidx = 0
-                try:
-                    startidx = self.chardata.index(chr(0x23))
-                except(LookupError, ValueError):
-                    # We did not find 0x23
-                    # We are not interested in data not starting by 0x23.
-                    print(str(datetime.datetime.now()) +
-                        " Error : none is 0x23. Dropping everything.")
-                    print(str([ord(x) for x in self.chardata]))
-                    self.chardata = list()
+        """
+        This method is called by Twisted.
+        The incoming bytes are appended to a per connection bytearray,
+        and self.offset is the read position in it. Packets are only
+        copied once, when they are handed to newpacket, and the consumed
+        bytes are removed once per call.
+        """
+        buf = self.buffer
+        buf.extend(chardata)
+        offset = self.offset
+        end = len(buf)
+        view = memoryview(buf)
+        try:
+            while end - offset >= 6:
+                if buf[offset] != 0x23:
+                    startidx = buf.find(b'\x23', offset)
+                    if startidx < 0:
+                        # We did not find 0x23
+                        # We are not interested in data not starting by 0x23.
+                        log.warning('None is 0x23. Dropping %i bytes.',
+                            end - offset)
+                        offset = end
+                        break
+                    log.warning('Deleting first characters : StartIDX : %i',
+                        startidx - offset)
+                    offset = startidx
                     continue
-
-                if startidx != 0:
-                    print('Deleting first characters : StartIDX : ', startidx)
-                    self.chardata = self.chardata[startidx:]
+                # We have a valid begining
+                datalength = buf[offset + 3]
+                if end - offset < datalength + 4:
+                    # Wait for the rest of the packet
+                    break
+                # We have at least a complete packet
+                chkidx = offset + datalength + 3
+                if checksum_at(buf, offset + 4, chkidx) != buf[chkidx]:
+                    log.warning('Invalid checksum for packet : %s',
+                        HexData(bytearray(view[offset:chkidx + 1])))
+                    offset = chkidx + 1
                     continue
+                # OK, I have now a nice, beautiful, valid packet
+                packet = view[offset:chkidx + 1].tobytes()
+                offset = chkidx + 1
+                self.newpacket(packet)
+        finally:
+            # The view must be gone before the bytearray can be resized.
+            del view
+            del buf[:offset]
+            self.offset = 0
+            if self.rxtimeout > 0.0:
+                self.schedule_rxtimeout()
+
+    def schedule_rxtimeout(self):
+        """ (Re)start the timer dropping an incomplete packet """
+        if self.rxcall is not None and self.rxcall.active():
+            if self.buffer:
+                self.rxcall.reset(self.rxtimeout)
             else:
-                """ We have a valid begining """
-                datalength = ord(self.chardata[3])
-                if len(self.chardata) >= datalength + 4:
-                    """ We have at least a complete packet"""
-                    if checksum(
-                        [ord(x) for x in self.chardata[4:datalength + 3]]
-                        ) != ord(self.chardata[datalength + 3]):
-                        print("Warning : Invalid checksum for packet : "
-                            + str( [ord(x) for x in self.chardata] ))
-                        validpacket = self.chardata[0:datalength + 4]
-                        self.chardata = self.chardata[datalength + 4:]
-                        continue
-                    else:
-                        validpacket = self.chardata[0:datalength + 4]
-                        self.chardata = self.chardata[datalength + 4:]
-                    # OK, I have now a nice, beautiful, valid packet
-                    data = [ord(x) for x in validpacket]
-                    self.newpacket(data)
-                else:
-                    #print("Debug packet : " + str(map(lambda x: ord(x), self.chardata)))
-                    #print("Debug ord(self.chardata[3]) : " + str(datalength))
-                    break
+                self.rxcall.cancel()
+                self.rxcall = None
+        elif self.buffer:
+            self.rxcall = reactor.callLater(self.rxtimeout, self.rx_expired)
+
+    def rx_expired(self):
+        self.rxcall = None
+        log.warning('Dropping incomplete packet : %s',
+            HexData(bytearray(self.buffer)))
+        del self.buffer[:]
 
     def keepalive(self):
-         self.send_data([0x31, 0x00, 0x00, 0x01, 0x00])
+         self.send_data([0x31, 0x00, 0x00, 0x01, 0x00], 'background')
  
@@ -0,0 +1,110 @@
+# **- encoding: utf-8 -**
+"""
+    Minido-Unleashed is a set of programs to control a home automation
+    system based on minido from AnB S.A.
+
+    Please check http://kenai.com/projects/minido-unleashed/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+    Encoding of the bus packets in the STOMP messages (/mu/read, /mu/write)
+
+    Two encodings are available :
+    - json   : the packet is a JSON list of integers (default).
+               This is the only one understood by the web browser.
+    - base64 : the raw packet in base64, with the content-type header
+               set to CONTENT_TYPE_PACKET. About 3 times smaller, and no
+               JSON parsing.
+    The encoding is chosen by the sender, the receivers detect it
+    automatically from the content-type header, so both can be mixed on
+    the same channel.
+
+    A message can also carry a batch of packets, in their bus order :
+    - json   : a JSON list of packets (lists of integers).
+    - base64 : the packets one after the other in base64, with the
+               content-type header set to CONTENT_TYPE_BATCH. They are
+               split again using the length byte of each packet.
+    Use packets() to get the packets of a decoded message in both cases.
+"""
+
+import base64
+from orbited import json
+
+ENCODINGS = ('json', 'base64')
+CONTENT_TYPE_PACKET = 'application/x-minido-packet'
+CONTENT_TYPE_BATCH = 'application/x-minido-batch'
+
+
+def encode(data, encoding='json'):
+    """
+    Encode a packet (list of integers) for a STOMP message.
+    Returns the body and a dict of additional STOMP headers.
+    Anything else than a packet is always sent as JSON.
+    """
+    if encoding == 'base64' and isinstance(data, (list, bytearray)):
+        return (base64.b64encode(bytes(bytearray(data))),
+            {'content-type': CONTENT_TYPE_PACKET})
+    return json.encode(data), {}
+
+
+def encode_batch(packets, encoding='json'):
+    """
+    Encode a list of packets for a single STOMP message.
+    Returns the body and a dict of additional STOMP headers.
+    """
+    if encoding == 'base64':
+        raw = bytearray()
+        for packet in packets:
+            raw.extend(packet)
+        return (base64.b64encode(bytes(raw)),
+            {'content-type': CONTENT_TYPE_BATCH})
+    return json.encode(packets), {}
+
+
+def decode(msg):
+    """
+    Decode the body of a received STOMP message.
+    A packet is always returned as a list of integers, and a batch as a
+    list of packets, whatever their encoding.
+    """
+    content_type = msg['headers'].get('content-type')
+    if content_type == CONTENT_TYPE_PACKET:
+        return list(bytearray(base64.b64decode(msg['body'])))
+    if content_type == CONTENT_TYPE_BATCH:
+        return split_packets(bytearray(base64.b64decode(msg['body'])))
+    return json.decode(msg['body'])
+
+
+def split_packets(raw):
+    """ Split a bytearray of packets put one after the other """
+    packets = list()
+    idx = 0
+    while idx + 4 <= len(raw):
+        end = idx + raw[idx + 3] + 4
+        packets.append(list(raw[idx:end]))
+        idx = end
+    return packets
+
+
+def packets(message):
+    """
+    Return the list of packets carried by a decoded message :
+    a single packet, a batch, or nothing if it is not a packet.
+    """
+    if type(message) is list and message:
+        if type(message[0]) is list:
+            return message
+        return [message]
+    return []